@@ -8,7 +8,9 @@ import subprocess
 import time
 import traceback
 from logging.handlers import RotatingFileHandler, SMTPHandler
+from typing import Optional
 
+import simplejson as json
 from flask import Flask, request, jsonify, url_for
 from flask_mail import Mail
 from pythonjsonlogger import jsonlogger
@@ -19,6 +21,9 @@ from bmrbapi.schemas import validate_parameters
 from bmrbapi.utils import querymod
 from bmrbapi.utils.configuration import configuration
 from bmrbapi.utils.connections import RedisConnection, PostgresConnection
+from bmrbapi.utils.dictionary_cache import dictionary_cache
+from bmrbapi.utils.entry_cache import entry_cache
+from bmrbapi.utils.shift_index import metabolomics_shift_index, peak_indexes
 from bmrbapi.views.db_links import db_endpoints
 from bmrbapi.views.dictionary import dictionary_endpoints
 from bmrbapi.views.entry import entry_endpoints
@@ -199,34 +204,49 @@ def catch_all():
     return "<pre>" + "\n".join(links) + "</pre>"
 
 
+def get_version() -> Optional[str]:
+    """ Returns the version of the API. """
+
+    try:
+        return subprocess.check_output(["git", "describe", "--abbrev=0"], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.realpath(__file__))).strip().decode()
+    except (subprocess.CalledProcessError, OSError):
+        try:
+            with open(os.path.join(os.path.dirname(os.path.realpath(__file__)), 'version.txt'), 'r') as version_file:
+                return version_file.read().strip()
+        except IOError:
+            return None
+
+
+# The version can't change without restarting, so only determine it once
+version = get_version()
+
+
 @application.route('/status')
 def get_status():
     """ Returns the server status."""
 
-    stats = {}
-    for key in ['metabolomics', 'macromolecules', 'chemcomps', 'combined']:
-        stats[key] = {}
-        with RedisConnection() as r:
-            for k, v in r.hgetall("%s:meta" % key).items():
-                k = k.decode()
-                v = v.decode()
-                stats[key][k] = v
-        for skey in stats[key]:
-            if skey == "update_time":
-                stats[key][skey] = float(stats[key][skey])
-            else:
-                stats[key][skey] = int(stats[key][skey])
-
-    with PostgresConnection() as pg:
-        for key in ['metabolomics', 'macromolecules']:
-            sql = '''SELECT reltuples FROM pg_class WHERE oid = '%s."Atom_chem_shift"'::regclass;''' % key
-            pg.execute(sql)
-            stats[key]['num_chemical_shifts'] = int(pg.fetchone()[0])
+    # The reloader stores the status of the databases whenever it updates them
+    with RedisConnection() as r:
+        snapshot = r.get("status:snapshot")
+    if snapshot is not None:
+        stats = json.loads(snapshot)
+    else:
+        stats = querymod.store_status_snapshot()
 
-    try:
-        stats['version'] = subprocess.check_output(["git", "describe", "--abbrev=0"]).strip()
-    except subprocess.CalledProcessError:
-        with open(os.path.join(os.path.dirname(os.path.realpath(__file__)), 'version.txt'), 'r') as version_file:
-            stats['version'] = version_file.read().strip()
+    # These are specific to the worker process which handled the request
+    stats['entry_cache'] = entry_cache.stats()
+    stats['dictionary_cache'] = dictionary_cache.stats()
+    stats['metabolomics_shift_index'] = metabolomics_shift_index.stats()
+    stats['peak_indexes'] = {database: index.stats() for database, index in peak_indexes.items()}
+    stats['postgres_pools'] = PostgresConnection.pool_stats()
+    stats['version'] = version
 
     return jsonify(stats)
+
+
+@application.route('/health')
+def health():
+    """ Returns whether the server is running, without checking the databases. For load balancers. """
+
+    return "OK"
@@ -4,25 +4,36 @@
 
 import logging
 import optparse
-import os
 import re
 import sys
 import time
-from multiprocessing import Pipe, cpu_count
-from os import _exit as child_exit
+from multiprocessing import Pool, cpu_count
 
-from bmrbapi.reloaders.database import one_entry
+import simplejson as json
+from redis.exceptions import ResponseError
+
+from bmrbapi.reloaders.chemcomps import load_chemcomps
+from bmrbapi.reloaders.database import WriteLimiter, compression_samples, init_reload_worker, reload_worker_chunk, \
+    start_generation, collect_old_generations, get_release_times
 from bmrbapi.reloaders.inext import inext
 from bmrbapi.reloaders.molprobity import molprobity_full, molprobity_visualizations
+from bmrbapi.reloaders.shift_statistics import shift_statistics
 from bmrbapi.reloaders.sql_initialize import sql_initialize
 from bmrbapi.reloaders.timedomain import timedomain
 from bmrbapi.reloaders.uniprot import uniprot
+from bmrbapi.reloaders.work_queue import queue_chunks, run_worker
 from bmrbapi.reloaders.xml_generate import xml
+from bmrbapi.utils import querymod
+from bmrbapi.utils.compression import train_zstd_dictionary, use_zstd_dictionary
 from bmrbapi.utils.configuration import configuration
 from bmrbapi.utils.connections import PostgresConnection, RedisConnection
+from bmrbapi.utils.dictionary_cache import bump_dictionary_generation
+from bmrbapi.utils.shift_index import ArrayStore, metabolomics_shift_index, peak_indexes
 
 loaded = {'metabolomics': [], 'macromolecules': [], 'chemcomps': []}
 to_process = {'metabolomics': [], 'macromolecules': [], 'chemcomps': []}
+# The generation each database is being loaded into, and the previously published generation
+generations = {}
 
 
 def add_to_loaded(loaded_entry):
@@ -47,34 +58,75 @@ def _natural_sort_key(s, _nsre=re.compile('([0-9]+)')):
             for text in re.split(_nsre, s)]
 
 
+def rebuild_index(index: ArrayStore) -> None:
+    """ Rebuilds one of the shift indexes. A failure (for example, if the SQL initialization which creates the
+    columns it is built from hasn't been run) is logged rather than raised, so that the rest of the reload still runs
+    and the API servers keep using the previous version. """
+
+    logger.info('Building the %s index...', index.name)
+    try:
+        index.rebuild()
+    except Exception as err:
+        logger.exception('Could not build the %s index: %s', index.name, err)
+        return
+    logger.info('Finished building the %s index...', index.name)
+
+
 # Put a few more things in REDIS
-def make_entry_list(name: str):
-    """ Calculate the list of entries to put in the DB."""
+def make_entry_list(name: str) -> bool:
+    """ Calculate the list of entries to put in the DB, and publish the generation the entries were loaded into.
+    Returns True if it was published.
+
+    The entries are stored as a list, as a JSON array ready to be served, and in two sorted sets: one scored by
+    position in the list, and one scored by the time each entry was originally released, to page through them.
+
+    Stale entries don't need to be deleted, as they simply aren't in the new generation."""
 
     # Sort the entries
     ent_list = sorted(loaded[name], key=_natural_sort_key)
 
     if len(ent_list) == 0:
         logging.critical('Could not load the entry set %s - no entries located!', name)
-        return
-
-    # Get the old entry list and delete ones that aren't there anymore
-    old_entries = r_conn.lrange("%s:entry_list" % name, 0, -1)
-    for each_entry in old_entries:
-        if each_entry not in ent_list:
-            to_delete = "%s:entry:%s" % (name, each_entry)
-            if r_conn.delete(to_delete):
-                logging.info("Deleted stale entry: %s" % to_delete)
-
-    # Set the update time, ready status, and entry list
-    r_conn.hmset("%s:meta" % name, {"update_time": time.time(), "num_entries": len(ent_list)})
-    loading = "%s:entry_list" % name + "_loading"
-    r_conn.delete(loading)
-    r_conn.rpush(loading, *ent_list)
-    r_conn.rename(loading, "%s:entry_list" % name)
-
-    dropped = [y[0] for y in to_process[name] if y[0] not in set(loaded[name])]
+        return False
+
+    # Build the new versions of the lists beside the current ones
+    keys = ["%s:%s" % (name, x) for x in ['entry_list', 'entry_list_json', 'entry_order', 'entry_releases']]
+    loading = [x + "_loading" for x in keys]
+    r_conn.delete(*loading)
+    for x in range(0, len(ent_list), 10000):
+        chunk = ent_list[x:x + 10000]
+        pipe = r_conn.pipeline(transaction=False)
+        pipe.rpush(loading[0], *chunk)
+        pipe.zadd(loading[2], {entry: x + pos for pos, entry in enumerate(chunk)})
+        pipe.execute()
+    r_conn.set(loading[1], json.dumps(ent_list))
+    if name == "combined":
+        r_conn.zunionstore(loading[3], ["%s:entry_releases" % x for x in ['metabolomics', 'macromolecules',
+                                                                          'chemcomps']])
+    else:
+        release_times = get_release_times(r_conn, ent_list, generations.get(name, (None, None))[0])
+        for x in range(0, len(ent_list), 10000):
+            chunk = {entry: release_times[entry] for entry in ent_list[x:x + 10000] if entry in release_times}
+            if chunk:
+                r_conn.zadd(loading[3], chunk)
+
+    # Atomically switch to the new generation, along with the update time, ready status, and entry lists
+    pipe = r_conn.pipeline()
+    for loading_key, key in zip(loading, keys):
+        if r_conn.exists(loading_key):
+            pipe.rename(loading_key, key)
+        else:
+            pipe.delete(key)
+    pipe.hmset("%s:meta" % name, {"update_time": time.time(), "num_entries": len(ent_list)})
+    if name in generations:
+        pipe.set("%s:current_generation" % name, generations[name][0])
+        pipe.delete("%s:pending_generation" % name)
+    pipe.execute()
+
+    loaded_set = set(loaded[name])
+    dropped = [y[0] for y in to_process[name] if y[0] not in loaded_set]
     logging.info("Entries not loaded in DB %s: %s" % (name, dropped))
+    return True
 
 
 # Specify some basic information about our command
@@ -96,6 +148,8 @@ opt.add_option("--xml", action="store_true", dest="xml", default=False, help="Up
 opt.add_option("--inext", action="store_true", dest="inext", default=False, help="Update the iNext tables.")
 opt.add_option("--sql", action="store_true", dest="sql", default=False,
                help="Run the SQL commands to prepare the correct indexes on the DB.")
+opt.add_option("--shift-statistics", action="store_true", dest="shift_statistics", default=False,
+               help="Update the chemical shift statistics table.")
 opt.add_option("--sql-host", action="store", dest='sql_host', default=configuration['postgres']['host'],
                help="Host to run the SQL updater on.")
 opt.add_option("--sql-database", action="store", dest='sql_database', default=configuration['postgres']['database'],
@@ -106,7 +160,8 @@ opt.add_option("--sql-port", action="store", dest='sql_port', default=configurat
                help="Port to connect to Postgres on.")
 opt.add_option("--all-entries", action="store_true", dest="all", default=False,
                help="Update all the databases, and run all reloaders. Equivalent to: --metabolomics --macromolecules "
-                    "--chemcomps --molprobity-visualization --molprobity-full --uniprot --sql --timedomain")
+                    "--chemcomps --molprobity-visualization --molprobity-full --uniprot --sql --timedomain "
+                    "--shift-statistics")
 opt.add_option("--redis-db", action="store", dest="redis_db", default=configuration['redis']['db'],
                help="The Redis DB to use. 0 is master.")
 opt.add_option("--redis-host", action="store", dest="redis_host", default=None,
@@ -116,6 +171,27 @@ opt.add_option("--redis-port", action="store", dest="redis_port", default=None,
 opt.add_option("--flush", action="store_true", dest="flush", default=False,
                help="Flush all keys in the DB prior to reloading. This will interrupt service until the DB is rebuilt! "
                     "(So only use it on the staging DB.)")
+opt.add_option("--full", action="store_true", dest="full", default=False,
+               help="Reload every entry, rather than only the entries whose files changed since they were last "
+                    "loaded. Use this after changing how entries are stored.")
+opt.add_option("--chunk-size", action="store", dest="chunk_size", type="int", default=50,
+               help="The number of entries each worker loads and writes to Redis at a time.")
+opt.add_option("--write-limit", action="store", dest="write_limit", type="float", default=None,
+               help="The maximum rate, in MB/s, at which to write entries to Redis. Use this to avoid saturating a "
+                    "Redis master which is serving requests.")
+opt.add_option("--distributed", action="store_true", dest="distributed", default=False,
+               help="Rather than loading the entries locally, put them on a work queue in Redis to be loaded by "
+                    "processes started with --worker, on this machine or others.")
+opt.add_option("--claim-timeout", action="store", dest="claim_timeout", type="float", default=600,
+               help="When using --distributed, put entries a worker claimed more than this many seconds ago back onto "
+                    "the work queue.")
+opt.add_option("--worker", action="store_true", dest="worker", default=False,
+               help="Load the entries queued by a reloader run with --distributed, until killed.")
+opt.add_option("--worker-once", action="store_true", dest="worker_once", default=False,
+               help="When using --worker, exit once the work queue is empty.")
+opt.add_option("--gc-delay", action="store", dest="gc_delay", type="float", default=30,
+               help="How many seconds to wait after publishing the reloaded entries before deleting the previous "
+                    "ones, to let in-flight requests which still use them finish.")
 opt.add_option("--verbose", action="store_true", dest="verbose", default=False, help="Be verbose")
 # Parse the command line input
 (options, cmd_input) = opt.parse_args()
@@ -138,10 +214,17 @@ if options.verbose:
 else:
     logger.setLevel(logging.WARNING)
 
+# Run as a worker for a distributed reload
+if options.worker:
+    logger.info('Waiting for entries to load...')
+    run_worker(write_limit=options.write_limit * 1024 * 1024 if options.write_limit else None,
+               once=options.worker_once)
+    sys.exit(0)
+
 # Make sure they specify a DB
 if not (options.metabolomics or options.macromolecules or options.chemcomps or options.molprobity_visualization
         or options.molprobity_full or options.uniprot or options.xml or options.inext or options.sql or
-        options.timedomain or options.all):
+        options.timedomain or options.shift_statistics or options.all):
     logging.exception("You must specify at least one of the reloaders.")
     sys.exit(1)
 
@@ -155,6 +238,7 @@ if options.all:
     options.uniprot = True
     options.sql = True
     options.timedomain = True
+    options.shift_statistics = True
     options.xml = True
     #options.inext = True
 
@@ -181,10 +265,26 @@ if options.inext:
 if options.sql:
     logger.info('Doing SQL initialization...')
     if sql_initialize(host=options.sql_host, database=options.sql_database, user=options.sql_user):
+        # Have the API servers reload the dictionary, which may have changed
+        bump_dictionary_generation()
         logger.info('Finished SQL initialization...')
+
+        # The shift indexes are built from the shift tables, which may have changed. (Those of the databases whose
+        #  entries are being reloaded are rebuilt after that.)
+        if not options.metabolomics:
+            rebuild_index(metabolomics_shift_index)
+        for database in ['macromolecules', 'metabolomics']:
+            if not getattr(options, database):
+                rebuild_index(peak_indexes[database])
     else:
         logger.exception('SQL reloading exited with exception.')
 
+# Uses the val_float column created by the SQL initialization
+if options.shift_statistics:
+    logger.info('Doing chemical shift statistics reload...')
+    shift_statistics()
+    logger.info('Finished chemical shift statistics reload...')
+
 # Load the metabolomics data
 if options.metabolomics:
     logger.info('Calculating metabolomics entries to process...')
@@ -240,87 +340,111 @@ if options.flush:
     with RedisConnection() as r:
         r.flushdb()
 
+# Each reload is loaded into a new generation of the database, which is only published once it is complete
+with RedisConnection() as r:
+    for database in ['metabolomics', 'macromolecules', 'chemcomps']:
+        if getattr(options, database):
+            generations[database] = start_generation(r, database, full=options.full)
+
+# Train the dictionary before starting the workers so they all use it
+dictionary_id = None
+if ((options.chemcomps or options.macromolecules or options.metabolomics) and
+        configuration.get('entry_compression', {}).get('codec', 'zlib') == 'zstd'):
+    logger.info('Training the zstd compression dictionary...')
+    samples = compression_samples(to_process['combined'],
+                                  configuration.get('entry_compression', {}).get('dictionary_samples', 250))
+    dictionary_id = train_zstd_dictionary(samples)
+    use_zstd_dictionary(dictionary_id)
+    logger.info('Finished training the zstd compression dictionary.')
+
 if options.chemcomps or options.macromolecules or options.metabolomics:
-    processes = []
-    num_threads = cpu_count()
+    num_workers = cpu_count()
+    # Split the write limit between the workers
+    write_limit = options.write_limit * 1024 * 1024 / num_workers if options.write_limit else None
+    # Chemcomps are built in bulk from the database, so only the entries loaded from files go to the workers
+    from_files = to_process['macromolecules'] + to_process['metabolomics']
+    chunks = [from_files[x:x + options.chunk_size] for x in range(0, len(from_files), options.chunk_size)]
 
     logger.info('Beginning to update entries in Redis...')
-    for thread in range(0, num_threads):
-
-        # Set up the pipes
-        parent_conn, child_conn = Pipe()
-        # Start the process
-        processes.append([parent_conn, child_conn])
-
-        # Use the fork to get through!
-        new_pid = os.fork()
-        # Okay, we are the child
-        if new_pid == 0:
-
-            # Each child gets a Redis
-            with RedisConnection() as red:
-
-                child_conn.send("ready")
-                while True:
-                    parent_message = child_conn.recv()
-                    if parent_message == "die":
-                        child_conn.close()
-                        parent_conn.close()
-                        child_exit(0)
-
-                    # Do work based on parent_message
-                    result = one_entry(parent_message[0], parent_message[1], red)
-
-                    # Tell our parent we are ready for the next job
-                    child_conn.send(result)
-
-        # We are the parent, don't need the child connection
-        else:
-            child_conn.close()
-
-    # Check if entries have completed by listening on the sockets
-    while len(to_process['combined']) > 0:
-
-        time.sleep(.001)
-        # Poll for processes ready to listen
-        for process in processes:
-            if process[0].poll():
-                data = process[0].recv()
-                if data:
-                    if data != "ready":
-                        add_to_loaded(data)
-                process[0].send(to_process['combined'].pop())
-                break
-
-    # Reap the children
-    for thread in range(0, num_threads):
-        # Get the last ready message from the child
-        data = processes[thread][0].recv()
-        # Tell the child to shut down
-        processes[thread][0].send("die")
-
-        res = os.wait()
-        if data:
-            add_to_loaded(data)
+    start_time = time.time()
+    processed = 0
+    timings = {}
+    pool = None
+
+    if options.chemcomps:
+        logger.info('Building the chemcomp entries...')
+        with RedisConnection() as r_conn:
+            chemcomps_loaded, timings = load_chemcomps(
+                [x[0][9:] for x in to_process['chemcomps']], r_conn, generation=generations['chemcomps'][0],
+                write_limiter=WriteLimiter(options.write_limit * 1024 * 1024 if options.write_limit else None),
+                batch_size=options.chunk_size)
+        for loaded_entry in chemcomps_loaded:
+            add_to_loaded(loaded_entry)
+        processed += len(to_process['chemcomps'])
+        logger.info('Processed %d chemcomps (%.1f entries/sec).', processed, processed / (time.time() - start_time))
+
+    if options.distributed:
+        results = queue_chunks(chunks, full=options.full, dictionary_id=dictionary_id,
+                               claim_timeout=options.claim_timeout, generations=generations)
+    else:
+        pool = Pool(num_workers, initializer=init_reload_worker, initargs=(options.full, write_limit, generations))
+        results = pool.imap_unordered(reload_worker_chunk, chunks)
+
+    for num_processed, chunk_loaded, chunk_timings in results:
+        for loaded_entry in chunk_loaded:
+            add_to_loaded(loaded_entry)
+        for stage, stage_time in chunk_timings.items():
+            timings[stage] = timings.get(stage, 0) + stage_time
+        processed += num_processed
+        logger.info('Processed %d of %d entries (%.1f entries/sec).', processed, len(to_process['combined']),
+                    processed / (time.time() - start_time))
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    elapsed = time.time() - start_time
+    logger.info('Processed %d entries in %.1f seconds (%.1f entries/sec). Time spent by all workers on each stage: %s',
+                processed, elapsed, processed / elapsed if elapsed else 0,
+                ", ".join("%s: %.1fs" % (stage, stage_time) for stage, stage_time in timings.items()))
 
     with RedisConnection() as r_conn:
         # Use a Redis list so other applications can read the list of entries
-        if options.metabolomics:
-            make_entry_list('metabolomics')
-        if options.macromolecules:
-            make_entry_list('macromolecules')
-        if options.chemcomps:
-            make_entry_list('chemcomps')
+        published = []
+        for database in ['metabolomics', 'macromolecules', 'chemcomps']:
+            if getattr(options, database) and make_entry_list(database):
+                published.append(database)
 
         # Make the full list from the existing lists regardless of update type
-        loaded['combined'] = (r_conn.lrange('metabolomics:entry_list', 0, -1) +
-                              r_conn.lrange('macromolecules:entry_list', 0, -1) +
-                              r_conn.lrange('chemcomps:entry_list', 0, -1))
+        loaded['combined'] = [x.decode() for x in (r_conn.lrange('metabolomics:entry_list', 0, -1) +
+                                                   r_conn.lrange('macromolecules:entry_list', 0, -1) +
+                                                   r_conn.lrange('chemcomps:entry_list', 0, -1))]
         make_entry_list('combined')
-        # Trigger a manual save to disk after reload
-        r_conn.save()
     logger.info('Finished updating list of entries present in Redis...')
 
+    # Have the API serve the new status of the databases
+    querymod.store_status_snapshot()
+
+    if options.metabolomics:
+        rebuild_index(metabolomics_shift_index)
+    for database in ['macromolecules', 'metabolomics']:
+        if getattr(options, database):
+            rebuild_index(peak_indexes[database])
+
+    # Delete the previous generations once nothing is using them anymore
+    with RedisConnection() as r_conn:
+        if published:
+            time.sleep(options.gc_delay)
+        for database in published:
+            collect_old_generations(r_conn, database)
+
+        # Trigger a save to disk after reload, without blocking the server
+        try:
+            r_conn.bgsave()
+        except ResponseError as err:
+            logger.warning('Could not start saving to disk: %s', err)
+    logger.info('Finished deleting the previous entries from Redis...')
+
 # The quicker molprobity code to generate the data for the molprobity visualizer
 if options.molprobity_visualization:
     logger.info('Doing MolProbity visualization reload...')
@@ -0,0 +1,179 @@
+""" Builds the chemcomp entries in bulk. Building a chemcomp with querymod.create_chemcomp_from_db() runs a handful of
+queries for each table of each of its two saveframes, which adds up over tens of thousands of chemcomps. Instead, each
+table is read once and its rows grouped by saveframe in memory, and the entries are then assembled from those. The
+entries are identical to the ones built by create_chemcomp_from_db(). """
+
+import logging
+import time
+from collections import defaultdict
+from typing import Dict, Generator, List, Optional, Tuple
+
+import pynmrstar
+from redis import StrictRedis
+
+from bmrbapi.exceptions import RequestException, ServerException
+from bmrbapi.reloaders.database import WriteLimiter, compress_entry, queue_entry, serialize_entry
+from bmrbapi.utils.connections import PostgresConnection
+from bmrbapi.utils.dictionary_cache import dictionary_cache
+from bmrbapi.utils.querymod import add_saveframe_tags, build_loop, get_loop_order, get_printable_tags, wrap_it_up
+
+
+class SaveframeTables:
+    """ The contents of the tables of one saveframe category, grouped by saveframe. """
+
+    def __init__(self, category: str, id_search_field: str):
+        self.category = category
+        self.id_search_field = id_search_field
+        self.table_name, self.loops = dictionary_cache.get_category_tables(category)
+
+        self.tag_names: List[str] = []
+        # The value of the search field -> the Sf_ID and Sf_framecode of the first saveframe with it
+        self.sf_ids: Dict[str, Tuple[int, str]] = {}
+        # Sf_ID -> the row of the saveframe table
+        self.rows: Dict[int, tuple] = {}
+        # The loop category -> Sf_ID -> the rows of the loop, in order
+        self.loop_rows: Dict[str, Dict[int, List[tuple]]] = {}
+
+    def load(self, cur) -> None:
+        """ Reads each of the tables of the category once. """
+
+        internalflag, printflag = dictionary_cache.get_category_flags(self.category)
+        if internalflag == "Y" or printflag == "N":
+            raise ServerException("The %s saveframe category is not printed." % self.category)
+
+        cur.execute('''SELECT * FROM %(table_name)s ORDER BY "Sf_ID"''', {'table_name': wrap_it_up(self.table_name)})
+        self.tag_names = [x.name for x in cur.description]
+        sf_id_pos = self.tag_names.index("Sf_ID")
+        framecode_pos = self.tag_names.index("Sf_framecode")
+        search_pos = self.tag_names.index(self.id_search_field)
+        for row in cur:
+            row = tuple(row)
+            self.sf_ids.setdefault(row[search_pos], (row[sf_id_pos], row[framecode_pos]))
+            self.rows.setdefault(row[sf_id_pos], row)
+
+        for each_loop in self.loops:
+            tags_to_use = get_printable_tags(each_loop)[0]
+            if len(tags_to_use) == 0:
+                continue
+
+            query = 'SELECT "Sf_ID",' + ",".join(['"' + x + '"' for x in tags_to_use])
+            query += ' FROM %(table_name)s'
+            order_tags = get_loop_order(each_loop, tags_to_use)
+            if order_tags:
+                query += ' ORDER BY "' + '","'.join(order_tags) + '"'
+            cur.execute(query, {'table_name': wrap_it_up(each_loop)})
+
+            # Grouping preserves the order of the rows within each saveframe
+            grouped = defaultdict(list)
+            for row in cur:
+                grouped[row[0]].append(tuple(row[1:]))
+            self.loop_rows[each_loop] = grouped
+
+    def build_saveframe(self, entry_id: str) -> pynmrstar.Saveframe:
+        """ Builds the saveframe whose search field has the given value, just like create_saveframe_from_db(). """
+
+        if entry_id not in self.sf_ids:
+            raise RequestException("No matching saveframe found.")
+        sf_id, sf_framecode = self.sf_ids[entry_id]
+
+        built_frame = pynmrstar.Saveframe.from_scratch(sf_framecode)
+        built_frame.tag_prefix = "_" + self.table_name
+        add_saveframe_tags(built_frame, self.table_name, self.tag_names, self.rows[sf_id])
+
+        for each_loop in self.loops:
+            if each_loop in self.loop_rows:
+                bmrb_loop = build_loop(each_loop, self.loop_rows[each_loop].get(sf_id, []))
+                if bmrb_loop is not None:
+                    built_frame.add_loop(bmrb_loop)
+
+        return built_frame
+
+
+def build_chemcomps(comp_ids: List[str]) -> Generator[Tuple[str, Optional[pynmrstar.Entry]], None, None]:
+    """ Yields the name of each chemcomp entry along with the entry, or None if it couldn't be built. """
+
+    with PostgresConnection() as cur:
+        cur.execute('''SET search_path=%(path)s, pg_catalog;''', {'path': 'chemcomps'})
+        chem_comp_tables = SaveframeTables("chem_comp", "ID")
+        chem_comp_tables.load(cur)
+        entity_tables = SaveframeTables("entity", "Nonpolymer_comp_ID")
+        entity_tables.load(cur)
+
+    for cc_id in comp_ids:
+        cc_id = cc_id.upper()
+        chemcomp = "chem_comp_" + cc_id
+        entry_name = "chemcomp_" + cc_id
+
+        try:
+            chemcomp_frame = chem_comp_tables.build_saveframe(cc_id)
+            # Set the frame name manually, because in the database it is wrong?
+            chemcomp_frame.name = chemcomp
+            entity_frame = entity_tables.build_saveframe(cc_id)
+        except Exception as e:
+            logging.exception("On %s: error: %s" % (entry_name, str(e)))
+            yield entry_name, None
+            continue
+
+        ent = pynmrstar.Entry.from_scratch(chemcomp)
+        # This is specifically omitted... long story
+        try:
+            del entity_frame['_Entity_atom_list']
+        except (KeyError, ValueError):
+            pass
+
+        ent.add_saveframe(entity_frame)
+        ent.add_saveframe(chemcomp_frame)
+
+        yield entry_name, ent
+
+
+def load_chemcomps(comp_ids: List[str], r_conn: StrictRedis, generation: Optional[str] = None,
+                   write_limiter: WriteLimiter = None, batch_size: int = 50) -> Tuple[List[str], Dict[str, float]]:
+    """ Builds the chemcomp entries in bulk and adds them to the given generation of the chemcomps database in Redis,
+    writing batch_size entries per pipeline.
+
+    Returns the names of the entries which were loaded, and the time spent on each stage of loading them. """
+
+    timings = {'build': 0.0, 'serialize': 0.0, 'compress': 0.0, 'write': 0.0, 'throttle': 0.0}
+    loaded = []
+
+    pipe = r_conn.pipeline(transaction=False)
+    queued_bytes = 0
+    chemcomps = build_chemcomps(comp_ids)
+    while True:
+        start = time.monotonic()
+        entry_name, ent = next(chemcomps, (None, None))
+        timings['build'] += time.monotonic() - start
+        if entry_name is None:
+            break
+        if ent is None:
+            continue
+
+        start = time.monotonic()
+        serialized = serialize_entry(ent)
+        timings['serialize'] += time.monotonic() - start
+
+        start = time.monotonic()
+        compressed = compress_entry(serialized)
+        timings['compress'] += time.monotonic() - start
+
+        queued_bytes += queue_entry(pipe, entry_name, compressed, generation=generation)
+        loaded.append(entry_name)
+
+        if len(loaded) % batch_size == 0:
+            if write_limiter is not None:
+                timings['throttle'] += write_limiter.wait(queued_bytes)
+            start = time.monotonic()
+            pipe.execute()
+            timings['write'] += time.monotonic() - start
+            queued_bytes = 0
+            logging.info("Loaded %d of %d chemcomps.", len(loaded), len(comp_ids))
+
+    if len(pipe):
+        if write_limiter is not None:
+            timings['throttle'] += write_limiter.wait(queued_bytes)
+        start = time.monotonic()
+        pipe.execute()
+        timings['write'] += time.monotonic() - start
+
+    return loaded, timings
@@ -1,13 +1,259 @@
+import calendar
 import logging
-import zlib
+import os
+import random
+import time
+from hashlib import md5
+from typing import Dict, List, Optional, Tuple
 
 import pynmrstar
+import simplejson as json
+from redis import StrictRedis
+from redis.client import Pipeline
 
 from bmrbapi.utils import querymod
+from bmrbapi.utils.compression import compress
+from bmrbapi.utils.configuration import configuration
+from bmrbapi.utils.connections import RedisConnection
 
+# All of the keys which are stored for each entry
+entry_key_types = ['entry', 'entry_star', 'entry_frames', 'entry_index', 'entry_meta']
 
-def one_entry(entry_name, entry_location, r_conn):
-    """ Load an entry and add it to REDIS """
+
+def get_fingerprints_key(entry_name: str, generation: Optional[str] = None) -> str:
+    """ Returns the key of the hash which holds the fingerprints of the files of the entries in the entry's database,
+    in the given generation of the database (or the published one). """
+
+    database = querymod.get_redis_database(entry_name)
+    if generation is None:
+        generation = querymod.get_current_generation(database)
+    if generation is None:
+        return "%s:fingerprints" % database
+    return "%s:%s:fingerprints" % (database, generation)
+
+
+def start_generation(r_conn: StrictRedis, database: str, full: bool = False) -> Tuple[str, Optional[str]]:
+    """ Returns the generation of the database to load the entries into, and the generation which is currently
+    published (or None). The generation of a previous reload which didn't finish is reused, so that the reload resumes
+    where it stopped, unless full is True. """
+
+    current, pending = r_conn.mget("%s:current_generation" % database, "%s:pending_generation" % database)
+    if pending is None or full:
+        pending = r_conn.incr("%s:last_generation" % database)
+        pipe = r_conn.pipeline()
+        pipe.set("%s:pending_generation" % database, pending)
+        pipe.sadd("%s:generations" % database, pending)
+        pipe.execute()
+        logging.info("Loading %s into generation %s.", database, pending)
+    else:
+        pending = pending.decode()
+        logging.info("Resuming loading %s into generation %s.", database, pending)
+
+    return str(pending), current.decode() if current is not None else None
+
+
+def collect_old_generations(r_conn: StrictRedis, database: str, batch_size: int = 1000) -> int:
+    """ Deletes the keys of the generations of the database which are neither published nor being loaded, along with
+    any keys stored before generations were used. The keys of the database are scanned once, and which ones to delete
+    is decided from their second segment: an old generation, or the key type of a key stored before generations. Keys
+    are deleted with pipelined UNLINKs, so Redis frees their memory in the background. Returns the number of keys
+    deleted. """
+
+    current, pending = r_conn.mget("%s:current_generation" % database, "%s:pending_generation" % database)
+    if current is None:
+        return 0
+    old_generations = r_conn.smembers("%s:generations" % database) - {current, pending}
+    # The second segments of the keys to delete
+    collected = {generation.decode() for generation in old_generations}
+    collected.update(entry_key_types)
+    legacy_fingerprints = ("%s:fingerprints" % database).encode()
+
+    deleted = 0
+    batch = []
+    pipe = r_conn.pipeline(transaction=False)
+    for key in r_conn.scan_iter(match="%s:*" % database, count=batch_size):
+        segments = key.decode().split(":", 2)
+        if (len(segments) == 3 and segments[1] in collected) or key == legacy_fingerprints:
+            batch.append(key)
+            if len(batch) == batch_size:
+                pipe.unlink(*batch)
+                deleted += len(batch)
+                batch = []
+                if len(pipe) >= 10:
+                    pipe.execute()
+    if batch:
+        pipe.unlink(*batch)
+        deleted += len(batch)
+    if old_generations:
+        pipe.srem("%s:generations" % database, *old_generations)
+    pipe.execute()
+
+    logging.info("Deleted %d keys of old generations of %s.", deleted, database)
+    return deleted
+
+
+def get_file_fingerprint(entry_location: str, previous: Optional[dict] = None) -> dict:
+    """ Returns the fingerprint of an entry file: its modification time, size, and a hash of its contents.
+
+    If a previous fingerprint is provided and the modification time and size haven't changed, the file is
+    assumed to be unchanged and the previous fingerprint is returned without reading the file. """
+
+    stat = os.stat(entry_location)
+    if previous is not None and previous['mtime'] == stat.st_mtime and previous['size'] == stat.st_size:
+        return previous
+
+    content_hash = md5()
+    with open(entry_location, 'rb') as entry_file:
+        for chunk in iter(lambda: entry_file.read(1024 * 1024), b''):
+            content_hash.update(chunk)
+    return {'mtime': stat.st_mtime, 'size': stat.st_size, 'hash': content_hash.hexdigest()}
+
+
+class WriteLimiter:
+    """ A token bucket which limits the rate at which data is written to Redis, so that a reload doesn't saturate a
+    master which is also serving requests. """
+
+    def __init__(self, bytes_per_second: Optional[float]):
+        self.bytes_per_second = bytes_per_second
+        self._allowance = bytes_per_second or 0
+        self._last = time.monotonic()
+
+    def wait(self, num_bytes: int) -> float:
+        """ Blocks until num_bytes may be written, and returns how long it waited. """
+
+        if not self.bytes_per_second:
+            return 0
+
+        now = time.monotonic()
+        self._allowance = min(self.bytes_per_second, self._allowance + (now - self._last) * self.bytes_per_second)
+        self._last = now
+        self._allowance -= num_bytes
+        if self._allowance >= 0:
+            return 0
+
+        # Go into debt, and wait until it is paid off
+        delay = -self._allowance / self.bytes_per_second
+        time.sleep(delay)
+        return delay
+
+
+def get_release_date(ent: pynmrstar.Entry) -> Optional[str]:
+    """ Returns the date the entry was originally released, or None if it doesn't have one. """
+
+    for release_loop in ent.get_loops_by_category("Release")[:1]:
+        try:
+            for release_number, date in release_loop.get_tag(["Release_number", "Date"]):
+                if release_number == "1" and date not in [None, ".", "?"]:
+                    return date
+        except ValueError:
+            return None
+    return None
+
+
+def get_release_times(r_conn: StrictRedis, entry_names: List[str], generation: Optional[str] = None) -> \
+        Dict[str, float]:
+    """ Returns the time each of the entries was originally released, as a unix timestamp, from the metadata stored
+    with the entries in the given generation of their database (or the published one). Entries without a valid
+    release date are omitted. """
+
+    pipe = r_conn.pipeline(transaction=False)
+    for entry_name in entry_names:
+        pipe.hget(querymod.locate_entry(entry_name, key_type="entry_meta", generation=generation), "release_date")
+
+    release_times = {}
+    for entry_name, release_date in zip(entry_names, pipe.execute()):
+        if not release_date:
+            continue
+        try:
+            release_times[entry_name] = calendar.timegm(time.strptime(release_date.decode(), "%Y-%m-%d"))
+        except ValueError:
+            logging.warning("On %s: invalid release date: %s", entry_name, release_date.decode())
+    return release_times
+
+
+def serialize_entry(ent: pynmrstar.Entry) -> dict:
+    """ Returns the uncompressed representations of the entry which are stored in Redis, and the metadata stored
+    along with them: its ETag, the date it was originally released (empty if it has none), a summary of its extra data, and the
+    information needed to cite it.
+
+    If "sharded_entries" is enabled in the configuration, this includes each saveframe separately, along with an
+    index of which saveframes have which categories and contain which loops. """
+
+    entry_json = ent.get_json().encode()
+    serialized = {'entry': entry_json,
+                  'entry_star': str(ent).encode(),
+                  'entry_frames': None,
+                  'entry_index': None,
+                  'meta': {'etag': md5(entry_json).hexdigest(),
+                           # Stored even when empty, to tell entries without one from those loaded before it was
+                           #  stored, which need reloading
+                           'release_date': get_release_date(ent) or '',
+                           'extra_data': json.dumps(querymod.get_extra_data_summary(ent)),
+                           # Stored as null for entries which can't be cited, to tell them from those loaded before
+                           #  it was stored
+                           'citation': 'null'}}
+
+    # Entries without a release loop or title, such as chemcomps, can't be cited
+    try:
+        serialized['meta']['citation'] = json.dumps(querymod.get_citation_record(ent))
+    except (IndexError, KeyError, ValueError):
+        pass
+
+    if configuration.get('sharded_entries', False) and ent.frame_list:
+        index = {'frames': [], 'categories': {}, 'loops': {}}
+        saveframes = {}
+        for saveframe in ent.frame_list:
+            index['frames'].append(saveframe.name)
+            # Match how Entry.get_saveframes_by_category() looks up the category
+            for category in saveframe.get_tag("Sf_category")[:1]:
+                index['categories'].setdefault(category, []).append(saveframe.name)
+            for loop in saveframe.loops:
+                index['loops'].setdefault(loop.category.lower(), []).append(saveframe.name)
+            saveframes[saveframe.name] = saveframe.get_json().encode()
+        serialized['entry_frames'] = saveframes
+        serialized['entry_index'] = json.dumps(index).encode()
+
+    return serialized
+
+
+def compress_entry(serialized: dict) -> dict:
+    """ Compresses the representations returned by serialize_entry(). """
+
+    compressed = dict(serialized)
+    for key_type in ['entry', 'entry_star', 'entry_index']:
+        if serialized[key_type] is not None:
+            compressed[key_type] = compress(serialized[key_type])
+    if serialized['entry_frames'] is not None:
+        compressed['entry_frames'] = {name: compress(frame) for name, frame in serialized['entry_frames'].items()}
+    return compressed
+
+
+def queue_entry(pipe: Pipeline, entry_name: str, compressed: dict, generation: Optional[str] = None) -> int:
+    """ Adds the commands to store an entry compressed by compress_entry() to the pipeline, and returns the number
+    of bytes which will be written. The entry is stored in the given generation of its database, or the published
+    one. """
+
+    pipe.set(querymod.locate_entry(entry_name, generation=generation), compressed['entry'])
+    meta_key = querymod.locate_entry(entry_name, key_type="entry_meta", generation=generation)
+    pipe.delete(meta_key)
+    pipe.hset(meta_key, mapping={field: value for field, value in compressed['meta'].items() if value is not None})
+    pipe.set(querymod.locate_entry(entry_name, key_type="entry_star", generation=generation),
+             compressed['entry_star'])
+    size = len(compressed['entry']) + len(compressed['entry_star'])
+
+    frames_key = querymod.locate_entry(entry_name, key_type="entry_frames", generation=generation)
+    index_key = querymod.locate_entry(entry_name, key_type="entry_index", generation=generation)
+    pipe.delete(frames_key, index_key)
+    if compressed['entry_frames']:
+        pipe.hset(frames_key, mapping=compressed['entry_frames'])
+        pipe.set(index_key, compressed['entry_index'])
+        size += sum(len(frame) for frame in compressed['entry_frames'].values()) + len(compressed['entry_index'])
+
+    return size
+
+
+def load_entry(entry_name: str, entry_location: Optional[str]) -> Optional[pynmrstar.Entry]:
+    """ Load an entry from its file, or from the database for chemcomps. Returns None if it couldn't be loaded. """
 
     if "chemcomp" in entry_name:
         try:
@@ -15,12 +261,6 @@ def one_entry(entry_name, entry_location, r_conn):
         except Exception as e:
             ent = None
             logging.exception("On %s: error: %s" % (entry_name, str(e)))
-
-        if ent is not None:
-            key = querymod.locate_entry(entry_name, r_conn)
-            r_conn.set(key, zlib.compress(ent.get_json().encode()))
-            logging.info("On %s: loaded" % entry_name)
-            return entry_name
     else:
         try:
             ent = pynmrstar.Entry.from_file(entry_location)
@@ -33,7 +273,149 @@ def one_entry(entry_name, entry_location, r_conn):
             ent = None
             logging.error("On %s: error: %s" % (entry_name, str(e)))
 
+    return ent
+
+
+def load_entries(entries: List[Tuple[str, Optional[str]]], r_conn: StrictRedis, full: bool = False,
+                 write_limiter: WriteLimiter = None, generations: Dict[str, Tuple[str, Optional[str]]] = None) -> \
+        Tuple[List[str], Dict[str, float]]:
+    """ Loads a batch of entries and adds them to REDIS, writing them all using one pipeline. Entries
+    whose file hasn't changed since it was last loaded are skipped, unless full is True. (Chemcomps are built from the
+    database rather than a file, so they are always loaded.)
+
+    generations maps each database to the generation to load its entries into, and the published generation (see
+    start_generation()). Unchanged entries which are only in the published generation are copied over. Without it,
+    entries are loaded into the published generation.
+
+    The entries are written without a transaction, so as not to block Redis while a whole batch is written. The
+    fingerprints of their files are only written once all of the entries have been, so that an entry is only
+    considered loaded once it has been completely written.
+
+    Returns the names of the entries which are loaded (including the unchanged ones), and the time spent on each
+    stage of loading them. """
+
+    timings = {'parse': 0.0, 'serialize': 0.0, 'compress': 0.0, 'write': 0.0, 'throttle': 0.0}
+    loaded = []
+    generations = generations or {}
+
+    # Get the fingerprints of the previously loaded files all at once. Check the generation being loaded first, in
+    #  case this resumes a reload which didn't finish, and then the published generation. Entries stored before their
+    #  release date and citation were stored in their metadata are loaded again, as if they had changed.
+    previous = {}
+    files = [entry_name for entry_name, entry_location in entries if entry_location is not None]
+    if files and not full:
+        pipe = r_conn.pipeline(transaction=False)
+        checked = []
+        for entry_name in files:
+            target, source = generations.get(querymod.get_redis_database(entry_name), (None, None))
+            for generation in [target] if source is None or source == target else [target, source]:
+                pipe.hget(get_fingerprints_key(entry_name, generation), entry_name)
+                pipe.exists(querymod.locate_entry(entry_name, generation=generation))
+                pipe.hmget(querymod.locate_entry(entry_name, key_type="entry_meta", generation=generation),
+                           ["release_date", "citation"])
+                checked.append((entry_name, generation))
+        results = pipe.execute()
+        for (entry_name, generation), fingerprint, exists, meta in zip(checked, results[::3], results[1::3],
+                                                                       results[2::3]):
+            if fingerprint and exists and None not in meta and entry_name not in previous:
+                previous[entry_name] = (json.loads(fingerprint), generation)
+
+    pipe = r_conn.pipeline(transaction=False)
+    fingerprints_pipe = r_conn.pipeline(transaction=False)
+    queued_bytes = 0
+    for entry_name, entry_location in entries:
+        target = generations.get(querymod.get_redis_database(entry_name), (None, None))[0]
+        fingerprint = None
+        if entry_location is not None:
+            previous_fingerprint, previous_generation = previous.get(entry_name, (None, None))
+            try:
+                fingerprint = get_file_fingerprint(entry_location, previous_fingerprint)
+            except IOError:
+                logging.info("On %s: no file." % entry_name)
+                continue
+
+            if previous_fingerprint is not None and fingerprint['hash'] == previous_fingerprint['hash']:
+                if previous_generation != target:
+                    for key_type in entry_key_types:
+                        pipe.execute_command('COPY',
+                                             querymod.locate_entry(entry_name, key_type=key_type,
+                                                                   generation=previous_generation),
+                                             querymod.locate_entry(entry_name, key_type=key_type, generation=target),
+                                             'REPLACE')
+                # Also remember the new modification time, if only it changed, to avoid hashing the file next time
+                if previous_generation != target or fingerprint != previous_fingerprint:
+                    fingerprints_pipe.hset(get_fingerprints_key(entry_name, target), entry_name,
+                                           json.dumps(fingerprint))
+                logging.info("On %s: unchanged." % entry_name)
+                loaded.append(entry_name)
+                continue
+
+        start = time.monotonic()
+        ent = load_entry(entry_name, entry_location)
+        timings['parse'] += time.monotonic() - start
+        if ent is None:
+            continue
+
+        start = time.monotonic()
+        serialized = serialize_entry(ent)
+        timings['serialize'] += time.monotonic() - start
+
+        start = time.monotonic()
+        compressed = compress_entry(serialized)
+        timings['compress'] += time.monotonic() - start
+
+        queued_bytes += queue_entry(pipe, entry_name, compressed, generation=target)
+        if fingerprint is not None:
+            fingerprints_pipe.hset(get_fingerprints_key(entry_name, target), entry_name, json.dumps(fingerprint))
+        loaded.append(entry_name)
+        if "chemcomp" in entry_name:
+            logging.info("On %s: loaded" % entry_name)
+
+    if len(pipe):
+        if write_limiter is not None:
+            timings['throttle'] += write_limiter.wait(queued_bytes)
+        start = time.monotonic()
+        pipe.execute()
+        timings['write'] += time.monotonic() - start
+    if len(fingerprints_pipe):
+        fingerprints_pipe.execute()
+
+    return loaded, timings
+
+
+# The settings of a reload worker process, set by init_reload_worker()
+_worker_settings = {}
+
+
+def init_reload_worker(full: bool, bytes_per_second: Optional[float],
+                       generations: Dict[str, Tuple[str, Optional[str]]]) -> None:
+    """ Initializes a process of the pool used to load entries. bytes_per_second limits the rate at which this
+    process writes to Redis. See load_entries() for the other arguments. """
+
+    _worker_settings['full'] = full
+    _worker_settings['write_limiter'] = WriteLimiter(bytes_per_second)
+    _worker_settings['generations'] = generations
+
+
+def reload_worker_chunk(entries: List[Tuple[str, Optional[str]]]) -> Tuple[int, List[str], Dict[str, float]]:
+    """ Loads a chunk of entries in a process of the pool. Returns the number of entries processed along with the
+    results of load_entries(). """
+
+    with RedisConnection() as r_conn:
+        loaded, timings = load_entries(entries, r_conn, full=_worker_settings['full'],
+                                       write_limiter=_worker_settings['write_limiter'],
+                                       generations=_worker_settings['generations'])
+    return len(entries), loaded, timings
+
+
+def compression_samples(to_process: List[Tuple[str, Optional[str]]], sample_size: int) -> List[bytes]:
+    """ Returns the data to train the compression dictionary on, from a random sample of the entries to load. """
+
+    samples = []
+    for entry_name, entry_location in random.sample(to_process, min(sample_size, len(to_process))):
+        ent = load_entry(entry_name, entry_location)
         if ent is not None:
-            key = querymod.locate_entry(entry_name, r_conn)
-            r_conn.set(key, zlib.compress(ent.get_json().encode()))
-            return entry_name
+            samples.append(ent.get_json().encode())
+            samples.append(str(ent).encode())
+            samples.extend([saveframe.get_json().encode() for saveframe in ent.frame_list])
+    return samples
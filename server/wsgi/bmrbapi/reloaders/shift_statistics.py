@@ -0,0 +1,121 @@
+""" Builds the table of precomputed statistics of the chemical shifts of each atom of each residue, which the
+/search/chemical_shift_statistics endpoint serves.
+
+The statistics cover both the macromolecules and metabolomics databases, and are calculated over all of the shifts of an
+atom, and separately over the shifts measured within each pH band and each temperature band. Each row also holds a
+histogram of the shifts, stored as only its non-empty bins. """
+
+from bmrbapi.utils.connections import PostgresConnection
+
+# The width of the bins of the histograms of each atom type, in ppm
+histogram_bin_widths = {'H': 0.05, 'C': 0.5, 'N': 0.5}
+default_histogram_bin_width = 1
+# The width of the pH and temperature (in K) bands the shifts are also grouped by
+ph_band_width = 1
+temperature_band_width = 10
+# The percentiles calculated for each group. The first and last only bound the histograms, so that a few badly
+#  referenced shifts don't stretch them across thousands of empty bins.
+percentiles = [0.001, 0.05, 0.25, 0.5, 0.75, 0.95, 0.999]
+
+
+def shift_statistics() -> None:
+    """ Creates the table of the statistics of the chemical shifts of each atom of each residue (Comp_ID and Atom_ID),
+    for all of the shifts, and for the shifts in each pH and temperature band. """
+
+    psql = PostgresConnection(write_access=True)
+    with psql as cur:
+        cur.execute('''
+CREATE TEMPORARY TABLE shift_statistics_shifts (
+ database text,
+ comp_id text,
+ atom_id text,
+ atom_type text,
+ val double precision,
+ ph_band numeric,
+ temperature_band numeric) ON COMMIT DROP;''')
+
+        for database in ['macromolecules', 'metabolomics']:
+            # The schema name can't be a query parameter, but it is one of the two above
+            cur.execute('''
+INSERT INTO shift_statistics_shifts
+SELECT %(database)s, cs."Comp_ID", cs."Atom_ID", cs."Atom_type", cs.val_float,
+       floor(web.convert_to_numeric(ph."Val") / %(ph_width)s) * %(ph_width)s,
+       floor(web.convert_to_numeric(temp."Val") / %(temperature_width)s) * %(temperature_width)s
+FROM {schema}."Atom_chem_shift" AS cs
+         LEFT JOIN {schema}."Assigned_chem_shift_list" AS csf
+                   ON csf."ID" = cs."Assigned_chem_shift_list_ID" AND csf."Entry_ID" = cs."Entry_ID"
+         LEFT JOIN {schema}."Sample_condition_variable" AS ph
+                   ON csf."Sample_condition_list_ID" = ph."Sample_condition_list_ID" AND
+                      ph."Entry_ID" = cs."Entry_ID" AND ph."Type" = 'pH'
+         LEFT JOIN {schema}."Sample_condition_variable" AS temp
+                   ON csf."Sample_condition_list_ID" = temp."Sample_condition_list_ID" AND
+                      temp."Entry_ID" = cs."Entry_ID" AND
+                      temp."Type" = 'temperature' AND temp."Val_units" = 'K'
+WHERE cs.val_float IS NOT NULL AND cs."Comp_ID" IS NOT NULL AND cs."Atom_ID" IS NOT NULL;'''.format(schema=database),
+                        {'database': database, 'ph_width': ph_band_width, 'temperature_width': temperature_band_width})
+
+        # The statistics of each atom, over all of the shifts and within each band
+        cur.execute('''
+CREATE TEMPORARY TABLE shift_statistics_groups ON COMMIT DROP AS
+SELECT database, comp_id, atom_id, atom_type,
+       CASE WHEN GROUPING(ph_band) = 0 THEN 'ph' WHEN GROUPING(temperature_band) = 0 THEN 'temperature'
+            ELSE 'all' END AS condition,
+       COALESCE(ph_band, temperature_band) AS band,
+       CASE atom_type {bin_widths} ELSE {default_bin_width} END AS bin_width,
+       count(*) AS count, avg(val) AS mean, stddev_samp(val) AS std, min(val) AS min, max(val) AS max,
+       percentile_cont(%(percentiles)s::double precision[]) WITHIN GROUP (ORDER BY val) AS percentiles
+FROM shift_statistics_shifts
+GROUP BY GROUPING SETS ((database, comp_id, atom_id, atom_type),
+                        (database, comp_id, atom_id, atom_type, ph_band),
+                        (database, comp_id, atom_id, atom_type, temperature_band));
+
+-- The shifts without a known pH or temperature
+DELETE FROM shift_statistics_groups WHERE condition != 'all' AND band IS NULL;'''.format(
+            bin_widths=' '.join("WHEN '%s' THEN %s" % x for x in histogram_bin_widths.items()),
+            default_bin_width=default_histogram_bin_width), {'percentiles': percentiles})
+
+        cur.execute('''
+CREATE TEMPORARY TABLE shift_statistics_bins ON COMMIT DROP AS
+SELECT groups.database, groups.comp_id, groups.atom_id, groups.atom_type, groups.condition, groups.band,
+       floor(shifts.val / groups.bin_width)::integer AS bin, count(*) AS count
+FROM shift_statistics_groups AS groups
+JOIN shift_statistics_shifts AS shifts
+  ON shifts.database = groups.database AND shifts.comp_id = groups.comp_id AND shifts.atom_id = groups.atom_id
+    AND shifts.atom_type IS NOT DISTINCT FROM groups.atom_type
+    AND (groups.condition = 'all' OR (groups.condition = 'ph' AND shifts.ph_band = groups.band)
+         OR (groups.condition = 'temperature' AND shifts.temperature_band = groups.band))
+WHERE shifts.val BETWEEN groups.percentiles[1] AND groups.percentiles[array_length(groups.percentiles, 1)]
+GROUP BY 1, 2, 3, 4, 5, 6, 7;''')
+
+        cur.execute('''
+DROP TABLE IF EXISTS web.shift_statistics_tmp;
+CREATE TABLE web.shift_statistics_tmp AS
+SELECT groups.database, groups.comp_id, groups.atom_id, groups.atom_type, groups.condition,
+       groups.band AS band_low,
+       groups.band + CASE groups.condition WHEN 'ph' THEN %(ph_width)s ELSE %(temperature_width)s END AS band_high,
+       groups.count, groups.mean, groups.std, groups.min, groups.max,
+       groups.percentiles[2:array_length(groups.percentiles, 1) - 1] AS percentiles,
+       groups.bin_width,
+       histograms.bins AS histogram_bins, histograms.counts AS histogram_counts
+FROM shift_statistics_groups AS groups
+LEFT JOIN (SELECT database, comp_id, atom_id, atom_type, condition, band,
+                  array_agg(bin ORDER BY bin) AS bins, array_agg(count ORDER BY bin) AS counts
+           FROM shift_statistics_bins
+           GROUP BY 1, 2, 3, 4, 5, 6) AS histograms
+  ON histograms.database = groups.database AND histograms.comp_id = groups.comp_id
+    AND histograms.atom_id = groups.atom_id AND histograms.atom_type IS NOT DISTINCT FROM groups.atom_type
+    AND histograms.condition = groups.condition
+    AND histograms.band IS NOT DISTINCT FROM groups.band;
+CREATE INDEX ON web.shift_statistics_tmp (database, comp_id, atom_id);
+
+ALTER TABLE IF EXISTS web.shift_statistics RENAME TO shift_statistics_old;
+ALTER TABLE web.shift_statistics_tmp RENAME TO shift_statistics;
+DROP TABLE IF EXISTS web.shift_statistics_old;
+ANALYZE web.shift_statistics;
+GRANT USAGE ON schema web TO PUBLIC;
+GRANT SELECT ON ALL TABLES IN schema web TO PUBLIC;
+ALTER DEFAULT PRIVILEGES IN schema web GRANT SELECT ON TABLES TO PUBLIC;
+GRANT ALL PRIVILEGES ON TABLE web.shift_statistics to web;
+GRANT ALL PRIVILEGES ON TABLE web.shift_statistics to bmrb;
+''', {'ph_width': ph_band_width, 'temperature_width': temperature_band_width})
+        psql.commit()
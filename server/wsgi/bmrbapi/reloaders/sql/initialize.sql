@@ -15,6 +15,17 @@ EXCEPTION WHEN OTHERS THEN
 END
 $func$  LANGUAGE plpgsql IMMUTABLE;
 
+-- Used for the typed chemical shift values
+CREATE OR REPLACE FUNCTION web.convert_to_float(text)
+  RETURNS double precision AS
+$func$
+BEGIN
+    RETURN $1::double precision;
+EXCEPTION WHEN OTHERS THEN
+   RETURN NULL;  -- NULL for other invalid input
+END
+$func$  LANGUAGE plpgsql IMMUTABLE;
+
 -- Put some indexes on the chemical shifts
 DO $$
 BEGIN
@@ -39,6 +50,23 @@ BEGIN
     END;
 END $$;
 
+-- Store the shift values as floats, so that the shift searches can use range scans on the composite indexes rather
+-- than casting "Val" for every row
+DO $$
+DECLARE
+    shift_schema text;
+BEGIN
+    FOREACH shift_schema IN ARRAY ARRAY['macromolecules', 'metabolomics'] LOOP
+        EXECUTE format('ALTER TABLE %I."Atom_chem_shift" ADD COLUMN IF NOT EXISTS val_float double precision
+                          GENERATED ALWAYS AS (web.convert_to_float("Val")) STORED', shift_schema);
+        EXECUTE format('CREATE INDEX IF NOT EXISTS atom_chem_shift_type_val
+                          ON %I."Atom_chem_shift" ("Atom_type", val_float)', shift_schema);
+        EXECUTE format('CREATE INDEX IF NOT EXISTS atom_chem_shift_comp_atom_val
+                          ON %I."Atom_chem_shift" ("Comp_ID", "Atom_ID", val_float)', shift_schema);
+        EXECUTE format('ANALYZE %I."Atom_chem_shift"', shift_schema);
+    END LOOP;
+END $$;
+
 -- Now start with the instant search...
 
 -- Helper function. We will delete this later.
@@ -327,6 +355,8 @@ GRANT ALL PRIVILEGES ON TABLE web.pdb_link to web;
 GRANT ALL PRIVILEGES ON TABLE web.pdb_link to bmrb;
 GRANT ALL PRIVILEGES ON FUNCTION web.convert_to_numeric to web;
 GRANT ALL PRIVILEGES ON FUNCTION web.convert_to_numeric to bmrb;
+GRANT ALL PRIVILEGES ON FUNCTION web.convert_to_float to web;
+GRANT ALL PRIVILEGES ON FUNCTION web.convert_to_float to bmrb;
 
 GRANT USAGE ON schema web TO PUBLIC;
 GRANT SELECT ON ALL TABLES IN schema web TO PUBLIC;
@@ -1,13 +1,14 @@
 import os
 
+import simplejson as json
 from psycopg2.extras import execute_values
 
 from bmrbapi.utils.configuration import configuration
-from bmrbapi.utils.connections import PostgresConnection
+from bmrbapi.utils.connections import PostgresConnection, RedisConnection
 
 
 def timedomain() -> None:
-    """Creates the time domain links table."""
+    """Creates the time domain links table, and the matching hash in Redis."""
 
     def get_dir_size(start_path='.'):
         total_size = 0
@@ -36,6 +37,8 @@ def timedomain() -> None:
             entry_id = int("".join([_ for _ in x if _.isdigit()]))
             yield entry_id, get_dir_size(os.path.join(td_dir, x)), get_data_sets(os.path.join(td_dir, x))
 
+    td_data = list(td_data_getter())
+
     psql = PostgresConnection(write_access=True)
     with psql as cur:
         cur.execute('''
@@ -44,7 +47,7 @@ CREATE TABLE IF NOT EXISTS web.timedomain_data_tmp (
  size numeric,
  sets numeric);''')
 
-        execute_values(cur, '''INSERT INTO web.timedomain_data_tmp(bmrbid, size, sets) VALUES %s;''', td_data_getter())
+        execute_values(cur, '''INSERT INTO web.timedomain_data_tmp(bmrbid, size, sets) VALUES %s;''', td_data)
 
         cur.execute('''
 ALTER TABLE IF EXISTS web.timedomain_data RENAME TO timedomain_data_old;
@@ -57,3 +60,15 @@ GRANT ALL PRIVILEGES ON TABLE web.timedomain_data to web;
 GRANT ALL PRIVILEGES ON TABLE web.timedomain_data to bmrb;
 ''')
         psql.commit()
+
+    # Also store it in Redis, so the extra data available for entries can be determined without querying Postgres
+    with RedisConnection() as r_conn:
+        pipe = r_conn.pipeline()
+        pipe.delete("timedomain_data_loading")
+        if td_data:
+            pipe.hset("timedomain_data_loading", mapping={entry_id: json.dumps({'size': size, 'sets': sets})
+                                                          for entry_id, size, sets in td_data})
+            pipe.rename("timedomain_data_loading", "timedomain_data")
+        else:
+            pipe.delete("timedomain_data")
+        pipe.execute()
@@ -0,0 +1,142 @@
+""" Distributes the loading of entries over any number of worker processes, on any number of machines, using lists in
+Redis as a work queue.
+
+The coordinator pushes chunks of entries onto the queue. Workers atomically move a chunk from the queue to the
+processing list, record when they claimed it, load it, and then acknowledge it by removing it from the processing list
+and pushing their results. Chunks which have been claimed for too long (because their worker died) are put back onto
+the queue by the coordinator. Loading an entry is idempotent, so a chunk being loaded twice is harmless. A chunk which
+fails to load is acknowledged with the error, which stops the reload. """
+
+import logging
+import time
+from typing import Dict, Generator, List, Optional, Tuple
+
+import simplejson as json
+
+from bmrbapi.reloaders.database import WriteLimiter, load_entries
+from bmrbapi.utils.compression import use_zlib, use_zstd_dictionary
+from bmrbapi.utils.connections import RedisConnection
+
+queue_key = "reload:queue"
+processing_key = "reload:processing"
+claims_key = "reload:claims"
+results_key = "reload:results"
+
+# Only puts a chunk back onto the queue if it is still being processed, as its worker may acknowledge it at any point
+requeue_script = """
+if redis.call('LREM', KEYS[1], 1, ARGV[1]) == 0 then
+    return 0
+end
+redis.call('HDEL', KEYS[2], ARGV[1])
+redis.call('RPUSH', KEYS[3], ARGV[1])
+return 1
+"""
+
+
+def queue_chunks(chunks: List[List[Tuple[str, Optional[str]]]], full: bool = False,
+                 dictionary_id: Optional[int] = None, claim_timeout: float = 600,
+                 generations: Dict[str, Tuple[str, Optional[str]]] = None) -> \
+        Generator[Tuple[int, List[str], Dict[str, float]], None, None]:
+    """ Pushes the chunks of entries onto the work queue, and then yields the results of each chunk (see
+    reload_worker_chunk()) as workers acknowledge them. Returns once every chunk has been acknowledged. See
+    load_entries() for the meaning of full and generations.
+
+    Chunks claimed by a worker more than claim_timeout seconds ago are put back onto the queue. Raises a RuntimeError
+    if a worker fails to load a chunk, after emptying the queue so that the other workers stop. """
+
+    with RedisConnection() as r_conn:
+        pipe = r_conn.pipeline()
+        pipe.delete(queue_key, processing_key, claims_key, results_key)
+        # Workers pop from the right, so push in reverse to have the chunks processed in order
+        for chunk_id in reversed(range(len(chunks))):
+            pipe.lpush(queue_key, json.dumps({'id': chunk_id, 'entries': chunks[chunk_id], 'full': full,
+                                              'dictionary': dictionary_id, 'generations': generations}))
+        pipe.execute()
+        logging.info('Queued %d chunks of entries for the workers.', len(chunks))
+
+        acknowledged = set()
+        last_check = time.time()
+        try:
+            while len(acknowledged) < len(chunks):
+                result = r_conn.blpop(results_key, timeout=1)
+                if result is not None:
+                    result = json.loads(result[1])
+                    if 'error' in result:
+                        raise RuntimeError('A worker failed to load chunk %s: %s' % (result['id'], result['error']))
+                    # A chunk which was put back onto the queue may be acknowledged more than once
+                    if result['id'] not in acknowledged:
+                        acknowledged.add(result['id'])
+                        yield result['processed'], result['loaded'], result['timings']
+
+                if time.time() - last_check > 1:
+                    requeue_expired_chunks(r_conn, claim_timeout)
+                    last_check = time.time()
+        finally:
+            r_conn.delete(queue_key, processing_key, claims_key, results_key)
+
+
+def requeue_expired_chunks(r_conn, claim_timeout: float) -> None:
+    """ Puts the chunks which were claimed more than claim_timeout seconds ago back onto the queue. """
+
+    now = time.time()
+    processing = r_conn.lrange(processing_key, 0, -1)
+    if not processing:
+        return
+
+    claims = r_conn.hmget(claims_key, processing)
+    for item, claimed in zip(processing, claims):
+        if claimed is None:
+            # The worker died before recording its claim, or is about to record it, so start the clock now
+            r_conn.hsetnx(claims_key, item, now)
+        elif now - float(claimed) > claim_timeout:
+            if requeue_chunk(r_conn, item):
+                logging.warning('Requeued chunk %s, which was claimed %.0f seconds ago.', json.loads(item)['id'],
+                                now - float(claimed))
+
+
+def requeue_chunk(r_conn, item: bytes) -> bool:
+    """ Moves the chunk from the processing list to the front of the queue, unless it has been acknowledged since
+    it was listed. Returns True if it was put back onto the queue. """
+
+    return bool(r_conn.eval(requeue_script, 3, processing_key, claims_key, queue_key, item))
+
+
+def run_worker(write_limit: Optional[float] = None, once: bool = False) -> None:
+    """ Loads the chunks of entries from the work queue until it is killed. write_limit is the maximum rate, in bytes
+    per second, at which this worker writes to Redis. If once is True, returns when the queue is empty. """
+
+    write_limiter = WriteLimiter(write_limit)
+    dictionary_id = None
+
+    with RedisConnection() as r_conn:
+        while True:
+            item = r_conn.brpoplpush(queue_key, processing_key, timeout=5)
+            if item is None:
+                if once:
+                    return
+                continue
+            r_conn.hset(claims_key, item, time.time())
+
+            chunk = json.loads(item)
+            if chunk['dictionary'] != dictionary_id:
+                dictionary_id = chunk['dictionary']
+                if dictionary_id:
+                    use_zstd_dictionary(dictionary_id)
+                else:
+                    use_zlib()
+            logging.info('Loading chunk %s.', chunk['id'])
+            result = {'id': chunk['id'], 'processed': len(chunk['entries'])}
+            try:
+                result['loaded'], result['timings'] = load_entries(
+                    [tuple(x) for x in chunk['entries']], r_conn, full=chunk['full'], write_limiter=write_limiter,
+                    generations=chunk['generations'])
+            except Exception as err:
+                # Retrying would most likely fail the same way, so have the coordinator stop the reload instead
+                logging.exception('Failed to load chunk %s.', chunk['id'])
+                result['error'] = repr(err)
+
+            pipe = r_conn.pipeline()
+            pipe.lrem(processing_key, 1, item)
+            pipe.hdel(claims_key, item)
+            pipe.rpush(results_key, json.dumps(result))
+            pipe.execute()
@@ -41,5 +41,9 @@ class GetStatus(Schema):
     pass
 
 
+class Health(Schema):
+    pass
+
+
 class Static(Schema):
     pass
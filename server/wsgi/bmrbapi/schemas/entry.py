@@ -1,11 +1,11 @@
 import enum
 
-from marshmallow import fields, Schema
+from marshmallow import fields, Schema, validate
 
 from bmrbapi.schemas.default import DatabaseSchema, CustomErrorEnum
 
 __all__ = ['GetEntry', 'GetSoftwareByEntry', 'GetExperimentData', 'GetCitation', 'SimulateHsqc',
-           'ValidateEntry', 'ListEntries']
+           'ValidateEntry', 'ListEntries', 'GetCitations']
 
 
 class GetEntry(Schema):
@@ -42,6 +42,10 @@ class GetCitation(Schema):
     format = CustomErrorEnum(Format)
 
 
+class GetCitations(GetCitation):
+    pass
+
+
 class SimulateHsqc(Schema):
     class Format(enum.Enum):
         html = "html"
@@ -62,4 +66,6 @@ class ValidateEntry(Schema):
 
 
 class ListEntries(DatabaseSchema):
-    pass
+    limit = fields.Integer(validate=validate.Range(min=1))
+    after = fields.String()
+    released_since = fields.Date()
@@ -1,11 +1,12 @@
 import enum
 
-from marshmallow import fields, Schema
+from marshmallow import fields, Schema, validate
 
 from bmrbapi.schemas.default import DatabaseSchema, CustomErrorEnum
 
-__all__ = ['GetBmrbDataFromPdbId', 'MultipleShiftSearch', 'GetChemicalShifts', 'GetAllValuesForTag', 'GetIdFromSearch',
-           'GetBmrbIdsFromPdbId', 'GetPdbIdsFromBmrbId', 'FastaSearch', 'Instant', 'Select', 'RerouteInstantInternal']
+__all__ = ['GetBmrbDataFromPdbId', 'MultipleShiftSearch', 'PeakSearch', 'GetChemicalShifts',
+           'GetChemicalShiftStatistics', 'GetAllValuesForTag', 'GetIdFromSearch', 'GetBmrbIdsFromPdbId',
+           'GetPdbIdsFromBmrbId', 'FastaSearch', 'Instant', 'Select', 'RerouteInstantInternal']
 
 
 class GetBmrbDataFromPdbId(Schema):
@@ -20,17 +21,48 @@ class MultipleShiftSearch(DatabaseSchema):
     shift = fields.Float(multiple=True)
 
 
+class PeakSearch(DatabaseSchema):
+    class Nuclei(enum.Enum):
+        N = "N"
+        C = "C"
+        n = "n"
+        c = "c"
+
+    peak = fields.String(multiple=True)
+    nucleus = CustomErrorEnum(Nuclei)
+    hthresh = fields.Float(validate=validate.Range(min=0, min_inclusive=False))
+    nthresh = fields.Float(validate=validate.Range(min=0, min_inclusive=False))
+    cthresh = fields.Float(validate=validate.Range(min=0, min_inclusive=False))
+
+
+class StreamingFormats(enum.Enum):
+    json = "json"
+    ndjson = "ndjson"
+    csv = "csv"
+    arrow = "arrow"
+    parquet = "parquet"
+
+
 class GetChemicalShifts(DatabaseSchema):
+
     shift = fields.Float(multiple=True)
     threshold = fields.Float()
     atom_type = fields.String()
     atom_id = fields.String(multiple=True)
     comp_id = fields.String(multiple=True)
     conditions = fields.Bool()
+    format = CustomErrorEnum(StreamingFormats)
+
+
+class GetChemicalShiftStatistics(DatabaseSchema):
+    comp_id = fields.String(multiple=True, required=True)
+    atom_id = fields.String(multiple=True)
+    ph = fields.Float()
+    temperature = fields.Float()
 
 
 class GetAllValuesForTag(DatabaseSchema):
-    pass
+    format = CustomErrorEnum(StreamingFormats)
 
 
 class GetIdFromSearch(DatabaseSchema):
@@ -0,0 +1,111 @@
+""" Compression of the data stored in Redis.
+
+Data is either compressed with zlib, or with zstd using a dictionary trained over the archive at reload time. A zstd
+frame starts with a magic number that can never start a zlib stream, and it records the ID of the dictionary it was
+compressed with, so the codec is determined from the data itself and both can coexist in the same database. """
+
+import logging
+import threading
+import zlib
+from typing import List
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from bmrbapi.exceptions import ServerException
+from bmrbapi.utils.configuration import configuration
+from bmrbapi.utils.connections import RedisConnection
+
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+# Trained dictionaries are never modified once stored, so they can be cached by ID
+_dictionaries = {}
+_thread_local = threading.local()
+
+# The compressor to use in this process, set by the reloader
+_compressor = None
+
+
+def _get_dictionary(dict_id: int) -> 'zstandard.ZstdCompressionDict':
+    """ Returns the zstd dictionary with the given ID, loading it from Redis if needed. """
+
+    if dict_id not in _dictionaries:
+        with RedisConnection() as r_conn:
+            dictionary = r_conn.get("compression:zstd_dictionary:%s" % dict_id)
+        if dictionary is None:
+            raise ServerException("The zstd dictionary %s is missing from Redis." % dict_id)
+        _dictionaries[dict_id] = zstandard.ZstdCompressionDict(dictionary)
+    return _dictionaries[dict_id]
+
+
+def decompress(data: bytes) -> bytes:
+    """ Decompresses data compressed with either codec. """
+
+    if not data.startswith(ZSTD_MAGIC):
+        return zlib.decompress(data)
+
+    if zstandard is None:
+        raise ServerException("Data is compressed with zstd, but the zstandard module is not installed.")
+
+    # Decompressors are not thread safe, so keep one per thread and dictionary
+    dict_id = zstandard.get_frame_parameters(data).dict_id
+    decompressors = getattr(_thread_local, 'decompressors', None)
+    if decompressors is None:
+        decompressors = _thread_local.decompressors = {}
+    if dict_id not in decompressors:
+        if dict_id:
+            decompressors[dict_id] = zstandard.ZstdDecompressor(dict_data=_get_dictionary(dict_id))
+        else:
+            decompressors[dict_id] = zstandard.ZstdDecompressor()
+    return decompressors[dict_id].decompress(data)
+
+
+def to_zlib(data: bytes) -> bytes:
+    """ Returns the data compressed with zlib, transcoding it only if it was compressed with zstd. """
+
+    if data.startswith(ZSTD_MAGIC):
+        return zlib.compress(decompress(data))
+    return data
+
+
+def compress(data: bytes) -> bytes:
+    """ Compresses data using the codec enabled by use_zstd_dictionary(), or zlib if it wasn't called. """
+
+    if _compressor is None:
+        return zlib.compress(data)
+    return _compressor.compress(data)
+
+
+def use_zlib() -> None:
+    """ Makes compress() use zlib in this process, undoing use_zstd_dictionary(). """
+
+    global _compressor
+
+    _compressor = None
+
+
+def use_zstd_dictionary(dict_id: int) -> None:
+    """ Makes compress() use zstd with the given (previously stored) dictionary in this process. """
+
+    global _compressor
+
+    level = configuration.get('entry_compression', {}).get('level', 10)
+    _compressor = zstandard.ZstdCompressor(level=level, dict_data=_get_dictionary(dict_id))
+
+
+def train_zstd_dictionary(samples: List[bytes]) -> int:
+    """ Trains a zstd dictionary over the provided samples, stores it in Redis, and returns its ID. """
+
+    if zstandard is None:
+        raise ImportError("The zstandard module must be installed to compress entries with zstd.")
+
+    dictionary_size = configuration.get('entry_compression', {}).get('dictionary_size', 112640)
+    dictionary = zstandard.train_dictionary(dictionary_size, samples)
+    with RedisConnection() as r_conn:
+        r_conn.set("compression:zstd_dictionary:%s" % dictionary.dict_id(), dictionary.as_bytes())
+    _dictionaries[dictionary.dict_id()] = dictionary
+    logging.info("Trained zstd dictionary %s over %d samples.", dictionary.dict_id(), len(samples))
+
+    return dictionary.dict_id()
@@ -1,3 +1,8 @@
+import os
+import threading
+import time
+from typing import Dict
+
 import psycopg2
 import psycopg2.extras
 import redis
@@ -7,19 +12,129 @@ from bmrbapi.exceptions import RequestException, ServerException
 from bmrbapi.utils.configuration import configuration
 
 
+class PostgresPool:
+    """ A pool of connections to one database using one set of credentials, shared by the threads of a process.
+
+    Connections are opened as needed, up to max_size. Once that many are checked out, get() waits up to timeout
+    seconds for one to be returned. Returned connections are reset (rolling back any open transaction and resetting
+    session settings like the search_path), and broken connections are discarded rather than reused. """
+
+    def __init__(self, max_size: int, timeout: float, **connect_kwargs):
+        self.max_size = max_size
+        self.timeout = timeout
+        self._connect_kwargs = connect_kwargs
+        self._idle = []
+        self._size = 0
+        self._condition = threading.Condition()
+
+        self.checkouts = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.checkout_time = 0.0
+        self.max_checkout_time = 0.0
+
+    def get(self) -> psycopg2.extensions.connection:
+        """ Returns a connection from the pool, opening a new one if needed and allowed. """
+
+        start = time.monotonic()
+        conn = None
+        waited = False
+        with self._condition:
+            while conn is None:
+                if self._idle:
+                    conn = self._idle.pop()
+                    if conn.closed:
+                        self._size -= 1
+                        conn = None
+                    continue
+                if self._size < self.max_size:
+                    # Reserve the slot, and connect outside of the lock
+                    self._size += 1
+                    break
+                remaining = self.timeout - (time.monotonic() - start)
+                if remaining <= 0:
+                    raise ServerException('Timed out waiting for a database connection.')
+                waited = True
+                self._condition.wait(remaining)
+
+        if conn is None:
+            try:
+                conn = psycopg2.connect(**self._connect_kwargs)
+            except Exception as err:
+                # Give back the reserved slot whatever went wrong, or the pool would shrink for good
+                with self._condition:
+                    self._size -= 1
+                    self._condition.notify()
+                if isinstance(err, psycopg2.OperationalError):
+                    raise ServerException('Could not connect to the database server.')
+                raise
+
+        elapsed = time.monotonic() - start
+        with self._condition:
+            self.checkouts += 1
+            self.checkout_time += elapsed
+            self.max_checkout_time = max(self.max_checkout_time, elapsed)
+            if waited:
+                self.waits += 1
+                self.wait_time += elapsed
+
+        return conn
+
+    def put(self, conn: psycopg2.extensions.connection) -> None:
+        """ Returns a connection to the pool. """
+
+        if not conn.closed:
+            try:
+                conn.reset()
+            except psycopg2.Error:
+                conn.close()
+
+        with self._condition:
+            if conn.closed:
+                self._size -= 1
+            else:
+                self._idle.append(conn)
+            self._condition.notify()
+
+    def stats(self) -> dict:
+        """ Returns the pool counters. """
+
+        with self._condition:
+            return {'size': self._size, 'in_use': self._size - len(self._idle), 'max_size': self.max_size,
+                    'checkouts': self.checkouts, 'waits': self.waits, 'wait_time': self.wait_time,
+                    'average_checkout_time': self.checkout_time / self.checkouts if self.checkouts else 0,
+                    'max_checkout_time': self.max_checkout_time}
+
+
 class PostgresConnection:
     """ Makes it more convenient to query postgres. It implements a context manager to ensure that the connection
-    is closed.
+    is returned to the pool.
+
+    Connections come from a per-process pool for each set of credentials (web, reload, and ETS). Any transaction
+    which is not committed before the context manager exits is rolled back.
 
     Specify write_access=True to use the reload user account with write access. Do not use this whenever user input
     is involved!
     Specify ets=True to connect to the ETS database.
-    Specify a schema to set it as the default search path."""
+    Specify a schema to set it as the default search path.
+    Specify server_side=True to get a named (server-side) cursor, which fetches the results of its query from the
+    server in batches of itersize rows as they are iterated over, rather than all at once. It can only execute one
+    query."""
+
+    _pools: Dict[str, PostgresPool] = {}
+    _pools_pid: int = None
+    _pools_lock = threading.Lock()
+    # Connections inherited from a parent process must not be garbage collected, as closing them would also close
+    #  the parent's connections
+    _inherited_pools = []
 
-    def __init__(self, write_access: bool = False, ets: bool = False, schema: str = None):
+    def __init__(self, write_access: bool = False, ets: bool = False, schema: str = None, server_side: bool = False,
+                 itersize: int = 2000):
 
         self._ets = ets
         self._reload = write_access
+        self._server_side = server_side
+        self._itersize = itersize
 
         # Check the schema
         if schema:
@@ -29,28 +144,70 @@ class PostgresConnection:
                 raise RequestException("Invalid database: %s." % schema)
         self._schema = schema
 
+    @classmethod
+    def get_pool(cls, name: str) -> PostgresPool:
+        """ Returns the pool for this process with the given name (web, reload, or ets), creating it if needed. """
+
+        with cls._pools_lock:
+            if cls._pools_pid != os.getpid():
+                if cls._pools:
+                    cls._inherited_pools.append(cls._pools)
+                cls._pools = {}
+                cls._pools_pid = os.getpid()
+
+            if name not in cls._pools:
+                if name == 'ets':
+                    connect_kwargs = {'host': configuration['ets']['host'],
+                                      'user': configuration['ets']['user'],
+                                      'database': configuration['ets']['database'],
+                                      'port': configuration['ets']['port']}
+                else:
+                    user = configuration['postgres']['user'] if name == 'web' else \
+                        configuration['postgres']['reload_user']
+                    connect_kwargs = {'host': configuration['postgres']['host'],
+                                      'user': user,
+                                      'database': configuration['postgres']['database'],
+                                      'port': configuration['postgres']['port']}
+                pool_config = configuration.get('postgres_pool', {})
+                cls._pools[name] = PostgresPool(max_size=pool_config.get('max_size', 10),
+                                                timeout=pool_config.get('timeout', 30),
+                                                cursor_factory=psycopg2.extras.DictCursor,
+                                                **connect_kwargs)
+
+            return cls._pools[name]
+
+    @classmethod
+    def pool_stats(cls) -> dict:
+        """ Returns the counters of the pools of this process. """
+
+        with cls._pools_lock:
+            pools = dict(cls._pools) if cls._pools_pid == os.getpid() else {}
+        return {name: pool.stats() for name, pool in pools.items()}
+
     def __enter__(self) -> psycopg2.extras.DictCursor:
 
         if self._ets:
-            self._conn = psycopg2.connect(host=configuration['ets']['host'],
-                                          user=configuration['ets']['user'],
-                                          database=configuration['ets']['database'],
-                                          port=configuration['ets']['port'],
-                                          cursor_factory=psycopg2.extras.DictCursor)
+            self._pool = self.get_pool('ets')
         else:
-            user = configuration['postgres']['user'] if not self._reload else configuration['postgres']['reload_user']
-            self._conn = psycopg2.connect(host=configuration['postgres']['host'],
-                                          user=user,
-                                          database=configuration['postgres']['database'],
-                                          port=configuration['postgres']['port'],
-                                          cursor_factory=psycopg2.extras.DictCursor)
-        cursor = self._conn.cursor()
-        if self._schema:
-            cursor.execute('SET search_path=public,%s;', [self._schema])
+            self._pool = self.get_pool('reload' if self._reload else 'web')
+        self._conn = self._pool.get()
+
+        try:
+            cursor = self._conn.cursor()
+            if self._schema:
+                cursor.execute('SET search_path=public,%s;', [self._schema])
+            if self._server_side:
+                # The cursor only lives until the transaction ends, which is when the connection is returned
+                cursor.close()
+                cursor = self._conn.cursor(name='server_side_cursor')
+                cursor.itersize = self._itersize
+        except psycopg2.Error:
+            self._pool.put(self._conn)
+            raise
         return cursor
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self._conn.close()
+        self._pool.put(self._conn)
 
     def commit(self):
         self._conn.commit()
@@ -65,35 +222,50 @@ class RedisConnection:
     to it. It passes back that connection object, using a context manager
     to clean up after use.
 
+    The connections come from a pool which is shared by the whole process. It is created on first use, and again
+    after a fork, so that processes never share sockets. When sentinels are configured, the master is discovered
+    when a connection is opened, and is only rediscovered when a connection fails (for example after a failover)
+    rather than on every request.
+
     If only one "sentinel" is defined, then just connect directly to that machine rather than checking the sentinels. """
 
-    def __init__(self):
-        """ Creates a connection instance. Optionally specify a non-default db. """
+    _client: redis.StrictRedis = None
+    _client_pid: int = None
+    _client_lock = threading.Lock()
 
-        # If there is only one sentinel, just treat that as the Redis instance itself, and not a sentinel
-        if len(configuration['redis']['sentinels']) == 1:
-            self._redis_host = configuration['redis']['sentinels'][0][0]
-            self._redis_port = configuration['redis']['sentinels'][0][1]
-        else:
-            # Connect to the sentinels to determine the master
-            try:
-                sentinel = Sentinel(configuration['redis']['sentinels'], socket_timeout=0.5)
-                self._redis_host, self._redis_port = sentinel.discover_master(configuration['redis']['master_name'])
+    @classmethod
+    def get_client(cls) -> redis.StrictRedis:
+        """ Returns the client for this process, creating it and its connection pool if needed. """
 
-            # Raise an exception if we cannot connect to the database server
-            except redis.sentinel.MasterNotFoundError:
-                raise ServerException('Could not determine Redis host. Sentinels offline?')
+        with cls._client_lock:
+            if cls._client is None or cls._client_pid != os.getpid():
+                password = configuration['redis']['password'] if configuration['redis']['password'] else None
 
-    def __enter__(self) -> redis.StrictRedis:
-        try:
-            password = configuration['redis']['password'] if configuration['redis']['password'] else None
-            self._redis_con = redis.StrictRedis(host=self._redis_host,
-                                                port=self._redis_port,
+                # If there is only one sentinel, just treat that as the Redis instance itself, and not a sentinel
+                if len(configuration['redis']['sentinels']) == 1:
+                    pool = redis.ConnectionPool(host=configuration['redis']['sentinels'][0][0],
+                                                port=configuration['redis']['sentinels'][0][1],
                                                 db=configuration['redis']['db'],
                                                 password=password)
-        except redis.exceptions.ConnectionError:
-            raise ServerException('Could not connect to Redis server.')
-        return self._redis_con
+                    cls._client = redis.StrictRedis(connection_pool=pool)
+                else:
+                    sentinel = Sentinel(configuration['redis']['sentinels'], socket_timeout=0.5)
+                    cls._client = sentinel.master_for(configuration['redis']['master_name'],
+                                                      redis_class=redis.StrictRedis,
+                                                      db=configuration['redis']['db'],
+                                                      password=password)
+                cls._client_pid = os.getpid()
+
+            return cls._client
+
+    def __enter__(self) -> redis.StrictRedis:
+        return self.get_client()
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self._redis_con.close()
+        # The connections are returned to the pool after each command, so there is nothing to close
+
+        # Raise an exception if we cannot connect to the database server
+        if exc_type is not None and issubclass(exc_type, redis.sentinel.MasterNotFoundError):
+            raise ServerException('Could not determine Redis host. Sentinels offline?')
+        if exc_type is not None and issubclass(exc_type, redis.exceptions.ConnectionError):
+            raise ServerException('Could not connect to Redis server.')
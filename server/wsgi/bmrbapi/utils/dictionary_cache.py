@@ -0,0 +1,213 @@
+""" A per-process cache of the NMR-STAR dictionary tables in the dict schema. The dictionary only changes when the
+database is reloaded, but it is consulted by almost every query which builds or searches NMR-STAR, so it is loaded in
+bulk once and then served from memory.
+
+The reloader bumps the dictionary generation in Redis after reloading the database, and each process reloads its copy
+of the dictionary once it notices the change. """
+
+import bisect
+import logging
+import threading
+import time
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple
+
+from bmrbapi.utils.configuration import configuration
+from bmrbapi.utils.connections import PostgresConnection, RedisConnection
+
+generation_key = "dictionary:generation"
+
+
+class DictionaryTables:
+    """ An immutable snapshot of the dictionary tables, indexed for the lookups the API performs. """
+
+    def __init__(self, generation: Optional[str]):
+        self.generation = generation
+        self.loaded = time.time()
+
+        # lower(tagcategory) -> the tag holding the logical entry ID
+        self.entry_id_tags: Dict[str, str] = {}
+        # tagcategory -> (the tags to print, the tags which are saveframe pointers)
+        self.printable_tags: Dict[str, Tuple[List[str], List[str]]] = {}
+        # The full tag names (originaltag) of the tags which should be used to order loops
+        self.row_index_tags = set()
+        # sfcategory -> (internalflag, printflag)
+        self.category_flags: Dict[str, Tuple[str, str]] = {}
+        # sfcategory -> the human readable description of the category
+        self.category_descriptions: Dict[str, str] = {}
+        # originalcategory -> the table of the saveframe tags
+        self.category_tables: Dict[str, str] = {}
+        # originalcategory -> the tables of the loops, in dictionary order
+        self.category_loops: Dict[str, List[str]] = {}
+        # originaltag -> {'type': ..., 'values': [...]}
+        self.enumerations: Dict[str, dict] = {}
+        # originaltag -> the sorted enumeration values, for prefix searches
+        self.sorted_enumerations: Dict[str, List[str]] = {}
+
+    def load(self, cur) -> None:
+        """ Loads the dictionary tables using the provided cursor. """
+
+        cur.execute('''SELECT dictionaryseq, printflag FROM dict.validator_printflags''')
+        print_flags = {x[0]: x[1] for x in cur.fetchall()}
+
+        cur.execute('''SELECT seq, val FROM dict.enumerations''')
+        enumeration_values = defaultdict(list)
+        for seq, val in cur:
+            enumeration_values[seq].append(val)
+
+        cur.execute('''SELECT originaltag, tagfield, tagcategory, originalcategory, internalflag, dictionaryseq,
+       sfpointerflg, rowindexflg, entryidflg, loopflag, itemenumclosedflg, enumeratedflg
+  FROM dict.adit_item_tbl
+  ORDER BY dictionaryseq''')
+
+        category_order = defaultdict(list)
+        for row in cur.fetchall():
+            tag_category = row['tagcategory']
+
+            if row['entryidflg'] == 'Y':
+                self.entry_id_tags.setdefault(tag_category.lower(), row['tagfield'])
+            if row['rowindexflg'] == 'Y':
+                self.row_index_tags.add(row['originaltag'])
+
+            # Tags without a print flag are never printed
+            printflag = print_flags.get(row['dictionaryseq'])
+            if printflag is not None:
+                tags_to_use, pointer_tags = self.printable_tags.setdefault(tag_category, ([], []))
+                if row['sfpointerflg'] == 'Y':
+                    pointer_tags.append(row['tagfield'])
+                # Make sure it isn't internal and it should be printed
+                if row['internalflag'] != 'Y' and printflag in ('Y', 'O'):
+                    tags_to_use.append(row['tagfield'])
+
+            if row['loopflag'] is not None and row['loopflag'] != 'Y':
+                self.category_tables.setdefault(row['originalcategory'], tag_category)
+            if tag_category not in category_order[row['originalcategory']]:
+                category_order[row['originalcategory']].append(tag_category)
+
+            if row['itemenumclosedflg'] == 'Y':
+                enumeration_type = 'enumerations'
+            elif row['enumeratedflg'] == 'Y':
+                enumeration_type = 'common'
+            else:
+                enumeration_type = None
+            values = enumeration_values.get(row['dictionaryseq'], [None])
+            self.enumerations.setdefault(row['originaltag'], {'type': enumeration_type, 'values': values})
+            self.sorted_enumerations.setdefault(row['originaltag'], sorted(x for x in values if x))
+
+        # The first table of each category holds the saveframe tags, the rest are loops
+        for category, tables in category_order.items():
+            self.category_loops[category] = tables[1:]
+
+        cur.execute('''SELECT sfcategory, internalflag, printflag FROM dict.cat_grp ORDER BY groupid''')
+        for row in cur:
+            self.category_flags.setdefault(row[0], (row[1], row[2]))
+
+        cur.execute('''SELECT sfcategory, catgrpviewname FROM dict.aditcatgrp''')
+        for row in cur:
+            self.category_descriptions.setdefault(row[0], row[1])
+
+
+class DictionaryCache:
+    """ Serves the dictionary lookups from a snapshot of the dictionary tables, reloading the snapshot when the
+    dictionary generation in Redis changes. """
+
+    def __init__(self):
+        self.loads = 0
+        self._tables: Optional[DictionaryTables] = None
+        self._checked = 0
+        self._lock = threading.Lock()
+
+    @property
+    def tables(self) -> DictionaryTables:
+        """ Returns the current snapshot of the dictionary, loading it first if needed. """
+
+        tables = self._tables
+        if tables is not None and time.time() - self._checked < configuration.get('generation_cache_seconds', 2):
+            return tables
+
+        with self._lock:
+            # Another thread may have just refreshed it
+            if self._tables is not None and \
+                    time.time() - self._checked < configuration.get('generation_cache_seconds', 2):
+                return self._tables
+
+            with RedisConnection() as r_conn:
+                generation = r_conn.get(generation_key)
+            generation = generation.decode() if generation is not None else None
+
+            if self._tables is None or self._tables.generation != generation:
+                tables = DictionaryTables(generation)
+                with PostgresConnection() as cur:
+                    tables.load(cur)
+                self._tables = tables
+                self.loads += 1
+                logging.info("Loaded the NMR-STAR dictionary (generation %s).", generation)
+            self._checked = time.time()
+            return self._tables
+
+    def get_entry_id_tag(self, tag_category: str) -> Optional[str]:
+        """ Returns the tag of the category which holds the logical entry ID, or None if the category is unknown. """
+
+        return self.tables.entry_id_tags.get(tag_category.lower())
+
+    def get_printable_tags(self, tag_category: str) -> Tuple[List[str], List[str]]:
+        """ Returns the tags that should be printed for the given category and the tags that are pointers. """
+
+        return self.tables.printable_tags.get(tag_category, ([], []))
+
+    def is_row_index(self, tag: str) -> bool:
+        """ Returns whether the (fully qualified) tag should be used to order the rows of its loop. """
+
+        return tag in self.tables.row_index_tags
+
+    def get_category_flags(self, sf_category: str) -> Optional[Tuple[str, str]]:
+        """ Returns the internal and print flags of the saveframe category, or None if the category is unknown. """
+
+        return self.tables.category_flags.get(sf_category)
+
+    def get_category_description(self, sf_category: str) -> Optional[str]:
+        """ Returns the human readable description of the saveframe category, or None if the category is unknown. """
+
+        return self.tables.category_descriptions.get(sf_category)
+
+    def get_category_tables(self, sf_category: str) -> Tuple[Optional[str], List[str]]:
+        """ Returns the table holding the saveframe tags of the category, and the tables of its loops. """
+
+        tables = self.tables
+        return tables.category_tables.get(sf_category), tables.category_loops.get(sf_category, [])
+
+    def get_enumerations(self, tag: str) -> Optional[dict]:
+        """ Returns the type of enumeration of the tag and its values, or None if the tag is unknown. """
+
+        return self.tables.enumerations.get(tag)
+
+    def search_enumerations(self, tag: str, term: str) -> List[str]:
+        """ Returns the enumeration values of the tag which start with term, in sorted order. """
+
+        values = self.tables.sorted_enumerations.get(tag, [])
+        start = bisect.bisect_left(values, term)
+        results = []
+        for value in values[start:]:
+            if not value.startswith(term):
+                break
+            results.append(value)
+        return results
+
+    def stats(self) -> dict:
+        """ Returns the state of the cache in this process. """
+
+        tables = self._tables
+        if tables is None:
+            return {'loaded': False, 'loads': self.loads}
+        return {'loaded': True, 'loads': self.loads, 'generation': tables.generation,
+                'age': time.time() - tables.loaded}
+
+
+def bump_dictionary_generation() -> None:
+    """ Tells every process that the dictionary changed, so that they reload it. """
+
+    with RedisConnection() as r_conn:
+        r_conn.incr(generation_key)
+
+
+dictionary_cache = DictionaryCache()
@@ -0,0 +1,76 @@
+""" A per-process cache of parsed PyNMR-STAR entries. Parsing a large entry from JSON takes far longer than fetching it,
+so the most recently used entries are kept around in each worker. """
+
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+import pynmrstar
+
+from bmrbapi.utils.configuration import configuration
+
+
+class EntryCache:
+    """ A least recently used cache of parsed entries. It is bounded both by the number of entries and by the total
+    size of the (uncompressed JSON) entries it holds.
+
+    Each entry is stored along with the generation of the database it was loaded from. Lookups must provide the
+    current generation of that database, and an entry cached from a previous generation is treated as a miss.
+
+    The cached objects are shared, so callers must never modify them. """
+
+    def __init__(self, max_entries: int, max_bytes: int):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, entry_id: str, generation: Optional[str]) -> Optional[pynmrstar.Entry]:
+        """ Returns the cached entry, or None if it isn't cached or was cached from a different generation. """
+
+        with self._lock:
+            cached = self._entries.get(entry_id)
+            if cached is None or generation is None or cached[0] != generation:
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(entry_id)
+            self.hits += 1
+            return cached[1]
+
+    def put(self, entry_id: str, generation: Optional[str], entry: pynmrstar.Entry, size: int) -> None:
+        """ Adds an entry to the cache, evicting the least recently used entries as needed. """
+
+        # Don't cache entries that we can't invalidate, or that would flush the whole cache
+        if generation is None or size > self.max_bytes or self.max_entries < 1:
+            return
+
+        with self._lock:
+            if entry_id in self._entries:
+                self._size -= self._entries.pop(entry_id)[2]
+            self._entries[entry_id] = (generation, entry, size)
+            self._size += size
+
+            while len(self._entries) > self.max_entries or self._size > self.max_bytes:
+                self._size -= self._entries.popitem(last=False)[1][2]
+
+    def clear(self) -> None:
+        """ Empties the cache. """
+
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def stats(self) -> dict:
+        """ Returns the cache counters for this process. """
+
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'entries': len(self._entries), 'bytes': self._size,
+                    'max_entries': self.max_entries, 'max_bytes': self.max_bytes}
+
+
+entry_cache = EntryCache(max_entries=configuration.get('entry_cache', {}).get('max_entries', 100),
+                         max_bytes=configuration.get('entry_cache', {}).get('max_bytes', 50 * 1024 * 1024))
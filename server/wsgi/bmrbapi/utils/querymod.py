@@ -6,8 +6,8 @@ is done; restapi.py mainly just calls the methods here and returns the results.
 """
 import logging
 import os
-import zlib
-from typing import Union, List, Generator, Tuple, Optional
+import time
+from typing import Union, List, Generator, Tuple, Optional, Dict
 
 import pynmrstar
 import simplejson as json
@@ -18,8 +18,11 @@ from psycopg2.extras import DictCursor
 from redis import StrictRedis
 
 from bmrbapi.exceptions import RequestException, ServerException
+from bmrbapi.utils.compression import decompress, to_zlib
 from bmrbapi.utils.configuration import configuration
 from bmrbapi.utils.connections import PostgresConnection, RedisConnection
+from bmrbapi.utils.dictionary_cache import dictionary_cache
+from bmrbapi.utils.entry_cache import entry_cache
 
 # Determine submodules folder
 _QUERYMOD_DIR = os.path.dirname(os.path.realpath(__file__))
@@ -29,24 +32,67 @@ SUBMODULE_DIR = os.path.join(os.path.dirname(_QUERYMOD_DIR), "submodules")
 logging.basicConfig()
 
 
-def locate_entry(entry_id: str, r_conn: StrictRedis) -> str:
-    """ Determines what the Redis key is for an entry given the database
-    provided."""
+# The currently published generation of each database, and when it was fetched
+_current_generations = {}
+
+
+def get_current_generation(database: str) -> Optional[str]:
+    """ Returns the generation of the database which is currently published, or None if the database was loaded
+    without generations.
+
+    The reloader writes each reload of a database under a new generation, and then publishes it by switching the
+    pointer to it. The pointer is cached for a couple of seconds so that it doesn't need to be fetched for every
+    request, and the reloader waits longer than that before deleting the previous generation. """
+
+    cached = _current_generations.get(database)
+    if cached is None or time.time() - cached[1] > configuration.get('generation_cache_seconds', 2):
+        with RedisConnection() as r_conn:
+            generation = r_conn.get("%s:current_generation" % database)
+        cached = (generation.decode() if generation is not None else None, time.time())
+        _current_generations[database] = cached
+    return cached[0]
+
+
+def get_redis_database(entry_id: str) -> str:
+    """ Returns which database in Redis holds the entry. """
 
     if entry_id.startswith("bm"):
-        return "metabolomics:entry:%s" % entry_id
+        return "metabolomics"
     elif entry_id.startswith("chemcomp"):
-        return "chemcomps:entry:%s" % entry_id
+        return "chemcomps"
     elif len(entry_id) == 32:
-        entry_loc = "uploaded:entry:%s" % entry_id
+        return "uploaded"
+    else:
+        return "macromolecules"
+
+
+def locate_entry(entry_id: str, r_conn: StrictRedis = None, key_type: str = "entry",
+                 generation: Optional[str] = None) -> str:
+    """ Determines what the Redis key is for an entry given the database
+    provided. If a Redis connection is provided, the expiration time of an
+    uploaded entry is refreshed as well.
+
+    Specify a key_type to get the key of data stored alongside the entry, for
+    example "entry_star" for the pre-rendered NMR-STAR.
+
+    The key is in the currently published generation of the database, unless
+    a generation is specified."""
+
+    database = get_redis_database(entry_id)
+    if database == "uploaded":
+        entry_loc = "uploaded:%s:%s" % (key_type, entry_id)
 
         # Update the expiration time if the entry is used
-        if r_conn.exists(entry_loc):
+        if r_conn is not None:
             r_conn.expire(entry_loc, configuration['redis']['upload_timeout'])
 
         return entry_loc
-    else:
-        return "macromolecules:entry:%s" % entry_id
+
+    if generation is None:
+        generation = get_current_generation(database)
+    if generation is None:
+        return "%s:%s:%s" % (database, key_type, entry_id)
+    return "%s:%s:%s:%s" % (database, generation, key_type, entry_id)
 
 
 def get_database_from_entry_id(entry_id: str) -> str:
@@ -58,6 +104,46 @@ def get_database_from_entry_id(entry_id: str) -> str:
         return "macromolecules"
 
 
+def convert_entry_format(entry: bytes, format_: str) -> Union[bytes, str, dict, pynmrstar.Entry]:
+    """ Converts a compressed JSON entry, as stored in Redis, into the requested format. See
+    get_valid_entries_from_redis() for the list of valid formats."""
+
+    # Return the compressed entry, only transcoding it if it isn't stored with zlib
+    if format_ == "zlib":
+        return to_zlib(entry)
+
+    # Uncompress into serialized JSON
+    entry = decompress(entry)
+    if format_ == "json":
+        return entry
+
+    # Parse the JSON into python dict
+    entry = json.loads(entry)
+    if format_ == "dict":
+        return entry
+
+    # Parse the dict into object
+    entry = pynmrstar.Entry.from_json(entry)
+    if format_ == "object":
+        return entry
+
+    # Return NMR-STAR
+    if format_ == "nmrstar" or format_ == "rawnmrstar":
+        return str(entry)
+
+    # Unknown format
+    raise RequestException("Invalid format: %s." % format_)
+
+
+def parse_entry(entry_id: str, entry: bytes, generation: Optional[str]) -> pynmrstar.Entry:
+    """ Parses a compressed JSON entry, as stored in Redis, and adds it to the cache of parsed entries."""
+
+    entry = convert_entry_format(entry, "json")
+    parsed = pynmrstar.Entry.from_json(json.loads(entry))
+    entry_cache.put(entry_id, generation, parsed, len(entry))
+    return parsed
+
+
 def get_valid_entries_from_redis(search_ids: Union[str, list],
                                  format_: str = "object",
                                  max_results: int = 500) -> \
@@ -65,12 +151,18 @@ def get_valid_entries_from_redis(search_ids: Union[str, list],
     """ Given a list of entries, yield them as the appropriate type as determined by the "format_"
     variable. Throw an exception if any of the provided IDs do not exist.
 
+    All of the entries are fetched from Redis in a single pipelined round trip, but they are only
+    decompressed and converted as they are yielded. Parsed entries are kept in a per-process cache
+    for as long as the generation of the database they were loaded from is current. Entries yielded
+    as objects are shared and must not be modified. The text formats are served from the NMR-STAR
+    rendered when the entry was loaded, if it is available.
+
     Valid entry formats:
     nmrstar: Return the entry as NMR-STAR text
     json: Return the entry in serialized JSON format
     dict: Return the entry JSON data as a python dict
     object: Return the PyNMR-STAR object for the entry
-    zlib: Return the entry straight from the DB as zlib compressed JSON
+    zlib: Return the entry as zlib compressed JSON (straight from the DB, unless stored with zstd)
     """
 
     # Wrap the IDs in a list if necessary
@@ -81,46 +173,290 @@ def get_valid_entries_from_redis(search_ids: Union[str, list],
     if len(search_ids) > max_results:
         raise RequestException('Too many IDs queried. Please query %s or fewer entries at a time. You attempted to '
                                'query %d IDs.' % (max_results, len(search_ids)))
+    if not search_ids:
+        return
+
+    # Use the same generation of each database for both the keys and the cache
+    databases = [get_redis_database(entry_id) for entry_id in search_ids]
+    generations = {database: get_current_generation(database) for database in set(databases) - {"uploaded"}}
+    entry_keys = [locate_entry(entry_id, generation=generations.get(database))
+                  for entry_id, database in zip(search_ids, databases)]
+    cached_entries = {}
+    rendered_entries = {}
+    round_trips = 0
 
-    # Get the connection to redis if needed
     with RedisConnection() as r_conn:
+        pipe = r_conn.pipeline(transaction=False)
+
+        # Update the expiration time of any uploaded entries which are used (this is a no-op for missing keys)
+        for entry_key in entry_keys:
+            if entry_key.startswith("uploaded:"):
+                pipe.expire(entry_key, configuration['redis']['upload_timeout'])
+
+        # Figure out which entries are already parsed in the cache, and still current
+        if format_ == "object":
+            for entry_id, database in zip(search_ids, databases):
+                cached_entry = entry_cache.get(entry_id, generations.get(database))
+                if cached_entry is not None:
+                    cached_entries[entry_id] = cached_entry
+
+        # Entries loaded by an older reloader won't have the NMR-STAR available, so fall back to the JSON for those
+        elif format_ == "nmrstar" or format_ == "rawnmrstar":
+            pipe.mget([locate_entry(entry_id, key_type="entry_star", generation=generations.get(database))
+                       for entry_id, database in zip(search_ids, databases)])
+            for entry_id, rendered_entry in zip(search_ids, pipe.execute()[-1]):
+                if rendered_entry is not None:
+                    rendered_entries[entry_id] = rendered_entry
+            round_trips += 1
+            pipe = r_conn.pipeline(transaction=False)
+
+        # Fetch all of the remaining entries at once
+        to_fetch = [entry_key for entry_id, entry_key in zip(search_ids, entry_keys)
+                    if entry_id not in cached_entries and entry_id not in rendered_entries]
+        fetched = {}
+        if to_fetch:
+            pipe.mget(to_fetch)
+            fetched = dict(zip(to_fetch, pipe.execute()[-1]))
+            round_trips += 1
+    logging.debug("Fetched %d entries (%d cached, %d pre-rendered) from Redis using %d round trip(s).",
+                  len(search_ids), len(cached_entries), len(rendered_entries), round_trips)
+
+    # Go through the IDs
+    for entry_id, entry_key, database in zip(search_ids, entry_keys, databases):
+        if entry_id in cached_entries:
+            yield entry_id, cached_entries[entry_id]
+            continue
+        if entry_id in rendered_entries:
+            yield entry_id, decompress(rendered_entries[entry_id]).decode()
+            continue
+
+        entry = fetched[entry_key]
+        if entry is None:
+            raise RequestException("Entry '%s' does not exist in the public database." % entry_id, status_code=404)
+
+        if format_ == "object":
+            yield entry_id, parse_entry(entry_id, entry, generations.get(database))
+        else:
+            yield entry_id, convert_entry_format(entry, format_)
 
-        # Go through the IDs
-        for entry_id in search_ids:
 
-            entry = r_conn.get(locate_entry(entry_id, r_conn=r_conn))
+def get_entry_from_redis(entry_id: str, format_: Optional[str] = None, meta_fields: List[str] = None) -> \
+        Tuple[Union[None, bytes, str, dict, pynmrstar.Entry], Dict[str, Optional[str]]]:
+    """ Returns a single entry in the given format (see get_valid_entries_from_redis() for the list of valid formats)
+    along with the requested fields of the metadata stored with it when it was loaded. Raises a 404 RequestException
+    if the entry doesn't exist.
 
-            # See if it is in redis
-            if entry:
-                # Return the compressed entry
-                if format_ == "zlib":
-                    yield entry_id, entry
+    If no format is specified, the entry itself isn't fetched, which is a cheap way to check that an entry exists
+    and to get its metadata. The existence check, the metadata and the entry are all fetched in a single round trip.
+    The exceptions are a parsed entry which isn't cached, and the text formats of an entry which was loaded without
+    pre-rendered NMR-STAR, which each take one more. Entries returned as objects are shared and must not be
+    modified."""
 
-                else:
-                    # Uncompress the zlib into serialized JSON
-                    entry = zlib.decompress(entry)
-                    if format_ == "json":
-                        yield entry_id, entry
-                    else:
-                        # Parse the JSON into python dict
-                        entry = json.loads(entry)
-                        if format_ == "dict":
-                            yield entry_id, entry
-                        else:
-                            # Parse the dict into object
-                            entry = pynmrstar.Entry.from_json(entry)
-                            if format_ == "object":
-                                yield entry_id, entry
-                            else:
-                                # Return NMR-STAR
-                                if format_ == "nmrstar" or format_ == "rawnmrstar":
-                                    yield entry_id, str(entry)
-
-                                # Unknown format
-                                else:
-                                    raise RequestException("Invalid format: %s." % format_)
+    meta_fields = meta_fields or []
+    database = get_redis_database(entry_id)
+    generation = get_current_generation(database) if database != "uploaded" else None
+    entry_key = locate_entry(entry_id, generation=generation)
+
+    with RedisConnection() as r_conn:
+        pipe = r_conn.pipeline(transaction=False)
+
+        # Update the expiration time if this is an uploaded entry
+        locate_entry(entry_id, r_conn=pipe)
+
+        if format_ is None:
+            pipe.exists(entry_key)
+        elif format_ == "object":
+            pipe.exists(entry_key)
+        elif format_ == "nmrstar" or format_ == "rawnmrstar":
+            pipe.exists(entry_key)
+            pipe.get(locate_entry(entry_id, key_type="entry_star", generation=generation))
+        else:
+            pipe.get(entry_key)
+        if meta_fields:
+            pipe.hmget(locate_entry(entry_id, key_type="entry_meta", generation=generation), meta_fields)
+
+        results = pipe.execute()
+        meta = dict(zip(meta_fields, results.pop() if meta_fields else []))
+        meta = {field: value.decode() if value is not None else None for field, value in meta.items()}
+
+        # Figure out if the entry exists and if we already have it
+        entry = None
+        if format_ is None:
+            exists = results[-1]
+        elif format_ == "object":
+            exists = results[-1]
+            entry = entry_cache.get(entry_id, generation)
+            if exists and entry is None:
+                entry = parse_entry(entry_id, r_conn.get(entry_key), generation)
+        elif format_ == "nmrstar" or format_ == "rawnmrstar":
+            exists, entry = results[-2:]
+            if entry is not None:
+                entry = decompress(entry).decode()
+            elif exists:
+                entry = convert_entry_format(r_conn.get(entry_key), format_)
+        else:
+            exists = results[-1] is not None
+            if exists:
+                entry = convert_entry_format(results[-1], format_)
+
+    if not exists:
+        raise RequestException("Entry '%s' does not exist in the public database." % entry_id, status_code=404)
+    return entry, meta
+
+
+def get_entries_meta_from_redis(entry_ids: List[str], meta_fields: List[str]) -> \
+        Dict[str, Optional[Dict[str, Optional[str]]]]:
+    """ Returns the requested fields of the metadata stored with each of the entries when they were loaded, or None
+    for the entries which don't exist. Everything is fetched in a single round trip. """
+
+    if not entry_ids:
+        return {}
+
+    databases = [get_redis_database(entry_id) for entry_id in entry_ids]
+    generations = {database: get_current_generation(database) for database in set(databases) - {"uploaded"}}
+
+    with RedisConnection() as r_conn:
+        pipe = r_conn.pipeline(transaction=False)
+        for entry_id, database in zip(entry_ids, databases):
+            pipe.exists(locate_entry(entry_id, generation=generations.get(database)))
+            pipe.hmget(locate_entry(entry_id, key_type="entry_meta", generation=generations.get(database)),
+                       meta_fields)
+        results = pipe.execute()
+
+    metas = {}
+    for entry_id, exists, meta in zip(entry_ids, results[0::2], results[1::2]):
+        if not exists:
+            metas[entry_id] = None
+        else:
+            metas[entry_id] = {field: value.decode() if value is not None else None
+                               for field, value in zip(meta_fields, meta)}
+    return metas
+
+
+def get_partial_entry_from_redis(entry_id: str, saveframe_names: List[str] = None,
+                                 saveframe_categories: List[str] = None,
+                                 loop_categories: List[str] = None) -> pynmrstar.Entry:
+    """ Returns an entry containing the saveframes with the given names, the saveframes of the
+    given categories, and the saveframes which contain loops of the given categories.
+
+    If the entry was stored with each saveframe separately, only those saveframes are fetched
+    and parsed. Otherwise the full entry is returned. Either way, the result must not be modified."""
+
+    with RedisConnection() as r_conn:
+        index = r_conn.get(locate_entry(entry_id, key_type="entry_index"))
+
+        if index is not None:
+            index = json.loads(decompress(index))
+            to_fetch = set(saveframe_names or []).intersection(index['frames'])
+            for saveframe_category in saveframe_categories or []:
+                to_fetch.update(index['categories'].get(saveframe_category, []))
+            for loop_category in loop_categories or []:
+                to_fetch.update(index['loops'].get(pynmrstar.utils.format_category(loop_category).lower(), []))
+
+            # Keep the saveframes in the order they appear in the entry
+            to_fetch = [x for x in index['frames'] if x in to_fetch]
+            saveframes = r_conn.hmget(locate_entry(entry_id, key_type="entry_frames"), to_fetch) if to_fetch else []
+
+    # Not stored with the saveframes separated
+    if index is None:
+        return get_entry_from_redis(entry_id, format_="object")[0]
+
+    entry = pynmrstar.Entry.from_scratch(entry_id)
+    for saveframe in saveframes:
+        if saveframe is not None:
+            entry.add_saveframe(pynmrstar.Saveframe.from_json(json.loads(decompress(saveframe))))
+    return entry
+
+
+def get_citation_record(entry: pynmrstar.Entry) -> dict:
+    """ Returns the information needed to cite the entry: its title, authors, release history, and the entry
+    citation. This is stored with the entry when it is loaded. """
+
+    def get_tag(saveframe, tag):
+        tag = saveframe.get_tag(tag)
+        if not tag:
+            return ""
+        else:
+            return tag[0]
+
+    record = {'authors': [], 'citations': [], 'citation_title': '', 'citation_journal': '',
+              'citation_volume_issue': '', 'citation_pagination': '', 'citation_year': ''}
+
+    for citation_frame in entry.get_saveframes_by_category("citations"):
+        if get_tag(citation_frame, "Class") == "entry citation":
+            cl = citation_frame["_Citation_author"]
+
+            # Get the journal information
+            record['citation_journal'] = get_tag(citation_frame, "Journal_abbrev")
+            issue = get_tag(citation_frame, "Journal_issue")
+            if issue and issue != ".":
+                issue = "(%s)" % issue
             else:
-                raise RequestException("Entry '%s' does not exist in the public database." % entry_id, status_code=404)
+                issue = ""
+            volume = get_tag(citation_frame, "Journal_volume")
+            if not volume or volume == ".":
+                volume = ""
+            record['citation_volume_issue'] = "%s%s" % (volume, issue)
+            record['citation_year'] = get_tag(citation_frame, "Year")
+            record['citation_pagination'] = "%s-%s" % (get_tag(citation_frame, "Page_first"),
+                                                       get_tag(citation_frame, "Page_last"))
+            record['citation_title'] = get_tag(citation_frame, "Title").strip()
+
+            # Authors
+            for row in cl.get_tag(["Given_name", "Family_name", "Middle_initials"]):
+                auth = {"@type": "Person", "givenName": row[0], "familyName": row[1]}
+                if row[2] != ".":
+                    auth["additionalName"] = row[2]
+                record['authors'].append(auth)
+
+            # Citations
+            doi = get_tag(citation_frame, "DOI")
+            if doi and doi != ".":
+                record['citations'].append({"@type": "ScholarlyArticle",
+                                            "@id": "https://doi.org/" + doi,
+                                            "headline": get_tag(citation_frame, "Title"),
+                                            "datePublished": get_tag(citation_frame, "Year")})
+
+    # Figure out last update day, version, and original release
+    orig_release, last_update, version = None, None, 1
+    for row in entry.get_loops_by_category("Release")[0].get_tag(["Release_number", "Date"]):
+        if row[0] == "1":
+            orig_release = row[1]
+        if int(row[0]) >= version:
+            last_update = row[1]
+            version = int(row[0])
+    record.update({'orig_release': orig_release, 'last_update': last_update, 'version': version})
+
+    # Title
+    record['title'] = entry.get_tag("Entry.Title")[0].rstrip()
+
+    return record
+
+
+def get_extra_data_summary(entry: pynmrstar.Entry) -> List[dict]:
+    """ Returns the types of data in the entry other than the assigned chemical shifts, along with the number of
+    data sets and the names of the saveframes of each type. This is stored with the entry when it is loaded. """
+
+    summary = []
+    for data_set_loop in entry.get_loops_by_category("Data_set")[:1]:
+        try:
+            data_sets = data_set_loop.get_tag(["Type", "Count"])
+        except ValueError:
+            return summary
+
+        for data_type, count in data_sets:
+            if data_type == "assigned_chemical_shifts":
+                continue
+            try:
+                count = int(count)
+            except (TypeError, ValueError):
+                count = None
+            summary.append({'data_type': dictionary_cache.get_category_description(data_type),
+                            'data_sets': count,
+                            'data_sfcategory': data_type,
+                            'saveframes': [x.name for x in entry.get_saveframes_by_category(data_type)]})
+
+    return summary
 
 
 def wrap_it_up(item: all) -> AsIs:
@@ -269,7 +605,7 @@ def create_chemcomp_from_db(chemcomp: str) -> pynmrstar.Entry:
     # This is specifically omitted... long story
     try:
         del entity_frame['_Entity_atom_list']
-    except KeyError:
+    except (KeyError, ValueError):
         pass
 
     ent.add_saveframe(entity_frame)
@@ -281,7 +617,8 @@ def create_chemcomp_from_db(chemcomp: str) -> pynmrstar.Entry:
 def get_entry_id_tag(tag_or_category: str, database: str = "macromolecules") -> str:
     """ Returns the tag that contains the logical Entry ID. This isn't always the Entry_ID tag.
 
-    You should always provide a Postgres cursor if you've already opened one."""
+    The tag is looked up in the dictionary cache, so this doesn't query Postgres (other than to reload the cache when
+    the dictionary changes)."""
 
     # Determine if this is a fully qualified tag or just the category
     try:
@@ -305,50 +642,17 @@ def get_entry_id_tag(tag_or_category: str, database: str = "macromolecules") ->
         except KeyError:
             raise ServerException("Unknown ID tag for tag: %s" % tag_or_category)
 
-    with PostgresConnection() as cur:
-        cur.execute("""
-SELECT tagfield
-  FROM dict.adit_item_tbl
-  WHERE entryidflg='Y' AND lower(tagcategory)=lower(%s);""", [tag_category])
-
-        try:
-            return cur.fetchone()[0]
-        except TypeError:
-            raise RequestException("Invalid tag queried, unable to determine entryidflag.")
+    id_tag = dictionary_cache.get_entry_id_tag(tag_category)
+    if id_tag is None:
+        raise RequestException("Invalid tag queried, unable to determine entryidflag.")
+    return id_tag
 
 
-def get_printable_tags(category: str, cur: DictCursor) -> Tuple[List[str], List[str]]:
+def get_printable_tags(category: str) -> Tuple[List[str], List[str]]:
     """ Returns a list of the tags that should be printed for the given
     category and a list of tags that are pointers."""
 
-    # Figure out the loop tags
-    cur.execute('''SELECT a.tagfield,a.internalflag,p.printflag,a.dictionaryseq,a.sfpointerflg
-                FROM dict.adit_item_tbl a JOIN dict.validator_printflags p ON p.dictionaryseq = a.dictionaryseq
-                WHERE tagcategory=%(loop_name)s ORDER BY dictionaryseq''',
-                {"loop_name": category})
-
-    tags_to_use = []
-    pointer_tags = []
-
-    # Figure out which tags to print
-    for row in cur:
-        # See if the tag is a pointer
-        if row[4] == "Y":
-            pointer_tags.append(row[0])
-
-        # Make sure it isn't internal and it should be printed
-        if row[1] != "Y":
-            # Make sure it should be printed
-            if row[2] == "Y" or row[2] == "O":
-                tags_to_use.append(row[0])
-            else:
-                if configuration['debug']:
-                    print("Skipping no print tag: %s" % row[0])
-        else:
-            if configuration['debug']:
-                print("Skipping private tag: %s" % row[0])
-
-    return tags_to_use, pointer_tags
+    return dictionary_cache.get_printable_tags(category)
 
 
 def create_saveframe_from_db(database: str, category: str, entry_id: str, id_search_field: str,
@@ -361,24 +665,11 @@ def create_saveframe_from_db(database: str, category: str, entry_id: str, id_sea
     You can optionally pass a cursor to reuse an existing postgresql
     connection."""
 
-    # Look up information about the tags to use later
-    # cur.execute('''SELECT adit_item_tbl.originaltag,adit_item_tbl.internalflag,
-    # printflag,adit_item_tbl.dictionaryseq,rowindexflg FROM dict.adit_item_tbl,
-    # dict.adit_item_tbl WHERE adit_item_tbl.originaltag=
-    # adit_item_tbl.originaltag''')
-
-    # Get the list of which tags should be used to order data
-    cur.execute('''SELECT originaltag,rowindexflg from dict.adit_item_tbl''')
-    tag_order = {x[0]: x[1] for x in cur.fetchall()}
-
     # Set the search path
     cur.execute('''SET search_path=%(path)s, pg_catalog;''', {'path': database})
 
     # Check if we are allowed to print it
-    cur.execute('''SELECT internalflag,printflag FROM dict.cat_grp
-                WHERE sfcategory=%(sf_cat)s ORDER BY groupid''',
-                {'sf_cat': category})
-    internalflag, printflag = cur.fetchone()
+    internalflag, printflag = dictionary_cache.get_category_flags(category)
 
     # Sorry, we won't print internal saveframes
     if internalflag == "Y":
@@ -391,11 +682,8 @@ def create_saveframe_from_db(database: str, category: str, entry_id: str, id_sea
                         "%s.%s", database, category)
         return None
 
-    # Get table name from category name
-    cur.execute("""SELECT DISTINCT tagcategory FROM dict.adit_item_tbl
-                WHERE originalcategory=%(category)s AND loopflag<>'Y'""",
-                {"category": category})
-    table_name = cur.fetchone()[0]
+    # Get table name from category name, and the loops we might need to insert
+    table_name, loops = dictionary_cache.get_category_tables(category)
 
     logging.debug("Will look in table: %s", table_name)
 
@@ -415,70 +703,29 @@ def create_saveframe_from_db(database: str, category: str, entry_id: str, id_sea
     built_frame = pynmrstar.Saveframe.from_scratch(sf_framecode)
     built_frame.tag_prefix = "_" + table_name
 
-    # Figure out which tags to display
-    tags_to_use, pointer_tags = get_printable_tags(table_name, cur)
-
     # Get the tag values
     cur.execute('''SELECT * FROM %(table_name)s WHERE "Sf_ID"=%(sf_id)s''',
                 {'sf_id': sf_id, 'table_name': wrap_it_up(table_name)})
-    tag_vals = cur.fetchone()
-
-    # Add the tags, and optionally add $ if the tag is a pointer
-    for pos, tag in enumerate(cur.description):
-        if tag.name in tags_to_use:
-            if tag.name in pointer_tags:
-                built_frame.add_tag(tag.name, "$" + tag_vals[pos])
-            else:
-                built_frame.add_tag(tag.name, tag_vals[pos])
-
-    # Figure out which loops we might need to insert
-    cur.execute('''SELECT tagcategory,min(dictionaryseq) AS seq FROM dict.adit_item_tbl
-                WHERE originalcategory=%(category)s GROUP BY tagcategory ORDER BY seq''',
-                {'category': category})
-
-    # The first result is the saveframe, so drop it
-    cur.fetchone()
-
-    # Figure out which loops we might need to add
-    loops = [x[0] for x in cur.fetchall()]
+    add_saveframe_tags(built_frame, table_name, [x.name for x in cur.description], cur.fetchone())
 
     # Add the loops
     for each_loop in loops:
 
         logging.debug("Doing loop: %s", each_loop)
 
-        tags_to_use, pointer_tags = get_printable_tags(each_loop, cur)
+        tags_to_use = get_printable_tags(each_loop)[0]
 
         # If there are any tags in the loop to use
         if len(tags_to_use) > 0:
-            # Create the loop
-            bmrb_loop = pynmrstar.Loop.from_scratch(category=each_loop)
-            bmrb_loop.add_tag(tags_to_use)
-
             # Get the loop data
             to_fetch = ",".join(['"' + x + '"' for x in tags_to_use])
             query = 'SELECT ' + to_fetch
             query += ' FROM %(table_name)s WHERE "Sf_ID" = %(id)s'
 
             # Determine how to order the data in the loops
-            order_tags = []
-            for tag in tags_to_use:
-                if tag_order["_" + each_loop + "." + tag] == "Y":
-                    order_tags.append(tag)
-                    if configuration['debug']:
-                        print("Ordering loop %s by %s." % (each_loop, tag))
-            if len(order_tags) > 0:
-                query += ' ORDER BY %s' % '"' + '","'.join(order_tags) + '"'
-            else:
-                if configuration['debug']:
-                    print("No order in loop: %s" % each_loop)
-                # If no explicit order, look for an "ordinal" tag
-                for tag in tags_to_use:
-                    if "ordinal" in tag or "Ordinal" in tag:
-                        if configuration['debug']:
-                            print("Found tag to order by (ordinal): %s" % tag)
-                        query += ' ORDER BY "%s"' % tag
-                        break
+            order_tags = get_loop_order(each_loop, tags_to_use)
+            if order_tags:
+                query += ' ORDER BY "' + '","'.join(order_tags) + '"'
 
             # Perform the query
             cur.execute(query, {"id": sf_id,
@@ -486,22 +733,76 @@ def create_saveframe_from_db(database: str, category: str, entry_id: str, id_sea
             if configuration['debug']:
                 print(cur.query)
 
-            # Add the data
-            for row in cur:
+            bmrb_loop = build_loop(each_loop, cur)
+            if bmrb_loop is not None:
+                built_frame.add_loop(bmrb_loop)
 
-                # Make sure to add the "$" if this is a sf_pointer
-                row = list(row)
-                for pos, tag in enumerate(tags_to_use):
-                    if tag in pointer_tags:
-                        row[pos] = "$" + row[pos]
+    return built_frame
 
-                # Add the data
-                bmrb_loop.add_data(row)
 
-            if bmrb_loop.data:
-                built_frame.add_loop(bmrb_loop)
+def get_loop_order(loop_category: str, tags_to_use: List[str]) -> List[str]:
+    """ Returns the tags to order the rows of the loop by. Those are the row index tags, or if there are none,
+    the first tag which is an ordinal. """
 
-    return built_frame
+    order_tags = []
+    for tag in tags_to_use:
+        if dictionary_cache.is_row_index("_" + loop_category + "." + tag):
+            order_tags.append(tag)
+            if configuration['debug']:
+                print("Ordering loop %s by %s." % (loop_category, tag))
+    if len(order_tags) > 0:
+        return order_tags
+
+    if configuration['debug']:
+        print("No order in loop: %s" % loop_category)
+    # If no explicit order, look for an "ordinal" tag
+    for tag in tags_to_use:
+        if "ordinal" in tag or "Ordinal" in tag:
+            if configuration['debug']:
+                print("Found tag to order by (ordinal): %s" % tag)
+            return [tag]
+    return []
+
+
+def add_saveframe_tags(built_frame: pynmrstar.Saveframe, table_name: str, tag_names: List[str], tag_vals) -> None:
+    """ Adds the printable tags of a row of the saveframe table to the saveframe. """
+
+    tags_to_use, pointer_tags = get_printable_tags(table_name)
+
+    # Add the tags, and optionally add $ if the tag is a pointer
+    for pos, tag in enumerate(tag_names):
+        if tag in tags_to_use:
+            if tag in pointer_tags:
+                built_frame.add_tag(tag, "$" + tag_vals[pos])
+            else:
+                built_frame.add_tag(tag, tag_vals[pos])
+
+
+def build_loop(loop_category: str, rows) -> Optional[pynmrstar.Loop]:
+    """ Builds a loop from the rows of its table, which must contain the printable tags of the loop in order.
+    Returns None if the loop would be empty. """
+
+    tags_to_use, pointer_tags = get_printable_tags(loop_category)
+
+    # Create the loop
+    bmrb_loop = pynmrstar.Loop.from_scratch(category=loop_category)
+    bmrb_loop.add_tag(tags_to_use)
+
+    # Add the data
+    for row in rows:
+
+        # Make sure to add the "$" if this is a sf_pointer
+        row = list(row)
+        for pos, tag in enumerate(tags_to_use):
+            if tag in pointer_tags:
+                row[pos] = "$" + row[pos]
+
+        # Add the data
+        bmrb_loop.add_data(row)
+
+    if not bmrb_loop.data:
+        return None
+    return bmrb_loop
 
 
 def create_combined_view() -> None:
@@ -563,6 +864,44 @@ def create_combined_view() -> None:
         psql.commit()
 
 
+def get_database_status() -> dict:
+    """ Returns the status of each database: its number of entries and chemical shifts, and when it was last
+    updated. """
+
+    stats = {}
+    with RedisConnection() as r:
+        pipe = r.pipeline(transaction=False)
+        for key in ['metabolomics', 'macromolecules', 'chemcomps', 'combined']:
+            pipe.hgetall("%s:meta" % key)
+        for key, meta in zip(['metabolomics', 'macromolecules', 'chemcomps', 'combined'], pipe.execute()):
+            stats[key] = {}
+            for k, v in meta.items():
+                k = k.decode()
+                if k == "update_time":
+                    stats[key][k] = float(v)
+                else:
+                    stats[key][k] = int(v)
+
+    with PostgresConnection() as pg:
+        pg.execute('''SELECT relnamespace::regnamespace::text, reltuples FROM pg_class
+  WHERE oid IN ('metabolomics."Atom_chem_shift"'::regclass, 'macromolecules."Atom_chem_shift"'::regclass);''')
+        for row in pg.fetchall():
+            stats[row[0]]['num_chemical_shifts'] = int(row[1])
+
+    return stats
+
+
+def store_status_snapshot() -> dict:
+    """ Stores the status of the databases in Redis, so that it can be served without querying them. Returns the
+    stored status. """
+
+    stats = get_database_status()
+    stats['snapshot_time'] = time.time()
+    with RedisConnection() as r:
+        r.set("status:snapshot", json.dumps(stats))
+    return stats
+
+
 # Helper methods
 def get_db(default: str = "macromolecules", valid_list: List[str] = None) -> str:
     """ Make sure the DB specified is valid. """
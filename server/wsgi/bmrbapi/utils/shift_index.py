@@ -0,0 +1,473 @@
+""" Indexes of chemical shifts held in memory as sorted NumPy arrays, so that shift and peak searches can be answered
+without scanning the shift tables in Postgres.
+
+The reloader builds each index from Postgres and stores it in Redis, compressing each array into its own field of a
+hash so that no single value is too large to replicate or fetch. The first process on each API server to notice a
+new version of an index writes its arrays to local disk, and every process on the server then memory maps the same
+files, so an index is only held in memory once per server no matter how many workers there are. """
+
+import functools
+import io
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+import zlib
+from decimal import Decimal
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+import simplejson as json
+
+from bmrbapi.exceptions import ServerException
+from bmrbapi.utils.configuration import configuration
+from bmrbapi.utils.connections import PostgresConnection, RedisConnection
+
+atom_types = ['C', 'N', 'H']
+atom_types_sorted = sorted(atom_types)
+# The nuclei which can be paired with the protons in a 2D peak
+peak_nuclei = ['N', 'C']
+# The lower bound, width, and number of the cells of the peak grid in the H dimension, and then in the other dimension.
+# Shifts outside of the grid are put in the cells on its edges.
+peak_grid = [-2.0, 0.1, 200, 0.0, 1.0, 256]
+
+
+class ArrayStore:
+    """ Shares a set of named NumPy arrays, built by the reloader, with every API process. """
+
+    def __init__(self, name: str, builder: Callable[[object], Dict[str, np.ndarray]]):
+        self.name = name
+        self.key = "index:%s" % name
+        # Builds the arrays using the provided cursor
+        self.builder = builder
+        self.loads = 0
+        self._arrays: Optional[Dict[str, np.ndarray]] = None
+        self._generation: Optional[str] = None
+        self._loaded = 0
+        self._checked = 0
+        self._lock = threading.Lock()
+
+    def rebuild(self) -> str:
+        """ Builds the arrays from the database and stores them in Redis as a new generation of the index. Returns the
+        new generation.
+
+        Each array is stored compressed in its own "<generation>:<array>" field, along with the list of the arrays,
+        before the generation is published. The fields of the previous generation are kept, as processes may still
+        be fetching them, and older ones are deleted. """
+
+        with PostgresConnection() as cur:
+            arrays = self.builder(cur)
+
+        with RedisConnection() as r_conn:
+            # Continue numbering from the published generation, in case it was stored without the counter
+            previous = r_conn.hget(self.key, 'generation')
+            r_conn.hsetnx(self.key, 'last_generation', previous or 0)
+            generation = str(r_conn.hincrby(self.key, 'last_generation', 1))
+
+            sizes = {}
+            for array_name, array in arrays.items():
+                buffer = io.BytesIO()
+                np.save(buffer, array, allow_pickle=False)
+                data = zlib.compress(buffer.getvalue())
+                r_conn.hset(self.key, '%s:%s' % (generation, array_name), data)
+                sizes[array_name] = len(data)
+            r_conn.hset(self.key, '%s:arrays' % generation, json.dumps(sorted(arrays)))
+            r_conn.hset(self.key, 'generation', generation)
+
+            keep = [b'generation', b'last_generation']
+            stale = [field for field in r_conn.hkeys(self.key)
+                     if field not in keep and field.split(b':')[0] not in [generation.encode(), previous]]
+            if stale:
+                r_conn.hdel(self.key, *stale)
+
+        largest = max(sizes, key=sizes.get)
+        logging.info("Stored generation %s of the %s index (%d bytes compressed, the largest array being %s with %d "
+                     "bytes).", generation, self.name, sum(sizes.values()), largest, sizes[largest])
+        return generation
+
+    @property
+    def arrays(self) -> Dict[str, np.ndarray]:
+        """ Returns the current version of the arrays, loading them first if needed. """
+
+        arrays = self._arrays
+        if arrays is not None and time.time() - self._checked < configuration.get('generation_cache_seconds', 2):
+            return arrays
+
+        with self._lock:
+            # Another thread may have just refreshed them
+            if self._arrays is not None and \
+                    time.time() - self._checked < configuration.get('generation_cache_seconds', 2):
+                return self._arrays
+
+            with RedisConnection() as r_conn:
+                generation = r_conn.hget(self.key, 'generation')
+                generation = generation.decode() if generation is not None else None
+
+                if generation is None:
+                    # Only build it once, rather than every time we check
+                    if self._arrays is None or self._generation is not None:
+                        logging.warning("The %s index hasn't been stored by the reloader, so building it from the "
+                                        "database.", self.name)
+                        with PostgresConnection() as cur:
+                            self._arrays = self.builder(cur)
+                        self._generation = None
+                        self._loaded = time.time()
+                        self.loads += 1
+                elif generation != self._generation:
+                    directory = self._get_directory(generation)
+                    if not os.path.isdir(directory):
+                        directory = self._write_directory(r_conn, generation)
+                    if directory is not None:
+                        self._arrays = {file_name[:-4]: np.load(os.path.join(directory, file_name), mmap_mode='r')
+                                        for file_name in os.listdir(directory)}
+                        self._generation = generation
+                        self._loaded = time.time()
+                        self.loads += 1
+                        logging.info("Loaded generation %s of the %s index.", generation, self.name)
+                    elif self._arrays is None:
+                        raise ServerException("The %s index is being rebuilt. Please try again." % self.name)
+                    else:
+                        logging.warning("Generation %s of the %s index was replaced while it was being loaded.",
+                                        generation, self.name)
+
+            self._checked = time.time()
+            return self._arrays
+
+    def _get_directory(self, generation: str) -> str:
+        """ Returns the directory the arrays of the given generation are stored in on this server. """
+
+        return os.path.join(configuration.get('index_directory', tempfile.gettempdir()),
+                            'bmrbapi_%s_%s' % (self.name, generation))
+
+    def _write_directory(self, r_conn, generation: str) -> Optional[str]:
+        """ Fetches the arrays of the given generation from Redis one at a time, and writes them to disk, one file per
+        array, so that they can be memory mapped. Returns the directory they were written to, or None if the
+        generation has since been deleted. """
+
+        array_names = r_conn.hget(self.key, '%s:arrays' % generation)
+        if array_names is None:
+            return None
+
+        directory = self._get_directory(generation)
+        parent = os.path.dirname(directory)
+        temp_directory = tempfile.mkdtemp(prefix='.bmrbapi_%s_' % self.name, dir=parent)
+        for array_name in json.loads(array_names):
+            data = r_conn.hget(self.key, '%s:%s' % (generation, array_name))
+            if data is None:
+                shutil.rmtree(temp_directory, ignore_errors=True)
+                return None
+            # The fields hold the arrays in the .npy format
+            with open(os.path.join(temp_directory, array_name + '.npy'), 'wb') as array_file:
+                array_file.write(zlib.decompress(data))
+
+        try:
+            os.rename(temp_directory, directory)
+        except OSError:
+            # Another process on this server already wrote them
+            shutil.rmtree(temp_directory, ignore_errors=True)
+            return directory
+
+        # Remove the previous generations. Processes which still have them mapped keep their copy until they reload.
+        for file_name in os.listdir(parent):
+            path = os.path.join(parent, file_name)
+            if file_name.startswith('bmrbapi_%s_' % self.name) and path != directory:
+                shutil.rmtree(path, ignore_errors=True)
+        return directory
+
+    def stats(self) -> dict:
+        """ Returns the state of the index in this process. """
+
+        if self._arrays is None:
+            return {'loaded': False, 'loads': self.loads}
+        return {'loaded': True, 'loads': self.loads, 'generation': self._generation,
+                'age': time.time() - self._loaded}
+
+
+def get_groups(cur, rows: List[tuple]) -> Tuple[Dict[Tuple[str, str], int], Dict[str, np.ndarray]]:
+    """ Returns the position of each shift list which the rows of shifts (which start with the Entry_ID and the
+    Assigned_chem_shift_list_ID) belong to, and the entry_ids, list_ids, titles, and links arrays describing them. """
+
+    group_keys = sorted(set((row[0], row[1]) for row in rows))
+    cur.execute('''SELECT id, title, link FROM web.instant_cache WHERE id = ANY(%s)''',
+                [sorted(set(key[0] for key in group_keys))])
+    entry_info = {row[0]: (row[1] or '', row[2] or '') for row in cur.fetchall()}
+
+    group_positions = {key: position for position, key in enumerate(group_keys)}
+    group_info = {'entry_ids': np.array([key[0] for key in group_keys], dtype=str),
+                  'list_ids': np.array([key[1] for key in group_keys], dtype=str),
+                  'titles': np.array([entry_info.get(key[0], ('', ''))[0] for key in group_keys], dtype=str),
+                  'links': np.array([entry_info.get(key[0], ('', ''))[1] for key in group_keys], dtype=str)}
+    return group_positions, group_info
+
+
+def build_metabolomics_shift_index(cur) -> Dict[str, np.ndarray]:
+    """ Builds the index of the metabolomics C, N, and H shifts using the provided cursor.
+
+    Each assigned chemical shift list is a group, described by the entry_ids, list_ids, titles, and links arrays. For
+    each atom type, the <type>_values array holds the distinct shifts of each group sorted by value, <type>_groups the
+    group of each shift, and <type>_shifts the shift as it was deposited. """
+
+    cur.execute('''
+SELECT DISTINCT "Entry_ID", "Assigned_chem_shift_list_ID"::text, "Atom_type", "Val", val_float
+FROM metabolomics."Atom_chem_shift"
+WHERE "Atom_type" IN ('C', 'N', 'H') AND val_float IS NOT NULL
+ORDER BY val_float''')
+    rows = cur.fetchall()
+
+    group_positions, arrays = get_groups(cur, rows)
+
+    for atom_type in atom_types:
+        type_rows = [row for row in rows if row[2] == atom_type]
+        arrays['%s_values' % atom_type] = np.array([row[4] for row in type_rows], dtype=np.float64)
+        arrays['%s_groups' % atom_type] = np.array([group_positions[(row[0], row[1])] for row in type_rows],
+                                                   dtype=np.int64)
+        arrays['%s_shifts' % atom_type] = np.array([row[3] for row in type_rows], dtype=str)
+
+    return arrays
+
+
+def get_window_positions(values: np.ndarray, lows: np.ndarray, highs: np.ndarray) -> np.ndarray:
+    """ Returns the positions, in order, of the sorted values which fall within any of the (inclusive) windows. """
+
+    starts = np.searchsorted(values, lows, side='left')
+    counts = np.maximum(np.searchsorted(values, highs, side='right') - starts, 0)
+    # The position of each value in each window is the start of its window plus its offset within the window
+    offsets = np.repeat(starts - np.cumsum(counts) + counts, counts)
+    return np.unique(np.arange(counts.sum()) + offsets)
+
+
+def score_shift_matches(queried: np.ndarray, thresholds: Dict[str, float], groups: np.ndarray, values: np.ndarray,
+                        deposited: np.ndarray, types: np.ndarray, group_info: Dict[str, np.ndarray]) -> List[dict]:
+    """ Scores the shift lists with shifts which matched any of the queried shifts. groups, values, deposited, and types
+    describe each matched shift (see build_metabolomics_shift_index()), and group_info holds the entry_ids, list_ids,
+    titles, and links of the groups.
+
+    Returns the shift lists ordered by the number of queried shifts they matched, and then by the total distance from
+    their shifts to the closest queried shifts. """
+
+    if len(groups) == 0:
+        return []
+
+    # Order the matched shifts of each shift list as they are displayed
+    order = np.lexsort((np.char.add(np.char.add(deposited, ','), types), groups))
+    groups, values, deposited, types = groups[order], values[order], deposited[order], types[order]
+    type_thresholds = np.array([thresholds[x] for x in atom_types_sorted])[np.searchsorted(atom_types_sorted, types)]
+    matched_groups, starts = np.unique(groups, return_index=True)
+    ends = np.append(starts[1:], len(groups))
+
+    # The distance from each matched shift to each queried shift
+    distances = np.abs(values[:, None] - queried[None, :])
+    combined_offsets = np.add.reduceat(distances.min(axis=1), starts)
+
+    # A queried shift is matched if the closest shift in the list is within the threshold for its atom type. Allow for
+    # floating point error, so that a shift exactly at the threshold matches.
+    shifts_matched = np.zeros(len(matched_groups), dtype=np.int64)
+    for column in range(len(queried)):
+        closest = np.lexsort((distances[:, column], groups))[starts]
+        shifts_matched += distances[closest, column] <= type_thresholds[closest] + 1e-9
+
+    entry_ids = group_info['entry_ids'][matched_groups]
+    results = []
+    for position in np.lexsort((entry_ids, combined_offsets, -shifts_matched)):
+        group = matched_groups[position]
+        title = str(group_info['titles'][group]).replace("\n", "")
+        results.append({'Entry_ID': str(entry_ids[position]),
+                        'Assigned_chem_shift_list_ID': str(group_info['list_ids'][group]),
+                        'Title': title or None,
+                        'Link': str(group_info['links'][group]) or None,
+                        'Val': [{'Shift': Decimal(str(deposited[x])), 'Atom_type': str(types[x])}
+                                for x in range(starts[position], ends[position])],
+                        'Combined_offset': round(Decimal(repr(float(combined_offsets[position]))), 3),
+                        'Shifts_matched': int(shifts_matched[position])})
+
+    return results
+
+
+def search_metabolomics_shifts(shifts: List[float], thresholds: Dict[str, float]) -> List[dict]:
+    """ Finds the metabolomics shift lists which contain shifts within the threshold for their atom type of any of the
+    queried shifts, using the index. See score_shift_matches() for the order of the results. """
+
+    arrays = metabolomics_shift_index.arrays
+    queried = np.array(sorted(shifts), dtype=np.float64)
+
+    groups, values, deposited, types = [], [], [], []
+    for atom_type in atom_types:
+        positions = get_window_positions(arrays['%s_values' % atom_type], queried - thresholds[atom_type],
+                                         queried + thresholds[atom_type])
+        groups.append(arrays['%s_groups' % atom_type][positions])
+        values.append(arrays['%s_values' % atom_type][positions])
+        deposited.append(arrays['%s_shifts' % atom_type][positions])
+        types.append(np.full(len(positions), atom_type))
+
+    return score_shift_matches(queried, thresholds, np.concatenate(groups), np.concatenate(values),
+                               np.concatenate(deposited), np.concatenate(types), arrays)
+
+
+def search_database_shifts(cur, shifts: List[float], thresholds: Dict[str, float]) -> List[dict]:
+    """ Like search_metabolomics_shifts(), but finds the matching shifts by querying the schema the cursor uses. Used
+    for the databases which aren't indexed. """
+
+    queried = np.array(sorted(shifts), dtype=np.float64)
+    window_types = [atom_type for _ in queried for atom_type in atom_types]
+    window_lows = [shift - thresholds[atom_type] for shift in queried.tolist() for atom_type in atom_types]
+    window_highs = [shift + thresholds[atom_type] for shift in queried.tolist() for atom_type in atom_types]
+
+    cur.execute('''
+SELECT DISTINCT atom_shift."Entry_ID", atom_shift."Assigned_chem_shift_list_ID"::text, atom_shift."Atom_type",
+  atom_shift."Val", atom_shift.val_float
+FROM unnest(%s::text[], %s::float[], %s::float[]) AS windows(atom_type, range_low, range_high)
+JOIN "Atom_chem_shift" as atom_shift
+  ON atom_shift."Atom_type" = windows.atom_type
+    AND atom_shift.val_float >= windows.range_low AND atom_shift.val_float <= windows.range_high''',
+                [window_types, window_lows, window_highs])
+    rows = cur.fetchall()
+
+    group_positions, group_info = get_groups(cur, rows)
+    return score_shift_matches(queried, thresholds,
+                               np.array([group_positions[(row[0], row[1])] for row in rows], dtype=np.int64),
+                               np.array([row[4] for row in rows], dtype=np.float64),
+                               np.array([row[3] for row in rows], dtype=str),
+                               np.array([row[2] for row in rows], dtype=str), group_info)
+
+
+def build_peak_index(database: str, cur) -> Dict[str, np.ndarray]:
+    """ Builds the index of the 2D peaks of the database using the provided cursor. Each peak is a proton and the N or C
+    it is bonded to. For macromolecules the bonded atom is found by name within the residue, in the same way as
+    pybmrb.csviz pairs the atoms of an HSQC: HB2 is bonded to CB, HD21 to ND2, and so on. For metabolomics the bonds of
+    the chemical component are used, since the atom names don't say which atoms are bonded.
+
+    Each assigned chemical shift list is a group, described as in build_metabolomics_shift_index(). For each nucleus,
+    the <nucleus>_cells, <nucleus>_h, <nucleus>_x, and <nucleus>_groups arrays hold the peaks sorted by the cell of
+    peak_grid they are in. """
+
+    if database == 'macromolecules':
+        query = '''
+SELECT DISTINCT ON (h."Entry_ID", h."Assigned_chem_shift_list_ID", h."Entity_assembly_ID", h."Entity_ID",
+                    h."Comp_index_ID", h."Atom_ID")
+       h."Entry_ID", h."Assigned_chem_shift_list_ID"::text, h.val_float, x.val_float
+FROM macromolecules."Atom_chem_shift" AS h
+JOIN macromolecules."Atom_chem_shift" AS x
+  ON x."Entry_ID" = h."Entry_ID" AND x."Assigned_chem_shift_list_ID" = h."Assigned_chem_shift_list_ID"
+    AND x."Entity_assembly_ID" = h."Entity_assembly_ID" AND x."Entity_ID" = h."Entity_ID"
+    AND x."Comp_index_ID" = h."Comp_index_ID" AND x."Atom_type" = %(nucleus)s
+    AND x."Atom_ID" IN (%(nucleus)s || substr(h."Atom_ID", 2),
+                        %(nucleus)s || substr(h."Atom_ID", 2, length(h."Atom_ID") - 2))
+WHERE h."Atom_type" = 'H' AND h.val_float IS NOT NULL AND x.val_float IS NOT NULL
+  AND NOT (h."Atom_ID" = 'H' AND x."Atom_ID" = 'C')
+-- Prefer HD1 -> CD1 over HD1 -> CD
+ORDER BY h."Entry_ID", h."Assigned_chem_shift_list_ID", h."Entity_assembly_ID", h."Entity_ID", h."Comp_index_ID",
+         h."Atom_ID", length(x."Atom_ID") DESC'''
+    else:
+        query = '''
+SELECT DISTINCT h."Entry_ID", h."Assigned_chem_shift_list_ID"::text, h.val_float, x.val_float
+FROM metabolomics."Atom_chem_shift" AS h
+JOIN metabolomics."Chem_comp_bond" AS bond
+  ON bond."Entry_ID" = h."Entry_ID" AND bond."Comp_ID" = h."Comp_ID"
+    AND h."Atom_ID" IN (bond."Atom_ID_1", bond."Atom_ID_2")
+JOIN metabolomics."Atom_chem_shift" AS x
+  ON x."Entry_ID" = h."Entry_ID" AND x."Assigned_chem_shift_list_ID" = h."Assigned_chem_shift_list_ID"
+    AND x."Comp_ID" = h."Comp_ID" AND x."Atom_type" = %(nucleus)s
+    AND x."Atom_ID" IN (bond."Atom_ID_1", bond."Atom_ID_2") AND x."Atom_ID" != h."Atom_ID"
+WHERE h."Atom_type" = 'H' AND h.val_float IS NOT NULL AND x.val_float IS NOT NULL'''
+
+    peaks = {}
+    for nucleus in peak_nuclei:
+        cur.execute(query, {'nucleus': nucleus})
+        peaks[nucleus] = cur.fetchall()
+
+    group_positions, arrays = get_groups(cur, [row for nucleus in peak_nuclei for row in peaks[nucleus]])
+    arrays['grid'] = np.array(peak_grid, dtype=np.float64)
+
+    for nucleus in peak_nuclei:
+        h_shifts = np.array([row[2] for row in peaks[nucleus]], dtype=np.float64)
+        x_shifts = np.array([row[3] for row in peaks[nucleus]], dtype=np.float64)
+        groups = np.array([group_positions[(row[0], row[1])] for row in peaks[nucleus]], dtype=np.int32)
+        cells = get_peak_cells(arrays['grid'], h_shifts, x_shifts)
+        order = np.argsort(cells, kind='stable')
+        arrays['%s_cells' % nucleus] = cells[order]
+        arrays['%s_h' % nucleus] = h_shifts[order]
+        arrays['%s_x' % nucleus] = x_shifts[order]
+        arrays['%s_groups' % nucleus] = groups[order]
+
+    return arrays
+
+
+def get_peak_cells(grid: np.ndarray, h_shifts: np.ndarray, x_shifts: np.ndarray) -> np.ndarray:
+    """ Returns the cell of the grid each of the peaks falls in. """
+
+    h_min, h_width, h_cells, x_min, x_width, x_cells = grid
+    h_positions = np.clip(np.floor((h_shifts - h_min) / h_width), 0, h_cells - 1)
+    x_positions = np.clip(np.floor((x_shifts - x_min) / x_width), 0, x_cells - 1)
+    return (h_positions * x_cells + x_positions).astype(np.int32)
+
+
+def search_peaks(database: str, peaks: List[Tuple[float, float]], nucleus: str, h_threshold: float,
+                 x_threshold: float) -> List[dict]:
+    """ Finds the shift lists with a peak (a proton and the N or C it is bonded to) within the thresholds of any of the
+    queried peaks. Returns the shift lists ordered by the number of queried peaks they matched, and then by the total
+    distance from the queried peaks to their closest peaks, with each dimension scaled by its threshold. """
+
+    arrays = peak_indexes[database].arrays
+    grid = arrays['grid']
+    x_cells = int(grid[5])
+    cells, h_shifts, x_shifts = arrays['%s_cells' % nucleus], arrays['%s_h' % nucleus], arrays['%s_x' % nucleus]
+
+    groups, queried, distances, matched_h, matched_x = [], [], [], [], []
+    for peak_number, (h_shift, x_shift) in enumerate(peaks):
+        # The cells the window around the peak covers. In each row of the grid, they are a contiguous range.
+        low_cell, high_cell = get_peak_cells(grid, np.array([h_shift - h_threshold, h_shift + h_threshold]),
+                                             np.array([x_shift - x_threshold, x_shift + x_threshold]))
+        row_starts = np.arange(low_cell // x_cells, high_cell // x_cells + 1) * x_cells
+        positions = get_window_positions(cells, row_starts + low_cell % x_cells, row_starts + high_cell % x_cells)
+
+        h_offsets = (h_shifts[positions] - h_shift) / h_threshold
+        x_offsets = (x_shifts[positions] - x_shift) / x_threshold
+        within = (np.abs(h_offsets) <= 1) & (np.abs(x_offsets) <= 1)
+        positions = positions[within]
+        groups.append(arrays['%s_groups' % nucleus][positions])
+        queried.append(np.full(len(positions), peak_number))
+        distances.append(np.hypot(h_offsets[within], x_offsets[within]))
+        matched_h.append(h_shifts[positions])
+        matched_x.append(x_shifts[positions])
+    groups, queried, distances = np.concatenate(groups), np.concatenate(queried), np.concatenate(distances)
+    matched_h, matched_x = np.concatenate(matched_h), np.concatenate(matched_x)
+    if len(groups) == 0:
+        return []
+
+    # Only keep the closest peak of each shift list to each queried peak
+    order = np.lexsort((distances, queried, groups))
+    groups, queried, distances = groups[order], queried[order], distances[order]
+    matched_h, matched_x = matched_h[order], matched_x[order]
+    closest = np.ones(len(groups), dtype=bool)
+    closest[1:] = (groups[1:] != groups[:-1]) | (queried[1:] != queried[:-1])
+    groups, queried, distances = groups[closest], queried[closest], distances[closest]
+    matched_h, matched_x = matched_h[closest], matched_x[closest]
+
+    matched_groups, starts = np.unique(groups, return_index=True)
+    ends = np.append(starts[1:], len(groups))
+    combined_offsets = np.add.reduceat(distances, starts)
+    peaks_matched = ends - starts
+
+    entry_ids = arrays['entry_ids'][matched_groups]
+    results = []
+    for position in np.lexsort((entry_ids, combined_offsets, -peaks_matched)):
+        group = matched_groups[position]
+        title = str(arrays['titles'][group]).replace("\n", "")
+        results.append({'Entry_ID': str(entry_ids[position]),
+                        'Assigned_chem_shift_list_ID': str(arrays['list_ids'][group]),
+                        'Title': title or None,
+                        'Link': str(arrays['links'][group]) or None,
+                        'Peaks': [{'Queried': {'H': peaks[queried[x]][0], nucleus: peaks[queried[x]][1]},
+                                   'Matched': {'H': float(matched_h[x]), nucleus: float(matched_x[x])}}
+                                  for x in range(starts[position], ends[position])],
+                        'Combined_offset': round(Decimal(repr(float(combined_offsets[position]))), 3),
+                        'Peaks_matched': int(peaks_matched[position])})
+
+    return results
+
+
+metabolomics_shift_index = ArrayStore('metabolomics_shifts', build_metabolomics_shift_index)
+peak_indexes = {database: ArrayStore('%s_peaks' % database, functools.partial(build_peak_index, database))
+                for database in ['macromolecules', 'metabolomics']}
@@ -0,0 +1,193 @@
+""" Streams the results of queries which may match too many rows to hold in memory. The rows are fetched in batches
+from a server-side cursor, and each batch is encoded and sent before the next one is fetched.
+
+Besides JSON, the results can be encoded as CSV, or (if pyarrow is installed) as columnar Arrow IPC streams or Parquet
+files, in which numeric columns keep their types. """
+
+import csv
+import io
+import itertools
+from typing import Generator, Iterable, List, Optional
+
+import simplejson as json
+from flask import Response
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+from bmrbapi.exceptions import RequestException
+from bmrbapi.utils.configuration import configuration
+from bmrbapi.utils.connections import PostgresConnection
+
+mimetypes = {'json': 'application/json', 'ndjson': 'application/x-ndjson', 'csv': 'text/csv',
+             'arrow': 'application/vnd.apache.arrow.stream', 'parquet': 'application/vnd.apache.parquet'}
+columnar_formats = ['arrow', 'parquet']
+# Columnar formats are more compact with more rows per batch (and Parquet writes a row group per batch)
+batch_rows = {'arrow': 20000, 'parquet': 50000}
+
+# The Postgres type OIDs of the columns which keep their types in the columnar formats. numeric is sent as a float,
+#  since that is what it is converted to for analysis anyway.
+integer_types = {20, 21, 23}
+float_types = {700, 701, 1700}
+boolean_types = {16}
+string_array_types = {1009, 1015}
+
+
+def encode_json(columns: List[str], batches: Iterable[list], query: Optional[str] = None) -> Generator[str, None, None]:
+    """ Encodes the rows as {"columns": [...], "data": [[...], ...]}, the same as the non-streaming endpoints. If query
+    is provided it is included as "debug". """
+
+    yield '{"columns": %s, "data": [' % json.dumps(columns)
+    separator = ''
+    for batch in batches:
+        if batch:
+            yield separator + ','.join(json.dumps(row) for row in batch)
+            separator = ','
+    if query is not None:
+        yield '], "debug": %s}' % json.dumps(query)
+    else:
+        yield ']}'
+
+
+def encode_ndjson(columns: List[str], batches: Iterable[list]) -> Generator[str, None, None]:
+    """ Encodes each row as a JSON object on its own line. """
+
+    for batch in batches:
+        yield ''.join(json.dumps(dict(zip(columns, row))) + '\n' for row in batch)
+
+
+def encode_csv(columns: List[str], batches: Iterable[list]) -> Generator[str, None, None]:
+    """ Encodes the rows as CSV, with a header row. """
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    for batch in batches:
+        writer.writerows(batch)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+
+class ChunkSink(io.RawIOBase):
+    """ A write-only file which holds what is written to it until it is taken, so that the files pyarrow writes can be
+    sent as they are written. """
+
+    def __init__(self):
+        super().__init__()
+        self._chunks: List[bytes] = []
+        self._position = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._position
+
+    def take(self) -> bytes:
+        """ Returns what was written since the last call. """
+
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def get_arrow_schema(description) -> 'pyarrow.Schema':
+    """ Returns the Arrow schema matching the columns of a cursor. """
+
+    fields = []
+    for column in description:
+        if column.type_code in integer_types:
+            fields.append(pyarrow.field(column.name, pyarrow.int64()))
+        elif column.type_code in float_types:
+            fields.append(pyarrow.field(column.name, pyarrow.float64()))
+        elif column.type_code in boolean_types:
+            fields.append(pyarrow.field(column.name, pyarrow.bool_()))
+        elif column.type_code in string_array_types:
+            fields.append(pyarrow.field(column.name, pyarrow.list_(pyarrow.string())))
+        else:
+            fields.append(pyarrow.field(column.name, pyarrow.string()))
+    return pyarrow.schema(fields)
+
+
+def get_record_batch(schema: 'pyarrow.Schema', batch: list) -> 'pyarrow.RecordBatch':
+    """ Converts a batch of rows to a batch of columns. """
+
+    arrays = []
+    for position, field in enumerate(schema):
+        values = [row[position] for row in batch]
+        if pyarrow.types.is_floating(field.type):
+            values = [float(x) if x is not None else None for x in values]
+        elif pyarrow.types.is_string(field.type):
+            values = [str(x) if x is not None else None for x in values]
+        arrays.append(pyarrow.array(values, type=field.type))
+    return pyarrow.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+def encode_arrow(description, batches: Iterable[list]) -> Generator[bytes, None, None]:
+    """ Encodes the rows as an Arrow IPC stream, with one record batch per batch of rows. """
+
+    schema = get_arrow_schema(description)
+    sink = ChunkSink()
+    with pyarrow.ipc.new_stream(sink, schema) as writer:
+        for batch in batches:
+            writer.write_batch(get_record_batch(schema, batch))
+            yield sink.take()
+    yield sink.take()
+
+
+def encode_parquet(description, batches: Iterable[list]) -> Generator[bytes, None, None]:
+    """ Encodes the rows as a Parquet file, with one row group per batch of rows. """
+
+    schema = get_arrow_schema(description)
+    sink = ChunkSink()
+    with pyarrow.parquet.ParquetWriter(sink, schema) as writer:
+        for batch in batches:
+            writer.write_table(pyarrow.Table.from_batches([get_record_batch(schema, batch)]))
+            yield sink.take()
+    yield sink.take()
+
+
+def stream_query(sql: str, args: list, schema: str, format_: str = 'json') -> Response:
+    """ Runs the query using a server-side cursor, and returns a response which streams the results in the given format
+    (json, ndjson, csv, arrow, or parquet). The query is run before returning, so that errors are raised while they can
+    still be reported to the client. """
+
+    if format_ in columnar_formats and pyarrow is None:
+        raise RequestException("The %s format is not available on this server. Please use csv instead." % format_,
+                               status_code=501)
+
+    def generate():
+        with PostgresConnection(schema=schema, server_side=True, itersize=batch_rows.get(format_, 2000)) as cur:
+            cur.execute(sql, args)
+            first_batch = cur.fetchmany(cur.itersize)
+            columns = [desc[0] for desc in cur.description]
+            batches = itertools.chain([first_batch], iter(lambda: cur.fetchmany(cur.itersize), []))
+            # The query has run, so let the response start
+            yield ''
+
+            if format_ == 'ndjson':
+                yield from encode_ndjson(columns, batches)
+            elif format_ == 'csv':
+                yield from encode_csv(columns, batches)
+            elif format_ == 'arrow':
+                yield from encode_arrow(cur.description, batches)
+            elif format_ == 'parquet':
+                yield from encode_parquet(cur.description, batches)
+            else:
+                # Send query string if in debug mode
+                query = cur.query.decode() if configuration['debug'] else None
+                yield from encode_json(columns, batches, query=query)
+
+    results = generate()
+    next(results)
+    return Response(results, mimetype=mimetypes.get(format_, 'application/json'))
@@ -1,6 +1,9 @@
 #!/usr/bin/env python3
 
+import os
+import subprocess
 import sys
+import tempfile
 import time
 import unittest
 from io import StringIO
@@ -8,6 +11,7 @@ from io import StringIO
 import pynmrstar
 import requests
 
+from bmrbapi.reloaders import work_queue
 from bmrbapi.utils import querymod
 from bmrbapi.utils.connections import RedisConnection
 
@@ -91,6 +95,81 @@ class TestAPI(unittest.TestCase):
         with RedisConnection() as redis_conn:
             redis_conn.delete(querymod.locate_entry(response['entry_id'], redis_conn))
 
+    def test_requeue_acknowledged_chunk(self):
+        """ Make sure that a chunk acknowledged by its worker after the coordinator found its claim expired is not put
+        back onto the work queue, while one which is still being processed is."""
+
+        with RedisConnection() as redis_conn:
+            if redis_conn.exists(work_queue.queue_key, work_queue.processing_key):
+                self.skipTest("A distributed reload is in progress.")
+
+            item = b'{"id": -1, "entries": [], "full": false, "dictionary": null, "generations": null}'
+            try:
+                # The worker acknowledges the chunk between the coordinator listing it and requeueing it
+                redis_conn.lpush(work_queue.processing_key, item)
+                redis_conn.hset(work_queue.claims_key, item, 0)
+                redis_conn.lrem(work_queue.processing_key, 1, item)
+                redis_conn.hdel(work_queue.claims_key, item)
+                self.assertFalse(work_queue.requeue_chunk(redis_conn, item))
+                self.assertEqual(redis_conn.llen(work_queue.queue_key), 0)
+
+                # The worker died, so the chunk is still being processed
+                redis_conn.lpush(work_queue.processing_key, item)
+                redis_conn.hset(work_queue.claims_key, item, 0)
+                self.assertTrue(work_queue.requeue_chunk(redis_conn, item))
+                self.assertEqual(redis_conn.lrange(work_queue.queue_key, 0, -1), [item])
+                self.assertEqual(redis_conn.llen(work_queue.processing_key), 0)
+                self.assertFalse(redis_conn.hexists(work_queue.claims_key, item))
+            finally:
+                redis_conn.delete(work_queue.queue_key, work_queue.processing_key, work_queue.claims_key)
+
+    def test_distributed_reload(self):
+        """ Make sure that chunks loaded by several workers are each acknowledged once, that the work queue is empty
+        afterwards, and that the entries are in the generation they were loaded into."""
+
+        with RedisConnection() as redis_conn:
+            if redis_conn.exists(work_queue.queue_key, work_queue.processing_key):
+                self.skipTest("A distributed reload is in progress.")
+
+            generation = 'test%d' % os.getpid()
+            generations = {'macromolecules': (generation, None)}
+            with tempfile.TemporaryDirectory() as entry_dir:
+                chunks = []
+                for chunk_id in range(4):
+                    chunk = []
+                    for entry_id in ['99%02d%d' % (chunk_id, x) for x in range(2)]:
+                        entry = pynmrstar.Entry.from_scratch(entry_id)
+                        entry_information = pynmrstar.Saveframe.from_scratch('entry_information', 'Entry')
+                        entry_information.add_tag('Sf_category', 'entry_information')
+                        entry_information.add_tag('ID', entry_id)
+                        entry.add_saveframe(entry_information)
+                        entry.write_to_file(os.path.join(entry_dir, entry_id + '.str'))
+                        chunk.append((entry_id, os.path.join(entry_dir, entry_id + '.str')))
+                    chunks.append(chunk)
+
+                # The workers are started first, and wait for the chunks to be queued
+                workers = [subprocess.Popen([sys.executable, '-m', 'bmrbapi.reloaders', '--worker', '--worker-once'],
+                                            cwd=os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
+                           for _ in range(3)]
+                try:
+                    results = list(work_queue.queue_chunks(chunks, generations=generations))
+                    # A chunk acknowledged a second time would only be pushed to the results once the workers exit
+                    self.assertEqual([worker.wait(timeout=60) for worker in workers], [0] * len(workers))
+                    self.assertEqual(len(results), len(chunks))
+                    loaded = [entry_id for _, chunk_loaded, _ in results for entry_id in chunk_loaded]
+                    self.assertEqual(sorted(loaded), sorted(x[0] for chunk in chunks for x in chunk))
+                    self.assertFalse(redis_conn.exists(work_queue.queue_key, work_queue.processing_key,
+                                                       work_queue.claims_key, work_queue.results_key))
+                    for entry_id in loaded:
+                        self.assertTrue(redis_conn.exists(querymod.locate_entry(entry_id, generation=generation)))
+                finally:
+                    for worker in workers:
+                        if worker.poll() is None:
+                            worker.kill()
+                    keys = list(redis_conn.scan_iter(match="macromolecules:%s:*" % generation))
+                    if keys:
+                        redis_conn.delete(*keys)
+
     def test_create_chemcomp_from_db(self):
         """ See if our code to generate a chemcomp from the DB is working."""
 
@@ -1,3 +1,4 @@
+import calendar
 import csv
 import os
 import subprocess
@@ -6,10 +7,11 @@ import zlib
 from decimal import Decimal
 from hashlib import md5
 from io import StringIO
-from time import time as unix_time
-from typing import List, Dict
+from time import strptime, time as unix_time
+from typing import List, Dict, Optional, Union
 
 import pynmrstar
+import simplejson as json
 from flask import Blueprint, Response, request, jsonify, send_file, make_response
 from pybmrb import csviz
 
@@ -17,21 +19,15 @@ from bmrbapi.exceptions import ServerException, RequestException
 from bmrbapi.utils import querymod
 from bmrbapi.utils.configuration import configuration
 from bmrbapi.utils.connections import PostgresConnection, RedisConnection
+from bmrbapi.utils.decorators import require_content_type_json
 from bmrbapi.utils.mappings import three_letter_code_to_one
-from bmrbapi.utils.querymod import get_valid_entries_from_redis
 
 entry_endpoints = Blueprint('entry', __name__)
+# How long the entries released since a given date are kept in order, to page through them
+released_since_timeout = 300
 
 
 # Helper functions defined before the views
-def check_valid(entry_id) -> None:
-    """ Checks if a given entry ID exists in redis. If not, throws a RequestException."""
-
-    with RedisConnection() as r:
-        if not r.exists(querymod.locate_entry(entry_id, r_conn=r)):
-            raise RequestException("Entry '%s' does not exist in the public database." % entry_id, status_code=404)
-
-
 def get_tags(entry_id: str, search_tags: List[str]) -> Dict[str, List[str]]:
     """ Returns results for the queried tags."""
 
@@ -41,10 +37,9 @@ def get_tags(entry_id: str, search_tags: List[str]) -> Dict[str, List[str]]:
             raise RequestException("You must provide the tag category to call this method at the entry level. For "
                                    "example, use 'Entry.Title' rather than 'Title'.")
 
-    # Go through the IDs
-    entry = next(get_valid_entries_from_redis(entry_id))
+    entry = querymod.get_entry_from_redis(entry_id, format_="object")[0]
     try:
-        return {entry[0]: entry[1].get_tags(search_tags)}
+        return {entry_id: entry.get_tags(search_tags)}
     # They requested a tag that doesn't exist
     except ValueError as error:
         raise RequestException(str(error))
@@ -56,19 +51,19 @@ def get_loops_by_category(entry_id: str, loop_categories: List[str], format_: st
 
     result = {}
 
-    # Go through the IDs
-    for entry in get_valid_entries_from_redis(entry_id):
-        result[entry[0]] = {}
-        for loop_category in loop_categories:
-            matches = entry[1].get_loops_by_category(loop_category)
+    # Only fetch the saveframes which contain the loops, if possible
+    entry = (entry_id, querymod.get_partial_entry_from_redis(entry_id, loop_categories=loop_categories))
+    result[entry[0]] = {}
+    for loop_category in loop_categories:
+        matches = entry[1].get_loops_by_category(loop_category)
 
-            if format_ == "rawnmrstar":
-                response = make_response("\n".join([str(x) for x in matches]), 200)
-                response.mimetype = "text/plain"
-                return response
-            else:
-                matching_loops = [x.get_json(serialize=False) for x in matches]
-            result[entry[0]][loop_category] = matching_loops
+        if format_ == "rawnmrstar":
+            response = make_response("\n".join([str(x) for x in matches]), 200)
+            response.mimetype = "text/plain"
+            return response
+        else:
+            matching_loops = [x.get_json(serialize=False) for x in matches]
+        result[entry[0]][loop_category] = matching_loops
 
     return jsonify(result)
 
@@ -79,8 +74,8 @@ def get_saveframes_by_category(entry_id: str, saveframe_categories: List[str], f
 
     result = {}
 
-    # Go through the IDs
-    entry = next(get_valid_entries_from_redis(entry_id))
+    # Only fetch the matching saveframes, if possible
+    entry = (entry_id, querymod.get_partial_entry_from_redis(entry_id, saveframe_categories=saveframe_categories))
     result[entry[0]] = {}
     for saveframe_category in saveframe_categories:
         matches = entry[1].get_saveframes_by_category(saveframe_category)
@@ -100,8 +95,8 @@ def get_saveframes_by_name(entry_id: str, saveframe_names: List[str], format_: s
 
     result = {}
 
-    # Go through the IDs
-    entry = next(get_valid_entries_from_redis(entry_id))
+    # Only fetch the matching saveframes, if possible
+    entry = (entry_id, querymod.get_partial_entry_from_redis(entry_id, saveframe_names=saveframe_names))
     result[entry[0]] = {}
     for saveframe_name in saveframe_names:
         try:
@@ -118,6 +113,63 @@ def get_saveframes_by_name(entry_id: str, saveframe_names: List[str], format_: s
     return jsonify(result)
 
 
+def is_full_entry_request() -> bool:
+    """ Returns True if the whole entry was requested, rather than some saveframes, loops, or tags of it. """
+
+    return not any(request.args.get(x, None) for x in ['saveframe_category', 'saveframe_name', 'loop', 'tag'])
+
+
+def get_entry_representation(entry_id: str, format_: str, entry=None) -> Response:
+    """ Returns the entry, or the saveframes, loops, or tags of it that were requested. If the whole entry was
+    requested and has already been fetched in the requested format, provide it to avoid fetching it again. """
+
+    # See if they specified more than one of [saveframe, loop, tag]
+    args = sum([1 if request.args.get('saveframe_category', None) else 0,
+                1 if request.args.get('saveframe_name', None) else 0,
+                1 if request.args.get('loop', None) else 0,
+                1 if request.args.get('tag', None) else 0])
+    if args > 1:
+        raise RequestException("Request either loop(s), saveframe(s) by category, saveframe(s) by name, "
+                               "or tag(s) but not more than one simultaneously.")
+
+    # See if they are requesting one or more saveframe
+    elif request.args.get('saveframe_category', None):
+        return get_saveframes_by_category(entry_id, request.args.getlist('saveframe_category'), format_)
+
+    # See if they are requesting one or more saveframe
+    elif request.args.get('saveframe_name', None):
+        return get_saveframes_by_name(entry_id, request.args.getlist('saveframe_name'), format_)
+
+    # See if they are requesting one or more loop
+    elif request.args.get('loop', None):
+        return get_loops_by_category(entry_id, request.args.getlist('loop'), format_)
+
+    # See if they want a tag
+    elif request.args.get('tag', None):
+        return jsonify(get_tags(entry_id, request.args.getlist('tag')))
+
+    # They want an entry
+    else:
+        # Get the entry
+        if entry is None:
+            entry = querymod.get_entry_from_redis(entry_id, format_=format_)[0]
+
+        # Bypass JSON encode/decode cycle
+        if format_ == "json":
+            return Response("""{"%s": %s}""" % (entry_id, entry.decode()), mimetype="application/json")
+
+        # Special case to return raw nmrstar
+        elif format_ == "rawnmrstar":
+            return Response(entry, mimetype="text/plain")
+
+        # Special case for raw zlib
+        elif format_ == "zlib":
+            return Response(entry, mimetype="application/zlib")
+
+        # Return the entry in any other format
+        return jsonify(entry)
+
+
 def panav_parser(panav_text: bytes) -> dict:
     """ Parses the PANAV data into something jsonify-able."""
 
@@ -207,53 +259,23 @@ def get_entry(entry_id=None):
 
     # Loading
     else:
-        # Make sure it is a valid entry
-        check_valid(entry_id)
-
-        # See if they specified more than one of [saveframe, loop, tag]
-        args = sum([1 if request.args.get('saveframe_category', None) else 0,
-                    1 if request.args.get('saveframe_name', None) else 0,
-                    1 if request.args.get('loop', None) else 0,
-                    1 if request.args.get('tag', None) else 0])
-        if args > 1:
-            raise RequestException("Request either loop(s), saveframe(s) by category, saveframe(s) by name, "
-                                   "or tag(s) but not more than one simultaneously.")
-
-        # See if they are requesting one or more saveframe
-        elif request.args.get('saveframe_category', None):
-            return get_saveframes_by_category(entry_id, request.args.getlist('saveframe_category'), format_)
-
-        # See if they are requesting one or more saveframe
-        elif request.args.get('saveframe_name', None):
-            return get_saveframes_by_name(entry_id, request.args.getlist('saveframe_name'), format_)
-
-        # See if they are requesting one or more loop
-        elif request.args.get('loop', None):
-            return get_loops_by_category(entry_id, request.args.getlist('loop'), format_)
-
-        # See if they want a tag
-        elif request.args.get('tag', None):
-            return jsonify(get_tags(entry_id, request.args.getlist('tag')))
-
-        # They want an entry
-        else:
-            # Get the entry
-            entry_id, entry = next(querymod.get_valid_entries_from_redis(entry_id, format_=format_))
-
-            # Bypass JSON encode/decode cycle
-            if format_ == "json":
-                return Response("""{"%s": %s}""" % (entry_id, entry.decode()), mimetype="application/json")
-
-            # Special case to return raw nmrstar
-            elif format_ == "rawnmrstar":
-                return Response(entry, mimetype="text/plain")
-
-            # Special case for raw zlib
-            elif format_ == "zlib":
-                return Response(entry, mimetype="application/zlib")
+        # Make sure it is a valid entry, and see if the client already has the current version of what they want. If
+        #  they might, only fetch the metadata, otherwise fetch the entry (if needed) along with it.
+        fetch_format = format_ if is_full_entry_request() and not request.if_none_match else None
+        entry, meta = querymod.get_entry_from_redis(entry_id, format_=fetch_format, meta_fields=['etag'])
+        etag = meta['etag']
+        if etag:
+            # Each combination of arguments is a different representation of the entry
+            etag = "%s-%s" % (etag, md5(request.query_string).hexdigest()[:12])
+            if etag in request.if_none_match:
+                response = Response(status=304)
+                response.set_etag(etag)
+                return response
 
-            # Return the entry in any other format
-            return jsonify(entry)
+        response = make_response(get_entry_representation(entry_id, format_, entry))
+        if etag:
+            response.set_etag(etag)
+        return response
 
 
 @entry_endpoints.route('/entry/<entry_id>/software')
@@ -277,7 +299,7 @@ WHERE "Software"."Entry_ID" = %s''', [entry_id])
 
         # If no results, make sure the entry exists
         if len(results) == 0:
-            check_valid(entry_id)
+            querymod.get_entry_from_redis(entry_id)
 
         return jsonify({"columns": column_names, "data": results})
 
@@ -363,91 +385,33 @@ ORDER BY me."Entry_ID", me."ID";'''
         results.append(tmp_res)
     # If no results, make sure the entry exists
     if len(results) == 0:
-        check_valid(entry_id)
+        querymod.get_entry_from_redis(entry_id)
     return jsonify(results)
 
 
-@entry_endpoints.route('/entry/<entry_id>/citation')
-def get_citation(entry_id):
-    """ Return the citation information for an entry in the requested format. """
-
-    format_ = request.args.get('format', "json-ld")
-
-    # Error if invalid
-    if format_ not in ["json-ld", "text", "bibtex"]:
-        raise RequestException("Invalid format specified. Please choose from the following formats: %s" %
-                               str(["json-ld", "text", "bibtex"]))
+def get_citation_record(entry_id: str, citation: Optional[str]) -> Optional[dict]:
+    """ Returns the citation record of the entry, given the one stored with it, or None if the entry can't be cited.
+    Entries loaded by an older reloader don't have it stored, so it is built from the entry for those. """
 
+    if citation is not None:
+        return json.loads(citation)
     try:
-        ent_ret_id, entry = next(get_valid_entries_from_redis(entry_id))
-    except StopIteration:
-        raise RequestException("Entry '%s' does not exist in the public database." % entry_id)
+        return querymod.get_citation_record(querymod.get_entry_from_redis(entry_id, format_="object")[0])
+    # Entries without a title or release information can't be cited
+    except (IndexError, KeyError, ValueError):
+        return None
 
-    # First lets get all the values we need, later we will format them
 
-    def get_tag(saveframe, tag):
-        tag = saveframe.get_tag(tag)
-        if not tag:
-            return ""
-        else:
-            return tag[0]
-
-    # Authors and citations
-    authors = []
-    citations = []
-    citation_title, citation_journal, citation_volume_issue, citation_pagination, citation_year = '', '', '', '', ''
-
-    for citation_frame in entry.get_saveframes_by_category("citations"):
-        if get_tag(citation_frame, "Class") == "entry citation":
-            cl = citation_frame["_Citation_author"]
-
-            # Get the journal information
-            citation_journal = get_tag(citation_frame, "Journal_abbrev")
-            issue = get_tag(citation_frame, "Journal_issue")
-            if issue and issue != ".":
-                issue = "(%s)" % issue
-            else:
-                issue = ""
-            volume = get_tag(citation_frame, "Journal_volume")
-            if not volume or volume == ".":
-                volume = ""
-            citation_volume_issue = "%s%s" % (volume, issue)
-            citation_year = get_tag(citation_frame, "Year")
-            citation_pagination = "%s-%s" % (get_tag(citation_frame, "Page_first"),
-                                             get_tag(citation_frame, "Page_last"))
-            citation_title = get_tag(citation_frame, "Title").strip()
-
-            # Authors
-            for row in cl.get_tag(["Given_name", "Family_name", "Middle_initials"]):
-                auth = {"@type": "Person", "givenName": row[0], "familyName": row[1]}
-                if row[2] != ".":
-                    auth["additionalName"] = row[2]
-                authors.append(auth)
-
-            # Citations
-            doi = get_tag(citation_frame, "DOI")
-            if doi and doi != ".":
-                citations.append({"@type": "ScholarlyArticle",
-                                  "@id": "https://doi.org/" + doi,
-                                  "headline": get_tag(citation_frame, "Title"),
-                                  "datePublished": get_tag(citation_frame, "Year")})
-
-    # Figure out last update day, version, and original release
-    orig_release, last_update, version = None, None, 1
-    for row in entry.get_loops_by_category("Release")[0].get_tag(["Release_number", "Date"]):
-        if row[0] == "1":
-            orig_release = row[1]
-        if int(row[0]) >= version:
-            last_update = row[1]
-            version = int(row[0])
-
-    # Title
-    title = entry.get_tag("Entry.Title")[0].rstrip()
+def render_citation(entry_id: str, record: dict, format_: str) -> Union[dict, str]:
+    """ Renders the citation record of an entry (see querymod.get_citation_record()) in the given format. """
+
+    authors = record['authors']
+    orig_release = record['orig_release']
 
     # DOI string
-    doi = "10.13018/BMR%s" % ent_ret_id
-    if ent_ret_id.startswith("bmse") or ent_ret_id.startswith("bmst"):
-        doi = "10.13018/%s" % ent_ret_id.upper()
+    doi = "10.13018/BMR%s" % entry_id
+    if entry_id.startswith("bmse") or entry_id.startswith("bmst"):
+        doi = "10.13018/%s" % entry_id.upper()
 
     if format_ == "json-ld":
         res = {"@context": "http://schema.org",
@@ -455,15 +419,15 @@ def get_citation(entry_id):
                "@id": "https://doi.org/10.13018/%s" % doi,
                "publisher": "Biological Magnetic Resonance Bank",
                "datePublished": orig_release,
-               "dateModified": last_update,
-               "version": "v%s" % version,
-               "name": title,
+               "dateModified": record['last_update'],
+               "version": "v%s" % record['version'],
+               "name": record['title'],
                "author": authors}
 
-        if len(citations) > 0:
-            res["citation"] = citations
+        if len(record['citations']) > 0:
+            res["citation"] = record['citations']
 
-        return jsonify(res)
+        return res
 
     elif format_ == "bibtex":
         ret_string = """@misc{%(entry_id)s,
@@ -477,13 +441,12 @@ def get_citation(entry_id):
  url = {https://doi.org/%(doi)s}
 }"""
 
-        ret_keys = {"entry_id": ent_ret_id, "title": title,
+        ret_keys = {"entry_id": entry_id, "title": record['title'],
                     "year": orig_release[0:4], "month": orig_release[5:7],
                     "doi": doi,
                     "author": " and ".join([x["familyName"] + ", " + x["givenName"] for x in authors])}
 
-        return Response(ret_string % ret_keys, mimetype="application/x-bibtex",
-                        headers={"Content-disposition": "attachment; filename=%s.bib" % entry_id})
+        return ret_string % ret_keys
 
     elif format_ == "text":
 
@@ -494,16 +457,16 @@ def get_citation(entry_id):
                 name += x["additionalName"]
             names.append(name)
 
-        text_dict = {"entry_id": entry_id, "title": title,
-                     "citation_title": citation_title,
-                     "citation_journal": citation_journal,
-                     "citation_volume_issue": citation_volume_issue,
-                     "citation_pagination": citation_pagination,
-                     "citation_year": citation_year,
+        text_dict = {"entry_id": entry_id, "title": record['title'],
+                     "citation_title": record['citation_title'],
+                     "citation_journal": record['citation_journal'],
+                     "citation_volume_issue": record['citation_volume_issue'],
+                     "citation_pagination": record['citation_pagination'],
+                     "citation_year": record['citation_year'],
                      "author": ", ".join(names),
                      "doi": doi}
 
-        if citation_journal:
+        if record['citation_journal']:
             citation = """BMRB ID: %(entry_id)s
 %(author)s
 %(citation_title)s
@@ -512,7 +475,67 @@ def get_citation(entry_id):
         else:
             citation = "BMRB ID: %(entry_id)s %(author)s %(title)s doi: %(doi)s" % text_dict
 
-        return Response(citation, mimetype="text/plain")
+        return citation
+
+
+@entry_endpoints.route('/entry/<entry_id>/citation')
+def get_citation(entry_id):
+    """ Return the citation information for an entry in the requested format. """
+
+    format_ = request.args.get('format', "json-ld")
+
+    # Error if invalid
+    if format_ not in ["json-ld", "text", "bibtex"]:
+        raise RequestException("Invalid format specified. Please choose from the following formats: %s" %
+                               str(["json-ld", "text", "bibtex"]))
+
+    citation = querymod.get_entry_from_redis(entry_id, meta_fields=['citation'])[1]['citation']
+    record = get_citation_record(entry_id, citation)
+    if record is None:
+        raise RequestException("Entry '%s' doesn't have the information needed to cite it." % entry_id)
+    rendered = render_citation(entry_id, record, format_)
+
+    if format_ == "json-ld":
+        return jsonify(rendered)
+    elif format_ == "bibtex":
+        return Response(rendered, mimetype="application/x-bibtex",
+                        headers={"Content-disposition": "attachment; filename=%s.bib" % entry_id})
+    else:
+        return Response(rendered, mimetype="text/plain")
+
+
+@entry_endpoints.route('/entry/citations', methods=['POST'])
+@require_content_type_json
+def get_citations():
+    """ Return the citation information for many entries at once in the requested format. The entry IDs are
+    provided as a JSON list in the request body. """
+
+    format_ = request.args.get('format', "json-ld")
+
+    entry_ids = request.json
+    if not isinstance(entry_ids, list) or not all(isinstance(x, str) for x in entry_ids):
+        raise RequestException("Please provide the entry IDs as a JSON list of strings.")
+    if len(entry_ids) > 10000:
+        raise RequestException('Too many IDs queried. Please query 10000 or fewer entries at a time. You attempted '
+                               'to query %d IDs.' % len(entry_ids))
+
+    # Only the stored citations are used, as building them from the entries would mean fetching and parsing each one.
+    #  Entries loaded by an older reloader don't have one stored, so are treated as if they can't be cited.
+    citations = {}
+    for entry_id, meta in querymod.get_entries_meta_from_redis(entry_ids, ['citation']).items():
+        if meta is not None and meta['citation'] is not None:
+            record = json.loads(meta['citation'])
+            if record is not None:
+                citations[entry_id] = render_citation(entry_id, record, format_)
+
+    # Entries which can't be cited are null in JSON-LD, and left out otherwise
+    if format_ == "json-ld":
+        return jsonify({entry_id: citations.get(entry_id) for entry_id in entry_ids})
+    elif format_ == "bibtex":
+        return Response("\n\n".join(citations.values()), mimetype="application/x-bibtex",
+                        headers={"Content-disposition": "attachment; filename=citations.bib"})
+    else:
+        return Response("\n\n".join(citations.values()), mimetype="text/plain")
 
 
 @entry_endpoints.route('/entry/<entry_id>/simulate_hsqc')
@@ -523,7 +546,7 @@ def simulate_hsqc(entry_id):
     filter_ = request.args.get('filter', "all")
 
     # The PyBMRB exception only fires if the entry ID is valid
-    check_valid(entry_id)
+    querymod.get_entry_from_redis(entry_id)
 
     if format_ == 'html':
         csviz._AUTOOPEN = False
@@ -589,10 +612,8 @@ def simulate_hsqc(entry_id):
 def validate_entry(entry_id):
     """ Returns the validation report for the given entry. """
 
-    try:
-        entry_id, entry = next(querymod.get_valid_entries_from_redis(entry_id))
-    except StopIteration:
-        raise RequestException("Entry '%s' does not exist in the public database." % entry_id)
+    # The entry is modified below, so don't use a (shared) cached entry object
+    entry = pynmrstar.Entry.from_json(querymod.get_entry_from_redis(entry_id, format_="dict")[0])
 
     result = {entry_id: {'avs': {}}}
     # Put the chemical shift loop in a file
@@ -656,8 +677,68 @@ def validate_entry(entry_id):
 @entry_endpoints.route('/list_entries')
 def list_entries():
     """ Returns all valid entry IDs by default. If a database is specified than
-        only entries from that database are returned. """
+        only entries from that database are returned.
+
+        The entries can be paged through by specifying the maximum number of
+        entries to return (limit) and the last entry of the previous page
+        (after), and filtered to those released on or after a given date
+        (released_since). """
 
     db = querymod.get_db("combined")
+    limit = request.args.get('limit', type=int)
+    after = request.args.get('after')
+    released_since = request.args.get('released_since')
+    if limit is not None and limit < 1:
+        raise RequestException("The limit must be at least 1.")
+    if released_since is not None:
+        try:
+            released_since = calendar.timegm(strptime(released_since, "%Y-%m-%d"))
+        except ValueError:
+            raise RequestException("Invalid date specified for 'released_since'. Please use the format YYYY-MM-DD.")
+
     with RedisConnection() as r:
-        return jsonify(r.lrange("%s:entry_list" % db, 0, -1))
+        if limit is None and after is None and released_since is None:
+            # The reloader stores the whole list ready to be served
+            entry_list = r.get("%s:entry_list_json" % db)
+            if entry_list is not None:
+                return Response(entry_list, mimetype='application/json')
+            return jsonify([x.decode() for x in r.lrange("%s:entry_list" % db, 0, -1)])
+
+        # Entries loaded by an older reloader aren't in the sorted sets, so page through the list instead
+        if not r.exists("%s:entry_order" % db):
+            if released_since is not None:
+                raise ServerException("Listing entries by release date is not available until the entries are "
+                                      "reloaded.", status_code=503)
+            entries = [x.decode() for x in r.lrange("%s:entry_list" % db, 0, -1)]
+            if after is not None:
+                try:
+                    entries = entries[entries.index(after) + 1:]
+                except ValueError:
+                    raise RequestException("The entry specified by 'after' is not in the database.")
+            return jsonify(entries[:limit])
+
+        # Entries are scored by their position in the list
+        min_score = "-inf"
+        if after is not None:
+            after_score = r.zscore("%s:entry_order" % db, after)
+            if after_score is None:
+                raise RequestException("The entry specified by 'after' is not in the database.")
+            min_score = "(%s" % after_score
+
+        order_key = "%s:entry_order" % db
+        if released_since is not None:
+            # Keep the entries released since the date, scored by their position in the list, for the following pages
+            order_key = "%s:entry_order_released:%d" % (db, released_since)
+            if not r.exists(order_key):
+                pipe = r.pipeline()
+                pipe.zunionstore(order_key, ["%s:entry_releases" % db])
+                pipe.zremrangebyscore(order_key, "-inf", "(%d" % released_since)
+                pipe.zinterstore(order_key, {order_key: 0, "%s:entry_order" % db: 1})
+                pipe.expire(order_key, released_since_timeout)
+                pipe.execute()
+
+        if limit is None:
+            entries = r.zrangebyscore(order_key, min_score, "+inf")
+        else:
+            entries = r.zrangebyscore(order_key, min_score, "+inf", start=0, num=limit)
+        return jsonify([x.decode() for x in entries])
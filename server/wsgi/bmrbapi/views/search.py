@@ -4,10 +4,11 @@ import textwrap
 import warnings
 from decimal import Decimal
 from tempfile import NamedTemporaryFile
-from typing import List, Dict, Iterable, Set
+from typing import List, Dict, Iterable, Set, Tuple
 from urllib.parse import quote
 
 import psycopg2
+import simplejson as json
 from flask import jsonify, request, Blueprint, url_for
 from psycopg2 import ProgrammingError
 
@@ -15,54 +16,73 @@ from psycopg2 import ProgrammingError
 import bmrbapi.views.sql.search as sql_statements
 from bmrbapi.exceptions import RequestException, ServerException
 from bmrbapi.utils.configuration import configuration
-from bmrbapi.utils.connections import PostgresConnection
+from bmrbapi.utils.connections import PostgresConnection, RedisConnection
 from bmrbapi.utils.decorators import require_content_type_json
 from bmrbapi.utils.querymod import SUBMODULE_DIR, get_db, get_entry_id_tag, select as qselect, \
-    get_database_from_entry_id, get_valid_entries_from_redis, \
+    get_valid_entries_from_redis, get_extra_data_summary, locate_entry, \
     get_category_and_tag, wrap_it_up, select as querymod_select
+from bmrbapi.utils.shift_index import search_database_shifts, search_metabolomics_shifts, search_peaks
+from bmrbapi.utils.streaming import stream_query
 
 search_endpoints = Blueprint('search', __name__)
 
 
-def get_extra_data_available(bmrb_id):
-    """ Returns any additional data associated with the entry. For example:
+def get_extra_data_available(bmrb_ids: List[str]) -> Dict[str, List[dict]]:
+    """ Returns any additional data associated with each of the entries. For example:
 
-    Time domain, residual dipolar couplings, pKa values, etc."""
+    Time domain, residual dipolar couplings, pKa values, etc.
 
-    # Set up the DB cursor
-    with PostgresConnection(schema=get_database_from_entry_id(bmrb_id)) as cur:
+    The summary of the data in each entry is stored with the entry when it is loaded, so they are all fetched from
+    Redis at once. Entries which aren't available in Redis have no additional data - for example, when we only have
+    2.0 records for an entry."""
 
-        query = '''
-SELECT "Entry_ID" as entry_id, ed."Type" as type, dic.catgrpviewname as description, "Count"::integer as sets,
-       0 as size from "Data_set" as ed
-  LEFT JOIN dict.aditcatgrp as dic ON ed."Type" = dic.sfcategory
- WHERE ed."Entry_ID" like %s
-UNION
-SELECT bmrbid, 'time_domain_data', 'Time domain data', sets, size FROM web.timedomain_data where bmrbid like %s;'''
-        cur.execute(query, [bmrb_id, bmrb_id])
+    if not bmrb_ids:
+        return {}
 
-        try:
-            entry = next(get_valid_entries_from_redis(bmrb_id))[1]
-        # This happens when an entry is valid but isn't available in Redis - for example, when we only have
-        #  2.0 records for an entry.
-        except StopIteration:
-            return []
+    with RedisConnection() as r_conn:
+        pipe = r_conn.pipeline(transaction=False)
+        for bmrb_id in bmrb_ids:
+            pipe.exists(locate_entry(bmrb_id))
+            pipe.hget(locate_entry(bmrb_id, key_type="entry_meta"), "extra_data")
+        pipe.exists("timedomain_data")
+        pipe.hmget("timedomain_data", bmrb_ids)
+        results = pipe.execute()
+    exists, summaries = results[0:-2:2], results[1:-2:2]
+    timedomain_data = [json.loads(x) if x is not None else None for x in results[-1]]
 
-        extra_data = []
-        for row in cur.fetchall():
-            if row['type'] == 'time_domain_data':
-                extra_data.append({'data_type': row['description'], 'data_sets': row['sets'], 'size': row['size'],
-                                   'thumbnail_url': url_for('static', filename='fid.svg', _external=True),
-                                   'urls': ['https://bmrb.io/ftp/pub/bmrb/timedomain/bmr%s/' % bmrb_id]})
-            elif row['type'] != "assigned_chemical_shifts":
-                saveframe_names = [x.name for x in entry.get_saveframes_by_category(row['type'])]
-                url = 'https://bmrb.io/data_library/summary/showGeneralSF.php?accNum=%s&Sf_framecode=%s'
+    # The time domain data hasn't been loaded into Redis yet
+    if not results[-2]:
+        with PostgresConnection() as cur:
+            cur.execute('''SELECT bmrbid, sets, size FROM web.timedomain_data WHERE bmrbid IN %s;''',
+                        [tuple(bmrb_ids)])
+            rows = {row['bmrbid']: {'sets': row['sets'], 'size': row['size']} for row in cur.fetchall()}
+        timedomain_data = [rows.get(bmrb_id) for bmrb_id in bmrb_ids]
 
-                extra_data.append({'data_type': row['description'], 'data_sets': row['sets'],
-                                   'data_sfcategory': row['type'],
-                                   'urls': [url % (bmrb_id, quote(x)) for x in saveframe_names]})
+    # Entries loaded by an older reloader don't have the summary stored, so build it from the entry
+    missing = [bmrb_id for bmrb_id, entry_exists, summary in zip(bmrb_ids, exists, summaries)
+               if entry_exists and summary is None]
+    built = {entry_id: get_extra_data_summary(entry) for entry_id, entry in get_valid_entries_from_redis(missing)}
 
-    return extra_data
+    result = {}
+    for bmrb_id, entry_exists, summary, timedomain in zip(bmrb_ids, exists, summaries, timedomain_data):
+        if not entry_exists:
+            result[bmrb_id] = []
+            continue
+
+        extra_data = []
+        for data_type in built[bmrb_id] if summary is None else json.loads(summary):
+            url = 'https://bmrb.io/data_library/summary/showGeneralSF.php?accNum=%s&Sf_framecode=%s'
+            extra_data.append({'data_type': data_type['data_type'], 'data_sets': data_type['data_sets'],
+                               'data_sfcategory': data_type['data_sfcategory'],
+                               'urls': [url % (bmrb_id, quote(x)) for x in data_type['saveframes']]})
+        if timedomain is not None:
+            extra_data.append({'data_type': 'Time domain data', 'data_sets': timedomain['sets'],
+                               'size': timedomain['size'],
+                               'thumbnail_url': url_for('static', filename='fid.svg', _external=True),
+                               'urls': ['https://bmrb.io/ftp/pub/bmrb/timedomain/bmr%s/' % bmrb_id]})
+        result[bmrb_id] = extra_data
+
+    return result
 
 
 def get_bmrb_ids_from_pdb_id(pdb_id: str) -> List[Dict[str, str]]:
@@ -107,8 +127,10 @@ def get_bmrb_data_from_pdb_id(pdb_id):
     """ Returns the associated BMRB data for a PDB ID. """
 
     result = []
-    for item in get_bmrb_ids_from_pdb_id(pdb_id):
-        data = get_extra_data_available(item['bmrb_id'])
+    bmrb_ids = get_bmrb_ids_from_pdb_id(pdb_id)
+    extra_data = get_extra_data_available([item['bmrb_id'] for item in bmrb_ids])
+    for item in bmrb_ids:
+        data = extra_data[item['bmrb_id']]
         if data:
             result.append({'bmrb_id': item['bmrb_id'], 'match_types': item['match_types'],
                            'url': 'https://bmrb.io/data_library/summary/index.php?bmrbId=%s' % item['bmrb_id'],
@@ -134,104 +156,71 @@ def multiple_shift_search():
     if not shift_strings:
         raise RequestException("You must specify at least one shift to search for.")
 
-    sql = '''
-SELECT atom_shift."Entry_ID",atom_shift."Assigned_chem_shift_list_ID"::text,
-  array_agg(DISTINCT  atom_shift."Val" || ',' ||  atom_shift."Atom_type") as shift_pair,ent.title,ent.link
-FROM "Atom_chem_shift" as atom_shift
-LEFT JOIN web.instant_cache as ent
-  ON ent.id = atom_shift."Entry_ID"
-WHERE '''
-    terms = []
-
     shift_floats: List[float] = []
-    shift_decimals: List[Decimal] = []
     shift = None
     try:
         for shift in shift_strings:
             shift_floats.append(float(shift))
-            shift_decimals.append(Decimal(shift))
     except ValueError:
         raise RequestException("Invalid shift specified. All shifts must be numbers. Invalid shift: '%s'" % shift)
 
-    shift_floats = sorted(shift_floats)
-    shift_decimals = sorted(shift_decimals)
+    # The metabolomics shifts are indexed in memory
+    database = get_db("metabolomics")
+    if database == "metabolomics":
+        return jsonify({'data': search_metabolomics_shifts(shift_floats, thresholds)})
 
-    for shift in shift_floats:
-        sql += '''
-((atom_shift."Val"::float <= %s  AND atom_shift."Val"::float >= %s AND atom_shift."Atom_type" = 'C')
- OR
- (atom_shift."Val"::float <= %s  AND atom_shift."Val"::float >= %s AND atom_shift."Atom_type" = 'N')
- OR
- (atom_shift."Val"::float <= %s  AND atom_shift."Val"::float >= %s AND atom_shift."Atom_type" = 'H')) OR '''
-        terms.append(shift + thresholds['C'])
-        terms.append(shift - thresholds['C'])
-        terms.append(shift + thresholds['N'])
-        terms.append(shift - thresholds['N'])
-        terms.append(shift + thresholds['H'])
-        terms.append(shift - thresholds['H'])
-
-    # End the OR
-    sql += '''
-1=2
-GROUP BY atom_shift."Entry_ID",atom_shift."Assigned_chem_shift_list_ID",ent.title,ent.link
-ORDER BY count(DISTINCT atom_shift."Val") DESC;
-    '''
-
-    # Do the query
-    with PostgresConnection(schema=get_db("metabolomics")) as cur:
-        cur.execute(sql, terms)
-        result = {"data": []}
+    result = {}
+    with PostgresConnection(schema=database) as cur:
+        result['data'] = search_database_shifts(cur, shift_floats, thresholds)
 
         # Send query string if in debug mode
         if configuration['debug']:
             result['debug'] = cur.query
+    return jsonify(result)
 
-        for entry in cur:
-            title = entry[3].replace("\n", "") if entry[3] else None
-            # Perfect opportunity for walrus operator once using 3.8
-            shifts = [{'Shift': Decimal(y[0]), 'Atom_type': y[1]} for y in [x.split(',') for x in entry[2]]]
-
-            result['data'].append({'Entry_ID': entry[0], 'Assigned_chem_shift_list_ID': entry[1], 'Title': title,
-                                   'Link': entry[4], 'Val': shifts})
-
-    def get_closest(collection, number):
-        """ Returns the closest number from a list of numbers. """
-        return min(collection, key=lambda _: abs(_ - number))
-
-    def get_closest_by_atom(collection: dict,
-                            shift_value: Decimal) -> dict:
-        """ Returns the closest [shift,atom_name] pair from the options. """
-
-        # Start with impossibly bad peak of the correct atom type, in case no matches for this peak exist
-        best_match: dict = {'Shift': Decimal('inf'), 'Atom_type': None}
-        for item in collection:
-            if abs(item['Shift'] - shift_value) < best_match['Shift']:
-                best_match = {'Shift': item['Shift'], 'Atom_type': item['Atom_type']}
-        return best_match
-
-    def get_sort_key(res) -> [int, Decimal, str]:
-        """ Returns the sort key. """
 
-        key: Decimal = Decimal(0)
+@search_endpoints.route('/search/peak_search')
+def peak_search():
+    """ Finds entries with bonded H/N or H/C shift pairs near the queried 2D peaks. """
 
-        # Add the difference of all the shifts
-        for item in res['Val']:
-            key += abs(get_closest(shift_decimals, item['Shift']) - item['Shift'])
-        res['Combined_offset'] = round(key, 3)
+    peaks: List[Tuple[float, float]] = []
+    for peak in request.args.getlist('peak'):
+        try:
+            h_shift, x_shift = [float(x) for x in peak.split(',')]
+        except ValueError:
+            raise RequestException("Invalid peak specified. Each peak must be the H shift and the N or C shift, "
+                                   "separated by a comma. Invalid peak: '%s'" % peak)
+        peaks.append((h_shift, x_shift))
+
+    if not peaks:
+        raise RequestException("You must specify at least one peak to search for.")
+
+    nucleus = request.args.get('nucleus', 'N').upper()
+    if nucleus not in ('N', 'C'):
+        raise RequestException("Invalid nucleus specified. Please specify either 'N' or 'C'.")
+    try:
+        h_threshold = float(request.args.get('hthresh', .05))
+        x_threshold = float(request.args.get('%sthresh' % nucleus.lower(), .5))
+    except ValueError:
+        raise RequestException("Invalid threshold specified. The thresholds must be numbers.")
+    if not (h_threshold > 0 and x_threshold > 0):
+        raise RequestException("Invalid threshold specified. The thresholds must be greater than zero.")
+    database = get_db('macromolecules', valid_list=['macromolecules', 'metabolomics'])
 
-        # Determine how many of the queried shifts were matched
-        num_match = 0
-        for check_peak in shift_decimals:
-            closest = get_closest_by_atom(res['Val'], check_peak)
-            if abs(check_peak - closest['Shift']) <= thresholds[closest['Atom_type']]:
-                num_match += 1
-        res['Shifts_matched'] = num_match
+    return jsonify({'data': search_peaks(database, peaks, nucleus, h_threshold, x_threshold)})
 
-        return -num_match, key, res['Entry_ID']
 
-    result['data'] = sorted(result['data'], key=get_sort_key)
+def merge_shift_windows(windows: List[Tuple[float, float]]) -> List[Tuple[float, float]]:
+    """ Merges the overlapping (exclusive) ranges of shift values, so that a shift falls within at most one of them
+    and joining against them doesn't return it more than once. """
 
-    return jsonify(result)
+    merged = []
+    for range_low, range_high in sorted(windows):
+        if merged and range_low < merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], range_high))
+        else:
+            merged.append((range_low, range_high))
+    return merged
 
 
 @search_endpoints.route('/search/chemical_shifts')
@@ -258,7 +247,6 @@ SELECT cs."Entry_ID"                          AS "Atom_chem_shift.Entry_ID",
        "Ambiguity_code"                       AS "Atom_chem_shift.Ambiguity_code",
        "Assigned_chem_shift_list_ID"::integer AS "Atom_chem_shift.Assigned_chem_shift_list_ID"
 FROM "Atom_chem_shift" AS cs
-WHERE
 '''
 
     if conditions:
@@ -285,61 +273,131 @@ FROM "Atom_chem_shift" AS cs
                    ON csf."Sample_condition_list_ID" = temp."Sample_condition_list_ID" AND
                       temp."Entry_ID" = cs."Entry_ID" AND
                       temp."Type" = 'temperature' AND temp."Val_units" = 'K'
-WHERE
 '''
 
     args = []
 
+    # See if a peak is specified
+    if shift_val:
+        windows = []
+        for val in shift_val:
+            try:
+                windows.append((float(val) - threshold, float(val) + threshold))
+            except ValueError:
+                raise RequestException('Invalid chemical shift specified: %s' % val)
+        range_lows, range_highs = zip(*merge_shift_windows(windows))
+        sql += '''
+JOIN unnest(%s::float[], %s::float[]) AS windows(range_low, range_high)
+  ON cs.val_float > windows.range_low AND cs.val_float < windows.range_high
+'''
+        args.append(list(range_lows))
+        args.append(list(range_highs))
+
+    sql += "WHERE 1=1"
+
     # See if a specific atom type is needed
     if atom_type:
-        sql += '''"Atom_type" = %s AND '''
+        sql += ''' AND "Atom_type" = %s'''
         args.append(atom_type.upper())
 
     # See if a specific atom is needed
     if atom_id:
-        sql += "("
-        for atom in atom_id:
-            sql += '''"Atom_ID" LIKE %s OR '''
-            args.append(atom.replace("*", "%").upper())
-        sql += "1 = 2) AND "
+        sql += ''' AND "Atom_ID" LIKE ANY(%s)'''
+        args.append([atom.replace("*", "%").upper() for atom in atom_id])
 
     # See if a specific residue is needed
     if comp_id:
-        sql += "("
-        for comp in comp_id:
-            sql += '''"Comp_ID" = %s OR '''
-            args.append(comp.upper())
-        sql += "1 = 2) AND "
+        sql += ''' AND "Comp_ID" = ANY(%s)'''
+        args.append([comp.upper() for comp in comp_id])
 
-    # See if a peak is specified
-    if shift_val:
-        sql += "("
-        for val in shift_val:
-            sql += '''(cs."Val"::float  < %s AND cs."Val"::float > %s) OR '''
-            try:
-                range_low = float(val) - threshold
-                range_high = float(val) + threshold
-            except ValueError:
-                raise RequestException('Invalid chemical shift specified: %s' % val)
-            args.append(range_high)
-            args.append(range_low)
-        sql += "1 = 2) AND "
+    # There may be millions of matching shifts, so stream them rather than building the whole response in memory
+    return stream_query(sql, args, database, request.args.get('format', 'json'))
 
-    # Make sure the SQL query syntax works out
-    sql += '''1=1'''
 
-    result = {}
+# The percentiles stored for each atom by the shift statistics reloader
+shift_statistics_percentiles = ['5', '25', '50', '75', '95']
 
-    # Do the query
-    with PostgresConnection(schema=database) as cur:
-        cur.execute(sql, args)
+
+def get_histogram(bin_width: float, bins: List[int], counts: List[int]) -> dict:
+    """ Expands a histogram stored as only its non-empty bins, which are numbered by their lower edge divided by the bin
+    width, into the counts of every bin from the first non-empty one to the last. """
+
+    if not bins:
+        return {'Bin_width': bin_width, 'Start': None, 'Counts': []}
+
+    all_counts = [0] * (bins[-1] - bins[0] + 1)
+    for bin_, count in zip(bins, counts):
+        all_counts[bin_ - bins[0]] = count
+    return {'Bin_width': bin_width, 'Start': round(bins[0] * bin_width, 6), 'Counts': all_counts}
+
+
+@search_endpoints.route('/search/chemical_shift_statistics')
+def get_chemical_shift_statistics():
+    """ Returns the precomputed statistics and histograms of the chemical shifts of the specified atoms, either of all
+    of the shifts or of those measured at around the specified pH or temperature."""
+
+    comp_id: List[str] = request.args.getlist('comp_id')
+    atom_id: List[str] = request.args.getlist('atom_id')
+    ph: str = request.args.get('ph', None)
+    temperature: str = request.args.get('temperature', None)
+    database: str = get_db('macromolecules', valid_list=['macromolecules', 'metabolomics'])
+
+    if not comp_id:
+        raise RequestException("You must specify at least one comp_id.")
+    if ph is not None and temperature is not None:
+        raise RequestException("You may only specify one of ph and temperature.")
+
+    sql = '''
+SELECT comp_id, atom_id, atom_type, condition, band_low, band_high, count, mean, std, min, max, percentiles, bin_width,
+       histogram_bins, histogram_counts
+FROM web.shift_statistics
+WHERE database = %s AND comp_id = ANY(%s)'''
+    args = [database, [comp.upper() for comp in comp_id]]
+
+    if atom_id:
+        sql += ''' AND atom_id LIKE ANY(%s)'''
+        args.append([atom.replace("*", "%").upper() for atom in atom_id])
+
+    if ph is not None or temperature is not None:
+        condition, value = ('ph', ph) if ph is not None else ('temperature', temperature)
+        try:
+            value = float(value)
+        except ValueError:
+            raise RequestException("Invalid %s specified. It must be a number." % condition)
+        sql += ''' AND condition = %s AND band_low <= %s AND %s < band_high'''
+        args.extend([condition, value, value])
+    else:
+        sql += " AND condition = 'all'"
+    sql += ''' ORDER BY comp_id, atom_id'''
+
+    result = {'data': []}
+    with PostgresConnection() as cur:
+        try:
+            cur.execute(sql, args)
+        except ProgrammingError:
+            raise ServerException("The chemical shift statistics have not been calculated yet.")
+
+        for row in cur:
+            result['data'].append({
+                'Comp_ID': row['comp_id'],
+                'Atom_ID': row['atom_id'],
+                'Atom_type': row['atom_type'],
+                'Condition': row['condition'],
+                'Band': [row['band_low'], row['band_high']] if row['condition'] != 'all' else None,
+                'Count': row['count'],
+                'Mean': row['mean'],
+                'Std': row['std'],
+                'Min': row['min'],
+                'Max': row['max'],
+                'Percentiles': dict(zip(shift_statistics_percentiles, row['percentiles'])),
+                'Histogram': get_histogram(row['bin_width'], row['histogram_bins'] or [],
+                                           row['histogram_counts'] or [])
+            })
 
         # Send query string if in debug mode
         if configuration['debug']:
             result['debug'] = cur.query
 
-        result['columns'] = [desc[0] for desc in cur.description]
-        result['data'] = cur.fetchall()
     return jsonify(result)
 
 
@@ -348,25 +406,30 @@ def get_all_values_for_tag(tag_name):
     """ Returns all entry numbers and corresponding tag values."""
 
     database = get_db('macromolecules')
+    format_ = request.args.get('format', 'json')
 
     params = get_category_and_tag(tag_name)
-    with PostgresConnection(schema=database) as cur:
 
-        # Use Entry_ID normally, but occasionally use ID depending on the context
-        id_field = get_entry_id_tag(tag_name, database=database)
+    # Use Entry_ID normally, but occasionally use ID depending on the context
+    id_field = get_entry_id_tag(tag_name, database=database)
 
+    if format_ != 'json':
+        # One row per value, which is what a data frame wants
+        query = '''SELECT "%s", %%s FROM "%s" WHERE %%s IS NOT NULL AND %%s::text NOT IN ('', 'na')
+  ORDER BY "%s";'''
+        query = query % (id_field, params[0], id_field)
+        try:
+            return stream_query(query, [wrap_it_up(params[1])] * 3, database, format_)
+        except ProgrammingError as e:
+            raise_tag_not_found(e)
+
+    with PostgresConnection(schema=database) as cur:
         query = '''SELECT "%s", array_agg(%%s) from "%s" GROUP BY "%s";'''
         query = query % (id_field, params[0], id_field)
         try:
             cur.execute(query, [wrap_it_up(params[1])])
         except ProgrammingError as e:
-            sp = str(e).split('\n')
-            if len(sp) > 3:
-                if sp[3].strip().startswith("HINT:  Perhaps you meant to reference the column"):
-                    raise RequestException("Tag not found. Did you mean the tag: '%s'?" %
-                                           sp[3].split('"')[1])
-
-            raise RequestException("Tag not found.")
+            raise_tag_not_found(e)
 
         # Turn the results into a dict
         res = {}
@@ -384,6 +447,18 @@ def get_all_values_for_tag(tag_name):
     return res
 
 
+def raise_tag_not_found(error: ProgrammingError) -> None:
+    """ Raises the error to return when querying for a tag fails, suggesting the right tag if Postgres did. """
+
+    sp = str(error).split('\n')
+    if len(sp) > 3:
+        if sp[3].strip().startswith("HINT:  Perhaps you meant to reference the column"):
+            raise RequestException("Tag not found. Did you mean the tag: '%s'?" %
+                                   sp[3].split('"')[1])
+
+    raise RequestException("Tag not found.")
+
+
 @search_endpoints.route('/search/get_id_by_tag_value/<tag_name>/<path:tag_value>')
 def get_id_from_search(tag_name, tag_value):
     """ Returns all BMRB IDs that were found when querying for entries